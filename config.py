@@ -9,6 +9,28 @@ STATIC_FOLDER = os.path.join(PROJECT_ROOT, 'droneapp/static')
 DEBUG = False
 LOG_FILE = 'ptell.log'
 
+# 操作するドローンの一覧（Fleet.addの引数）、最初のドローンが既定のドローンになる
+# 例: 複数台のTello EDUをそれぞれのインターフェース経由で操作する場合
+# DRONES = [
+#     {'drone_ip': '192.168.10.1', 'host_ip': '192.168.10.2'},
+#     {'drone_ip': '192.168.11.1', 'host_ip': '192.168.11.2'},
+# ]
+# 直近の映像（プリロール）の保存先と保持量は {'drone_ip': ..., 'preroll_folder': ..., 'preroll_seconds': 10,
+# 'preroll_max_bytes': 16 * 1024 * 1024} で変更できる
+# 映像のデコードをプロセス内で行う場合は {'drone_ip': '192.168.10.1', 'video_decoder': 'pyav'}（PyAVが必要）
+DRONES = [
+    {'drone_ip': '192.168.10.1'},
+]
+
+# 飛行中のデータグラムを記録するフォルダ（/api/capture/start、tools/replay_capture.pyで再生）
+CAPTURE_FOLDER = os.path.join(PROJECT_ROOT, 'captures')
+
+# 映像（H.264）の録画フォルダ（/api/recording/start、tools/extract_recording.pyで切り出し）
+RECORDING_FOLDER = os.path.join(PROJECT_ROOT, 'recordings')
+
+# スナップショットの索引とサムネイルの保存先（静的ファイルとして配信しないよう、スナップショットのフォルダとは分ける）
+GALLERY_FOLDER = os.path.join(PROJECT_ROOT, 'gallery')
+
 # Flaskアプリケーションの初期化
 app = Flask(__name__, template_folder=TEMPLATES, static_folder=STATIC_FOLDER)
 
@@ -1,4 +1,7 @@
 import logging
+import os
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 from flask import jsonify
 from flask import render_template
@@ -8,13 +11,33 @@ from flask import redirect, url_for, flash
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 
 import droneapp.models.course
-from droneapp.models.drone_manager import DroneManager # ドローン管理クラスをインポート
+from droneapp.models.drone_manager import ErrorInvalidResolution
+from droneapp.models.drone_manager import SNAPSHOT_BURST_MAX
+from droneapp.models.drone_manager import SNAPSHOT_IMAGE_FOLDER
+from droneapp.models.fleet import ErrorUnknownDrone
+from droneapp.models.fleet import Fleet # 複数ドローンの管理クラスをインポート
+from droneapp.models.gallery import ErrorUnknownSnapshot
+from droneapp.models.gallery import GALLERY_PER_PAGE
+from droneapp.models.gallery import SnapshotGallery
+from droneapp.models.preroll import ErrorPrerollEmpty
+from droneapp.models.telemetry import STATE_FIELDS
+from droneapp.models.telemetry_store import ErrorUnknownField
+from droneapp.models.telemetry_store import TELEMETRY_POINTS
+from droneapp.models.telemetry_store import TELEMETRY_WINDOW_SECONDS
 from droneapp.models.user import get_user, authenticate_user
 
 import config
 
+try:
+    from flask_sock import Sock  # WebSocketでfMP4を配信する場合のみ必要（pip install flask-sock）
+except ImportError:
+    Sock = None
+
 logger = logging.getLogger(__name__) #loggerオブジェクトを取得、他のモジュールからも利用できるようにする  
+SNAPSHOT_TIMEOUT = 2  # スナップショットの書き込みを待つ最大時間（秒）、映像が流れていなければ失敗になる
+PREROLL_TIMEOUT = 10  # プリロールの書き出しを待つ最大時間（秒）
 app = config.app  # Flaskアプリケーションのインスタンスを取得
+sock = Sock(app) if Sock is not None else None  # flask-sockがなければfMP4はHTTPのチャンク転送で配信する
 
 # Flask-Loginの初期化
 login_manager = LoginManager()
@@ -26,11 +49,28 @@ login_manager.login_message = 'ドローンを操作するにはログインが
 def load_user(user_id):
     return get_user(user_id)
 
-# グローバルなドローンインスタンス（アプリ起動時に初期化）
-drone_instance = DroneManager()
+# ドローンの一覧（アプリ起動時に初期化）,各ルートは/drones/<drone_id>/...でドローンを指定できる
+fleet = Fleet()
+fleet_drones = [fleet.add(**drone_config) for drone_config in config.DRONES]
+
+# スナップショットの索引（全ドローンで共通のフォルダ）、撮影したファイルは書き込みのスレッドから追加される
+gallery = SnapshotGallery(SNAPSHOT_IMAGE_FOLDER, config.GALLERY_FOLDER)
+gallery.sync()  # サーバーを止めている間に追加・削除されたファイルを反映する
+for drone in fleet_drones:
+    drone.add_snapshot_listener(gallery.add)
+
+def get_drone(drone_id=None):
+    return fleet.get(drone_id)
 
-def get_drone():
-    return drone_instance
+@app.errorhandler(ErrorUnknownDrone)
+def unknown_drone(ex):
+    return jsonify(status='fail', message=f'Unknown drone: {ex}'), 404
+
+# 登録されているドローンの一覧を返すAPIエンドポイント
+@app.route('/api/drones', methods=['GET'])
+@login_required
+def drones():
+    return jsonify(drones=fleet.ids()), 200
 
 @app.route('/')
 def index():
@@ -64,105 +104,141 @@ def logout():
 @app.route('/controller/')
 @login_required
 def controller():
-    return render_template('controller.html')
+    return render_template('controller.html', video_websocket=sock is not None)
 
 # 顔追跡制御用の個別APIエンドポイント
 @app.route('/face_tracking/enable', methods=['POST'])
+@app.route('/drones/<drone_id>/face_tracking/enable', methods=['POST'])
 @login_required
-def enable_face_tracking():
-    drone = get_drone()
+def enable_face_tracking(drone_id=None):
+    drone = get_drone(drone_id)
     result = drone.enable_face_tracking()
     return jsonify(status='success', message=result), 200
 
 @app.route('/face_tracking/disable', methods=['POST'])
+@app.route('/drones/<drone_id>/face_tracking/disable', methods=['POST'])
 @login_required
-def disable_face_tracking():
-    drone = get_drone()
+def disable_face_tracking(drone_id=None):
+    drone = get_drone(drone_id)
     result = drone.disable_face_tracking()
     return jsonify(status='success', message=result), 200
 
 @app.route('/face_tracking/toggle', methods=['POST'])
+@app.route('/drones/<drone_id>/face_tracking/toggle', methods=['POST'])
 @login_required
-def toggle_face_tracking():
-    drone = get_drone()
+def toggle_face_tracking(drone_id=None):
+    drone = get_drone(drone_id)
     result = drone.toggle_face_tracking()
     return jsonify(status='success', message=result), 200
 
+@app.route('/face_tracking/mode', methods=['POST'])
+@app.route('/drones/<drone_id>/face_tracking/mode', methods=['POST'])
+@login_required
+def face_tracking_mode(drone_id=None):
+    drone = get_drone(drone_id)
+    mode = request.form.get('mode')
+    if not drone.set_tracking_mode(mode):
+        return jsonify(status='fail', message=f'Unknown tracking mode: {mode}'), 400
+    return jsonify(status='success', mode=mode), 200
+
+# 顔検出のフレーム間隔を変更するAPIエンドポイント（間のフレームは追跡器で顔を追う）
+@app.route('/face_detect/interval', methods=['POST'])
+@app.route('/drones/<drone_id>/face_detect/interval', methods=['POST'])
+@login_required
+def face_detect_interval(drone_id=None):
+    drone = get_drone(drone_id)
+    interval = request.form.get('interval', type=int)
+    if interval is None or interval < 1:
+        return jsonify(status='fail', message='interval must be a positive integer'), 400
+    return jsonify(status='success', interval=drone.set_detect_interval(interval)), 200
+
 @app.route('/face_tracking/status', methods=['GET'])
+@app.route('/drones/<drone_id>/face_tracking/status', methods=['GET'])
 @login_required
-def face_tracking_status():
-    drone = get_drone()
+def face_tracking_status(drone_id=None):
+    drone = get_drone(drone_id)
     status = "enabled" if drone.is_face_tracking else "disabled"
-    return jsonify(status=status, is_tracking=drone.is_face_tracking), 200
+    return jsonify(status=status, is_tracking=drone.is_face_tracking, mode=drone.tracking_mode), 200
 
 # 基本操作用の個別APIエンドポイント（追跡中でも利用可能）
 @app.route('/takeoff', methods=['POST'])
+@app.route('/drones/<drone_id>/takeoff', methods=['POST'])
 @login_required
-def takeoff():
-    drone = get_drone()
+def takeoff(drone_id=None):
+    drone = get_drone(drone_id)
     drone.takeoff()
     return jsonify(status='success', message='Takeoff command sent'), 200
 
 @app.route('/land', methods=['POST'])
+@app.route('/drones/<drone_id>/land', methods=['POST'])
 @login_required
-def land():
-    drone = get_drone()
+def land(drone_id=None):
+    drone = get_drone(drone_id)
     drone.land()
     return jsonify(status='success', message='Land command sent'), 200
 
 @app.route('/up', methods=['POST'])
+@app.route('/drones/<drone_id>/up', methods=['POST'])
 @login_required
-def up():
-    drone = get_drone()
+def up(drone_id=None):
+    drone = get_drone(drone_id)
     drone.up()
     return jsonify(status='success', message='Up command sent'), 200
 
 @app.route('/down', methods=['POST'])
+@app.route('/drones/<drone_id>/down', methods=['POST'])
 @login_required
-def down():
-    drone = get_drone()
+def down(drone_id=None):
+    drone = get_drone(drone_id)
     drone.down()
     return jsonify(status='success', message='Down command sent'), 200
 
 @app.route('/left', methods=['POST'])
+@app.route('/drones/<drone_id>/left', methods=['POST'])
 @login_required
-def left():
-    drone = get_drone()
+def left(drone_id=None):
+    drone = get_drone(drone_id)
     drone.left()
     return jsonify(status='success', message='Left command sent'), 200
 
 @app.route('/right', methods=['POST'])
+@app.route('/drones/<drone_id>/right', methods=['POST'])
 @login_required
-def right():
-    drone = get_drone()
+def right(drone_id=None):
+    drone = get_drone(drone_id)
     drone.right()
     return jsonify(status='success', message='Right command sent'), 200
 
 @app.route('/forward', methods=['POST'])
+@app.route('/drones/<drone_id>/forward', methods=['POST'])
 @login_required
-def forward():
-    drone = get_drone()
+def forward(drone_id=None):
+    drone = get_drone(drone_id)
     drone.forward()
     return jsonify(status='success', message='Forward command sent'), 200
 
 @app.route('/back', methods=['POST'])
+@app.route('/drones/<drone_id>/back', methods=['POST'])
 @login_required
-def back():
-    drone = get_drone()
+def back(drone_id=None):
+    drone = get_drone(drone_id)
     drone.back()
     return jsonify(status='success', message='Back command sent'), 200
 
 # コマンドを受け取るAPIエンドポイント
 @app.route('/api/command/', methods=['POST'])
+@app.route('/drones/<drone_id>/api/command/', methods=['POST'])
 @login_required
-def command():
+def command(drone_id=None):
     cmd = request.form.get('command')
     logger.info({'action': 'command', 'cmd': cmd})
-    drone = get_drone()
+    drone = get_drone(drone_id)
     if cmd == 'takeoff':
         drone.takeoff()
     if cmd == 'land':
         drone.land()
+    if cmd == 'emergency':
+        drone.emergency()
     if cmd == 'speed':
         speed = request.form.get('speed')
         logger.info({'action': 'command', 'cmd': cmd, 'speed': speed})
@@ -226,24 +302,284 @@ def command():
         logger.info({'action': 'command', 'cmd': cmd})
         drone.toggle_face_tracking()  # 顔追跡モード切り替え
     if cmd == 'snapshot':
-        if drone.snapshot():
-            return jsonify(status='success'), 200
-        else:
-            return jsonify(status='fail'), 400
+        future = drone.snapshot()
+        try:
+            files = future.result(timeout=SNAPSHOT_TIMEOUT)
+        except FutureTimeoutError:
+            future.cancel()  # 映像が流れ始めても撮影しない
+            return jsonify(status='fail', message='No video frame'), 400
+        except Exception as ex:
+            return jsonify(status='fail', message=str(ex)), 400
+        return jsonify(status='success', files=[os.path.basename(path) for path in files]), 200
 
     return jsonify(status='success'), 200
 
+# 最新の状態（状態パケットから取得）を返すAPIエンドポイント
+@app.route('/api/state', methods=['GET'])
+@app.route('/drones/<drone_id>/api/state', methods=['GET'])
+@login_required
+def drone_state(drone_id=None):
+    drone = get_drone(drone_id)
+    state = drone.get_state()
+    if state is None:
+        return jsonify(status='fail', message='No state received'), 503
+    return jsonify(state.as_dict()), 200
+
+# 状態の時系列を間引いて返すAPIエンドポイント（グラフ描画用）
+# 例: /api/telemetry?fields=h,bat&seconds=600&points=300
+@app.route('/api/telemetry', methods=['GET'])
+@app.route('/drones/<drone_id>/api/telemetry', methods=['GET'])
+@login_required
+def drone_telemetry(drone_id=None):
+    drone = get_drone(drone_id)
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else STATE_FIELDS
+    seconds = request.args.get('seconds', TELEMETRY_WINDOW_SECONDS, type=float)
+    points = request.args.get('points', TELEMETRY_POINTS, type=int)
+    try:
+        return jsonify(drone.get_telemetry(fields, seconds, max(points, 1))), 200
+    except ErrorUnknownField as ex:
+        return jsonify(status='fail', message=f'Unknown field: {ex}'), 400
+
+# コマンド送信キューの統計を返すAPIエンドポイント
+@app.route('/api/command/stats', methods=['GET'])
+@app.route('/drones/<drone_id>/api/command/stats', methods=['GET'])
+@login_required
+def command_stats(drone_id=None):
+    drone = get_drone(drone_id)
+    return jsonify(drone.command_stats()), 200
+
+# コマンド応答のRTT推定値を返すAPIエンドポイント
+@app.route('/api/command/rtt', methods=['GET'])
+@app.route('/drones/<drone_id>/api/command/rtt', methods=['GET'])
+@login_required
+def command_rtt(drone_id=None):
+    drone = get_drone(drone_id)
+    return jsonify(drone.rtt_stats()), 200
+
+# 映像データの受信状況を返すAPIエンドポイント
+@app.route('/api/video/stats', methods=['GET'])
+@app.route('/drones/<drone_id>/api/video/stats', methods=['GET'])
+@login_required
+def video_stats(drone_id=None):
+    drone = get_drone(drone_id)
+    return jsonify(drone.video_stats()), 200
+
+# フレームの遅延（最初のデータグラムの受信から decode/detect/encode/yield/sent まで）のヒストグラムを返すAPIエンドポイント
+# POST overlay=1でフレームに受信時刻と遅延を描き込む（tello_simulatorの生成時刻と比べてガラス・トゥ・ガラスの遅延を測る）
+@app.route('/api/video/latency', methods=['GET', 'POST'])
+@app.route('/drones/<drone_id>/api/video/latency', methods=['GET', 'POST'])
+@login_required
+def video_latency(drone_id=None):
+    drone = get_drone(drone_id)
+    if request.method == 'POST':
+        drone.set_latency_overlay(request.form.get('overlay', '0') in ('1', 'true', 'on'))
+    return jsonify(drone.latency_stats()), 200
+
+# 配信・顔検出の解像度を取得・変更するAPIエンドポイント
+# 例: POST stream=960x720&detect=320x240
+@app.route('/api/video/resolution', methods=['GET', 'POST'])
+@app.route('/drones/<drone_id>/api/video/resolution', methods=['GET', 'POST'])
+@login_required
+def video_resolution(drone_id=None):
+    drone = get_drone(drone_id)
+    if request.method == 'GET':
+        return jsonify(drone.get_resolution()), 200
+    try:
+        sizes = {}
+        for name in ('stream', 'detect'):
+            value = request.form.get(name)
+            if value:
+                width, _, height = value.lower().partition('x')
+                sizes[name] = (int(width), int(height))
+        resolution = drone.set_resolution(sizes.get('stream'), sizes.get('detect'))
+    except (ValueError, ErrorInvalidResolution) as ex:
+        return jsonify(status='fail', message=f'Invalid resolution: {ex}'), 400
+    return jsonify(status='success', **resolution), 200
+
+# 受信したデータグラムの記録を開始するAPIエンドポイント（記録はtools/replay_capture.pyで再生できる）
+@app.route('/api/capture/start', methods=['POST'])
+@app.route('/drones/<drone_id>/api/capture/start', methods=['POST'])
+@login_required
+def capture_start(drone_id=None):
+    drone = get_drone(drone_id)
+    os.makedirs(config.CAPTURE_FOLDER, exist_ok=True)
+    filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{drone.drone_ip}.tcap"
+    path = os.path.join(config.CAPTURE_FOLDER, filename)
+    drone.start_capture(path)
+    return jsonify(status='success', file=filename), 200
+
+@app.route('/api/capture/stop', methods=['POST'])
+@app.route('/drones/<drone_id>/api/capture/stop', methods=['POST'])
+@login_required
+def capture_stop(drone_id=None):
+    drone = get_drone(drone_id)
+    stats = drone.stop_capture()
+    if stats is None:
+        return jsonify(status='fail', message='Not capturing'), 400
+    return jsonify(status='success', records=stats['records'], bytes=stats['bytes']), 200
+
+@app.route('/api/capture', methods=['GET'])
+@app.route('/drones/<drone_id>/api/capture', methods=['GET'])
+@login_required
+def capture_status(drone_id=None):
+    drone = get_drone(drone_id)
+    stats = drone.capture_stats()
+    if stats is None:
+        return jsonify(capturing=False), 200
+    return jsonify(capturing=True, file=os.path.basename(stats['path']),
+                   records=stats['records'], bytes=stats['bytes']), 200
+
+# 映像をデコードせずに録画するAPIエンドポイント（一定時間ごとの区間ファイルとキーフレームの索引を作る）
+# 録画はtools/extract_recording.pyで時刻を指定して切り出せる
+@app.route('/api/recording/start', methods=['POST'])
+@app.route('/drones/<drone_id>/api/recording/start', methods=['POST'])
+@login_required
+def recording_start(drone_id=None):
+    drone = get_drone(drone_id)
+    os.makedirs(config.RECORDING_FOLDER, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{drone.drone_ip}"
+    drone.start_recording(os.path.join(config.RECORDING_FOLDER, name))
+    return jsonify(status='success', name=name), 200
+
+@app.route('/api/recording/stop', methods=['POST'])
+@app.route('/drones/<drone_id>/api/recording/stop', methods=['POST'])
+@login_required
+def recording_stop(drone_id=None):
+    drone = get_drone(drone_id)
+    stats = drone.stop_recording()
+    if stats is None:
+        return jsonify(status='fail', message='Not recording'), 400
+    return jsonify(status='success', segments=stats['segments'], bytes=stats['bytes']), 200
+
+@app.route('/api/recording', methods=['GET'])
+@app.route('/drones/<drone_id>/api/recording', methods=['GET'])
+@login_required
+def recording_status(drone_id=None):
+    drone = get_drone(drone_id)
+    stats = drone.recording_stats()
+    if stats is None:
+        return jsonify(recording=False), 200
+    stats['name'] = os.path.basename(stats.pop('prefix'))
+    return jsonify(recording=True, **stats), 200
+
+# 連続したフレームを、配信する解像度（Telloの960x720ではない）のまま枠などを描画せずに保存するAPIエンドポイント
+# 例: POST count=10、応答のresolutionは保存した画像の解像度。/api/video/resolutionのstreamで変更できる（最大960x720）
+@app.route('/api/snapshot/burst', methods=['POST'])
+@app.route('/drones/<drone_id>/api/snapshot/burst', methods=['POST'])
+@login_required
+def snapshot_burst(drone_id=None):
+    drone = get_drone(drone_id)
+    count = request.form.get('count', 10, type=int)
+    if count is None or not 1 <= count <= SNAPSHOT_BURST_MAX:
+        return jsonify(status='fail', message=f'count must be 1-{SNAPSHOT_BURST_MAX}'), 400
+    future = drone.snapshot_burst(count)
+    try:
+        files = future.result(timeout=SNAPSHOT_TIMEOUT + count / 10)  # 30fpsで撮影し、エンコードする時間
+    except FutureTimeoutError:
+        future.cancel()
+        return jsonify(status='fail', message='No video frame'), 400
+    except Exception as ex:
+        return jsonify(status='fail', message=str(ex)), 400
+    return jsonify(status='success', files=[os.path.basename(path) for path in files],
+                   resolution=drone.get_resolution()['stream']), 200
+
+# スナップショットの一覧を新しい順にページ単位で返すAPIエンドポイント（索引だけを読み、画像は読まない）
+# 例: GET /api/snapshots?page=2&per_page=50&kind=burst
+@app.route('/api/snapshots', methods=['GET'])
+@login_required
+def snapshot_list():
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', GALLERY_PER_PAGE, type=int)
+    result = gallery.page(page, per_page, kind=request.args.get('kind'))
+    for item in result['items']:
+        item['url'] = url_for('static', filename=f'img/snapshots/{item["name"]}')
+        item['thumbnail_url'] = url_for('snapshot_thumbnail', name=item['name'])
+    return jsonify(result), 200
+
+# スナップショットのサムネイル（最初に要求されたときに作ってキャッシュする）
+@app.route('/api/snapshots/<name>/thumbnail', methods=['GET'])
+@login_required
+def snapshot_thumbnail(name):
+    try:
+        jpeg = gallery.thumbnail(name)
+    except ErrorUnknownSnapshot:
+        return jsonify(status='fail', message=f'Unknown snapshot: {name}'), 404
+    response = Response(jpeg, mimetype='image/jpeg')
+    response.headers['Cache-Control'] = 'private, max-age=86400'  # ファイル名は撮影日時なので内容は変わらない
+    return response
+
+@app.route('/api/snapshots/stats', methods=['GET'])
+@login_required
+def snapshot_gallery_stats():
+    return jsonify(gallery.stats()), 200
+
+# 直近の映像（プリロール）を保存するAPIエンドポイント
+# 顔が映り始めたときや状態パケットの異常（衝突・落下）でも自動で保存される
+@app.route('/api/preroll/save', methods=['POST'])
+@app.route('/drones/<drone_id>/api/preroll/save', methods=['POST'])
+@login_required
+def preroll_save(drone_id=None):
+    drone = get_drone(drone_id)
+    try:
+        result = drone.save_preroll().result(timeout=PREROLL_TIMEOUT)
+    except ErrorPrerollEmpty:
+        return jsonify(status='error', message='No video buffered'), 409  # キーフレームをまだ受信していない
+    except FutureTimeoutError:
+        return jsonify(status='error', message='Timed out writing the pre-roll'), 504  # 書き出しは続けて行われる
+    except Exception as ex:
+        logger.error({'action': 'preroll_save', 'ex': ex})
+        return jsonify(status='error', message=str(ex)), 500
+    return jsonify(status='success', file=os.path.basename(result['path']),
+                   bytes=result['bytes'], seconds=result['seconds']), 200
+
+@app.route('/api/preroll', methods=['GET'])
+@app.route('/drones/<drone_id>/api/preroll', methods=['GET'])
+@login_required
+def preroll_status(drone_id=None):
+    drone = get_drone(drone_id)
+    return jsonify(drone.preroll_stats()), 200
+
 # 映像ストリーミング用画像を生成するジェネレーター関数
-def video_generator():
-    drone = get_drone()
-    for jpeg in drone.video_frame_generator():
+# フレームを受信してから送り出すまで（yield）と、Webサーバーが書き込みを終えるまで（sent）の遅延を記録する
+def video_generator(drone):
+    for jpeg, received in drone.timed_video_frame_generator():
+        drone.record_frame_latency('yield', received)
         yield (b'--frame\r\n'
                 b'Content-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n\r\n')
+        drone.record_frame_latency('sent', received)
 
 # 映像ストリーミングのためのエンドポイント
 @app.route('/video/streaming')
-def video_feed():
-    return Response(video_generator(), mimetype='multipart/x-mixed-replace; boundary=frame')
+@app.route('/drones/<drone_id>/video/streaming')
+def video_feed(drone_id=None):
+    drone = get_drone(drone_id)
+    return Response(video_generator(drone), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+# デコードせずに詰め替えたfMP4を配信するエンドポイント（controller.htmlのMSEプレーヤーで再生する）
+# オーバーレイ（顔の枠など）が必要な場合は/video/streamingを使う
+@app.route('/video/fmp4')
+@app.route('/drones/<drone_id>/video/fmp4')
+def video_fmp4(drone_id=None):
+    drone = get_drone(drone_id)
+    return Response(drone.video_fmp4_generator(), mimetype='video/mp4',
+                    headers={'Cache-Control': 'no-store'})
+
+def video_fmp4_websocket(ws, drone_id=None):
+    """WebSocketの1メッセージに1セグメント（初期化セグメントまたはフラグメント）を送る"""
+    drone = get_drone(drone_id)
+    segments = drone.video_fmp4_generator()
+    try:
+        for segment in segments:
+            ws.send(segment)
+    except Exception as ex:
+        logger.info({'action': 'video_fmp4_websocket', 'ex': ex})  # 視聴者が切断した
+    finally:
+        segments.close()
+
+if sock is not None:
+    sock.route('/video/fmp4/ws', endpoint='video_fmp4_ws')(video_fmp4_websocket)
+    sock.route('/drones/<drone_id>/video/fmp4/ws', endpoint='drone_video_fmp4_ws')(video_fmp4_websocket)
 
 def run():
     app.run(host=config.WEB_ADDRESS, port=config.WEB_PORT, threaded=True)
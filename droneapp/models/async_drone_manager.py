@@ -0,0 +1,322 @@
+import asyncio #非同期I/O
+import logging #ログ出力用
+
+import cv2 as cv #OpenCVライブラリ
+import numpy as np #数値計算ライブラリ
+
+from droneapp.models.drone_manager import CMD_FFMPEG
+from droneapp.models.drone_manager import DEFAULT_DEGREE
+from droneapp.models.drone_manager import DEFAULT_DISTANCE
+from droneapp.models.drone_manager import DEFAULT_SPEED
+from droneapp.models.drone_manager import ErrorCommandTimeout
+from droneapp.models.drone_manager import ErrorDroneStopped
+from droneapp.models.drone_manager import FRAME_SIZE
+from droneapp.models.drone_manager import FRAME_X
+from droneapp.models.drone_manager import FRAME_Y
+from droneapp.models.drone_manager import VIDEO_PORT
+from droneapp.models.drone_manager import command_timeout
+from droneapp.models.drone_manager import decode_response
+from droneapp.models.drone_manager import is_instant_command
+from droneapp.models.rtt import RttEstimator
+
+
+logger = logging.getLogger(__name__)
+
+VIDEO_WRITE_BUFFER_LIMIT = 1024 * 1024  # ffmpegへの書き込みバッファの上限（バイト）、超えた分は破棄する
+
+
+class _CommandProtocol(asyncio.DatagramProtocol):
+    """コマンドポートの応答を受け取るプロトコル"""
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def datagram_received(self, data, addr):
+        self.manager._handle_response(data, addr)
+
+    def error_received(self, exc):
+        logger.error({'action': 'receive_response', 'ex': exc})
+
+
+class _VideoProtocol(asyncio.DatagramProtocol):
+    """映像ポートのH.264データをffmpegに渡すプロトコル"""
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def datagram_received(self, data, addr):
+        self.manager._write_video(data)
+
+    def error_received(self, exc):
+        logger.error({'action': '_receive_video', 'ex': exc})
+
+
+class AsyncDroneManager(object):
+    """asyncio版のDroneManager
+
+    ソケットはloop.create_datagram_endpointで作成し、待機はすべてawaitで行うため
+    イベントループをブロックしない。Singletonではないので、ポートを分ければ
+    1つのプロセスで複数のドローンを扱える。
+
+        async with AsyncDroneManager() as drone:
+            await drone.takeoff()
+            await drone.clockwise(90)
+            await drone.land()
+    """
+
+    def __init__(self, host_ip='0.0.0.0', host_port=8889,
+                drone_ip='192.168.10.1', drone_port=8889,
+                is_imperial=False, speed=DEFAULT_SPEED,
+                video_port=VIDEO_PORT):
+        self.host_ip = host_ip
+        self.host_port = host_port
+        self.drone_ip = drone_ip
+        self.drone_port = drone_port
+        self.drone_address = (self.drone_ip, self.drone_port)
+        self.video_port = video_port
+
+        self.is_imperial = is_imperial
+        self.speed = speed
+
+        self.response = None  # ドローンからの最新の応答メッセージ
+        self._transport = None  # コマンド用のトランスポート
+        self._video_transport = None  # 映像用のトランスポート
+        self._proc = None  # ffmpegのサブプロセス
+        self._command_lock = None  # 応答待ちのコマンドを1つに制限するロック
+        self._pending_command = None  # 応答待ちの(コマンド, Future)、なければNone
+        self._quiet_until = 0  # タイムアウト後に遅れて届く応答を読み捨てるため、次のコマンドを送らない期限（loop.time()）
+        self._rtt = RttEstimator()  # 応答時間の推定、読み捨てる期間に使う
+
+        self.is_patrol = False
+        self._patrol_task = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    async def start(self):
+        """ソケットとffmpegを準備し、SDKモードと映像ストリーミングを開始する"""
+        loop = asyncio.get_running_loop()
+        self._command_lock = asyncio.Lock()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: _CommandProtocol(self),
+            local_addr=(self.host_ip, self.host_port))
+
+        try:
+            args = CMD_FFMPEG.split(' ')
+            self._proc = await asyncio.create_subprocess_exec(
+                *args, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+        except OSError as ex:
+            logger.error({'action': 'start', 'ex': ex, 'status': 'ffmpeg not started'})
+            self._proc = None
+
+        self._video_transport, _ = await loop.create_datagram_endpoint(
+            lambda: _VideoProtocol(self), local_addr=(self.host_ip, self.video_port))
+
+        await self.send_command('command')
+        await self.send_command('streamon')
+        await self.set_speed(self.speed)
+
+    async def stop(self):
+        """パトロールを止め、ソケットとffmpegを閉じる"""
+        await self.stop_patrol()
+        if self._pending_command is not None:
+            command, future = self._pending_command
+            self._pending_command = None
+            if not future.done():
+                future.set_exception(ErrorDroneStopped(command))
+        for transport in (self._transport, self._video_transport):
+            if transport is not None:
+                transport.close()
+        self._transport = self._video_transport = None
+        if self._proc is not None:
+            if self._proc.returncode is None:
+                self._proc.kill()
+                await self._proc.wait()
+            self._proc = None
+
+    def _handle_response(self, data, addr):
+        """受信した応答を、応答待ちのコマンドのFutureに渡す"""
+        self.response = data
+        decoded_response = decode_response(data)
+        pending, self._pending_command = self._pending_command, None
+        if pending is None or pending[1].done():
+            logger.warning({'action': 'receive_response', 'response': decoded_response, 'from': addr,
+                            'status': 'unsolicited'})
+            return
+        command, future = pending
+        logger.info({'action': 'receive_response', 'command': command, 'response': decoded_response, 'from': addr})
+        future.set_result(decoded_response)
+
+    async def send_command(self, command, timeout=None):
+        """コマンドを送信して応答文字列を返す。応答がなければErrorCommandTimeoutを送出する"""
+        if timeout is None:
+            timeout = command_timeout(command)
+        async with self._command_lock:
+            loop = asyncio.get_running_loop()
+            wait = self._quiet_until - loop.time()
+            if wait > 0:
+                # 応答待ちのコマンドがない間に届いた応答はunsolicitedとして読み捨てられる
+                await asyncio.sleep(wait)
+            if self._transport is None:
+                raise ErrorDroneStopped(command)
+            future = loop.create_future()
+            self._pending_command = (command, future)
+            logger.info({'action': 'send_command', 'command': command})
+            sent_at = loop.time()
+            self._transport.sendto(command.encode('utf-8'), self.drone_address)
+            try:
+                response = await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                self._rtt.note_timeout()
+                logger.warning({'action': 'send_command', 'command': command, 'status': 'timeout'})
+                # 遅れて届いた応答が次のコマンドの応答と取り違えられないよう、少し待って読み捨てる（DroneManagerと同じ）
+                self._quiet_until = loop.time() + self._rtt.rto()
+                raise ErrorCommandTimeout(command) from None
+            finally:
+                if self._pending_command is not None and self._pending_command[1] is future:
+                    self._pending_command = None
+            if is_instant_command(command):
+                self._rtt.update(loop.time() - sent_at)
+            return response
+
+    def rtt_stats(self):
+        """コマンド応答のRTT・RTOを返す"""
+        return self._rtt.stats()
+
+    async def takeoff(self):
+        try:
+            battery_level = int(await self.send_command('battery?'))
+            if battery_level < 20:
+                logger.warning(f"警告: バッテリー残量が少ないです ({battery_level}%)")
+                if battery_level < 10:
+                    logger.error(f"エラー: バッテリー残量が危険レベルです ({battery_level}%)")
+                    return False
+            logger.info(f"バッテリー残量: {battery_level}%")
+        except (ErrorCommandTimeout, ValueError):
+            logger.warning("バッテリー残量の確認に失敗しました")
+
+        await self.send_command('takeoff')
+        return True
+
+    async def land(self):
+        return await self.send_command('land')
+
+    async def move(self, direction, distance):
+        distance = float(distance)
+        if self.is_imperial:
+            distance = int(round(distance * 30.48))  # フィートをcmに変換
+        else:
+            distance = int(round(distance * 100))  # メートルをcmに変換
+        return await self.send_command(f'{direction} {distance}')
+
+    async def up(self, distance=DEFAULT_DISTANCE):
+        return await self.move('up', distance)
+
+    async def down(self, distance=DEFAULT_DISTANCE):
+        return await self.move('down', distance)
+
+    async def left(self, distance=DEFAULT_DISTANCE):
+        return await self.move('left', distance)
+
+    async def right(self, distance=DEFAULT_DISTANCE):
+        return await self.move('right', distance)
+
+    async def forward(self, distance=DEFAULT_DISTANCE):
+        return await self.move('forward', distance)
+
+    async def back(self, distance=DEFAULT_DISTANCE):
+        return await self.move('back', distance)
+
+    async def set_speed(self, speed):
+        self.speed = speed
+        return await self.send_command(f'speed {speed}')
+
+    async def clockwise(self, degree=DEFAULT_DEGREE):
+        return await self.send_command(f'cw {degree}')
+
+    async def counter_clockwise(self, degree=DEFAULT_DEGREE):
+        return await self.send_command(f'ccw {degree}')
+
+    async def flip(self, direction):
+        if direction not in ['l', 'r', 'f', 'b']:
+            logger.error("フリップの方向は 'l', 'r', 'f', 'b' のいずれかで指定してください")
+            return None
+        return await self.send_command(f'flip {direction}')
+
+    async def flip_front(self):
+        return await self.flip('f')
+
+    async def flip_back(self):
+        return await self.flip('b')
+
+    async def flip_left(self):
+        return await self.flip('l')
+
+    async def flip_right(self):
+        return await self.flip('r')
+
+    # パトロールモードを開始するメソッド,タスクとして実行する
+    async def patrol(self):
+        if not self.is_patrol:
+            self._patrol_task = asyncio.get_running_loop().create_task(self._patrol())
+            self.is_patrol = True
+            logger.info("パトロールモードを開始しました")
+
+    async def stop_patrol(self):
+        if self.is_patrol:
+            self._patrol_task.cancel()
+            try:
+                await self._patrol_task
+            except asyncio.CancelledError:
+                pass
+            self._patrol_task = None
+            self.is_patrol = False
+            logger.info("パトロールモードを停止しました")
+
+    async def _patrol(self):
+        status = 0
+        while True:
+            status += 1
+            try:
+                if status == 1:
+                    await self.up()
+                if status == 2:
+                    await self.clockwise()
+                if status == 3:
+                    await self.down()
+            except ErrorCommandTimeout:
+                pass
+            if status == 4:
+                status = 0
+            await asyncio.sleep(5)  # 各動作の完了を待つ
+
+    def _write_video(self, data):
+        """映像データをffmpegの標準入力に書き込む（バッファが溢れている場合は破棄）"""
+        if self._proc is None or self._proc.stdin.is_closing():
+            return
+        if self._proc.stdin.transport.get_write_buffer_size() > VIDEO_WRITE_BUFFER_LIMIT:
+            return
+        self._proc.stdin.write(data)
+
+    async def video_binary_generator(self):
+        """デコード済みのフレームをNumPy配列で返す非同期ジェネレータ"""
+        if self._proc is None:
+            return
+        while True:
+            try:
+                frame = await self._proc.stdout.readexactly(FRAME_SIZE)
+            except asyncio.IncompleteReadError:
+                logger.warning('video_binary_generator: ffmpeg stream closed')
+                return
+            yield np.frombuffer(frame, np.uint8).reshape(FRAME_Y, FRAME_X, 3)
+
+    async def video_jpeg_generator(self):
+        """JPEGエンコード済みのフレームを返す非同期ジェネレータ,エンコードは別スレッドで行う"""
+        loop = asyncio.get_running_loop()
+        async for frame in self.video_binary_generator():
+            _, jpeg = await loop.run_in_executor(None, cv.imencode, '.jpg', frame)
+            yield jpeg.tobytes()
@@ -0,0 +1,212 @@
+import bisect #索引の二分探索
+import logging #ログ出力用
+import os #ファイル操作
+import struct #バイナリ形式の読み書き
+import threading #スレッド関連
+import time #時間関連
+
+logger = logging.getLogger(__name__)
+
+# キャプチャファイルの形式（リトルエンディアン）
+#   ヘッダー: MAGIC(8) バージョン(uint16) 予約(uint16)
+#   レコード: 受信時刻(float64, time.time()) チャンネル(uint8) 長さ(uint32) データ
+#   索引: INDEX_MAGIC(4) 件数(uint32) {時刻(float64) レコードの位置(uint64)}*件数
+#   フッター: 索引の位置(uint64) FOOTER_MAGIC(8)
+# 索引とフッターはclose()で書き込む。途中で終了したファイルは先頭から順に読める。
+MAGIC = b'TELLOCAP'
+VERSION = 1
+HEADER = struct.Struct('<8sHH')
+RECORD = struct.Struct('<dBI')
+INDEX_MAGIC = b'TIDX'
+INDEX_COUNT = struct.Struct('<4sI')
+INDEX_ENTRY = struct.Struct('<dQ')
+FOOTER = struct.Struct('<Q8s')
+FOOTER_MAGIC = b'TCAPEND!'
+
+INDEX_INTERVAL = 1.0  # 索引を作る間隔（秒）
+
+# チャンネル
+CHANNEL_COMMAND = 0  # 送信したコマンド
+CHANNEL_RESPONSE = 1  # コマンドの応答
+CHANNEL_STATE = 2  # 状態パケット
+CHANNEL_VIDEO = 3  # 映像データ
+CHANNEL_NAMES = {
+    CHANNEL_COMMAND: 'command',
+    CHANNEL_RESPONSE: 'response',
+    CHANNEL_STATE: 'state',
+    CHANNEL_VIDEO: 'video',
+}
+
+
+class ErrorInvalidCapture(Exception):
+    """キャプチャファイルの形式が正しくない場合の例外"""
+
+
+class CaptureWriter(object):
+    """受信したデータグラムを時刻付きでキャプチャファイルに書き込む
+
+    IOLoopのスレッドから呼ばれるため、書き込みはバッファ付きのファイルに追記するだけにする。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION, 0))
+        self._lock = threading.Lock()
+        self._index = []  # (時刻, レコードの位置)
+        self._next_index_time = 0
+        self.records = 0  # 書き込んだレコード数
+        self.bytes = 0  # 書き込んだデータのバイト数
+
+    def write(self, channel, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            if self._file is None:
+                return  # 既に閉じている
+            if timestamp >= self._next_index_time:
+                self._index.append((timestamp, self._file.tell()))
+                self._next_index_time = timestamp + INDEX_INTERVAL
+            self._file.write(RECORD.pack(timestamp, channel, len(data)))
+            self._file.write(data)
+            self.records += 1
+            self.bytes += len(data)
+
+    def close(self):
+        """索引とフッターを書き込んでファイルを閉じる"""
+        with self._lock:
+            if self._file is None:
+                return
+            index_offset = self._file.tell()
+            self._file.write(INDEX_COUNT.pack(INDEX_MAGIC, len(self._index)))
+            for entry in self._index:
+                self._file.write(INDEX_ENTRY.pack(*entry))
+            self._file.write(FOOTER.pack(index_offset, FOOTER_MAGIC))
+            self._file.close()
+            self._file = None
+        logger.info({'action': 'capture', 'path': self.path, 'records': self.records, 'bytes': self.bytes})
+
+    def stats(self):
+        return {'path': self.path, 'records': self.records, 'bytes': self.bytes}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CaptureReader(object):
+    """キャプチャファイルを読み込む"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        header = self._file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ErrorInvalidCapture(path)
+        magic, version, _ = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ErrorInvalidCapture(path)
+        self._end = os.path.getsize(path)  # レコードの終端（索引があればその手前）
+        self.index = self._read_index()
+
+    def _read_index(self):
+        """索引を読み込む。索引がない（書き込み途中で終了した）場合は空のリスト"""
+        if self._end < HEADER.size + FOOTER.size:
+            return []
+        self._file.seek(self._end - FOOTER.size)
+        index_offset, magic = FOOTER.unpack(self._file.read(FOOTER.size))
+        if magic != FOOTER_MAGIC:
+            logger.warning({'action': 'capture', 'path': self.path, 'status': 'no index'})
+            return []
+        self._file.seek(index_offset)
+        magic, count = INDEX_COUNT.unpack(self._file.read(INDEX_COUNT.size))
+        if magic != INDEX_MAGIC:
+            raise ErrorInvalidCapture(self.path)
+        data = self._file.read(INDEX_ENTRY.size * count)
+        self._end = index_offset
+        return [INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size) for i in range(count)]
+
+    def records(self, start=None, end=None, channels=None):
+        """(時刻, チャンネル, データ)を順に返す。startを指定すると索引でその付近まで読み飛ばす"""
+        offset = HEADER.size
+        if start is not None and self.index:
+            position = bisect.bisect_right([t for t, _ in self.index], start) - 1
+            if position >= 0:
+                offset = self.index[position][1]
+        self._file.seek(offset)
+        while offset + RECORD.size <= self._end:
+            timestamp, channel, length = RECORD.unpack(self._file.read(RECORD.size))
+            data = self._file.read(length)
+            offset += RECORD.size + length
+            if len(data) < length:
+                break  # 書き込み途中で終了したレコード
+            if start is not None and timestamp < start:
+                continue
+            if end is not None and timestamp > end:
+                break
+            if channels is None or channel in channels:
+                yield timestamp, channel, data
+
+    def summary(self):
+        """チャンネルごとのレコード数・バイト数と記録期間を返す"""
+        channels = {name: {'records': 0, 'bytes': 0} for name in CHANNEL_NAMES.values()}
+        first = last = None
+        for timestamp, channel, data in self.records():
+            if first is None:
+                first = timestamp
+            last = timestamp
+            counts = channels[CHANNEL_NAMES.get(channel, str(channel))]
+            counts['records'] += 1
+            counts['bytes'] += len(data)
+        return {'path': self.path, 'start': first, 'end': last,
+                'duration': (last - first) if first is not None else 0, 'channels': channels}
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CaptureReplayer(object):
+    """キャプチャしたデータグラムを元の時間間隔でDroneManagerに流し込む
+
+    speedが2なら2倍速、0なら待たずに流す。送信したコマンドは記録用なので流さない。
+    """
+
+    def __init__(self, reader, drone, speed=1.0, start=None, end=None):
+        self.reader = reader
+        self.drone = drone
+        self.speed = speed
+        self.start = start
+        self.end = end
+        self.replayed = {name: 0 for name in CHANNEL_NAMES.values()}  # 流したレコード数
+        self.lag = 0  # 予定時刻からの最大の遅れ（秒）
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        channels = (CHANNEL_RESPONSE, CHANNEL_STATE, CHANNEL_VIDEO)
+        first = None
+        started = time.monotonic()
+        for timestamp, channel, data in self.reader.records(self.start, self.end, channels):
+            if self._stop_event.is_set():
+                break
+            if first is None:
+                first = timestamp
+            if self.speed > 0:
+                delay = started + (timestamp - first) / self.speed - time.monotonic()
+                if delay > 0:
+                    self._stop_event.wait(delay)
+                else:
+                    self.lag = max(self.lag, -delay)
+            self.drone.inject_datagram(channel, data)
+            self.replayed[CHANNEL_NAMES[channel]] += 1
+        return self.replayed
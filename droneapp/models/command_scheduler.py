@@ -0,0 +1,118 @@
+import collections #両端キュー
+import logging #ログ出力用
+import threading #スレッド関連
+
+logger = logging.getLogger(__name__)
+
+# コマンドの優先度（数値が小さいほど先に送信される）
+PRIORITY_SAFETY = 0  # 緊急停止・着陸
+PRIORITY_USER = 1  # ユーザー操作
+PRIORITY_TRACKING = 2  # 顔追跡・パトロールなどの自動制御
+PRIORITIES = (PRIORITY_SAFETY, PRIORITY_USER, PRIORITY_TRACKING)
+PRIORITY_NAMES = {
+    PRIORITY_SAFETY: 'safety',
+    PRIORITY_USER: 'user',
+    PRIORITY_TRACKING: 'tracking',
+}
+
+SAFETY_COMMANDS = ('emergency', 'land')  # 安全のため最優先で送信するコマンド
+
+
+def command_priority(command):
+    """コマンド文字列から既定の優先度を決める"""
+    if command.split(' ')[0] in SAFETY_COMMANDS:
+        return PRIORITY_SAFETY
+    return PRIORITY_USER
+
+
+class CommandScheduler(object):
+    """優先度付きのコマンド送信キュー
+
+    優先度の高いクラスから順に取り出す。追跡クラスは最新の補正だけに意味があるため、
+    送信待ちのコマンドは新しいコマンドで置き換え（latest-wins）、古い方のFutureはキャンセルする。
+    安全クラスのコマンドが積まれたときは、送信待ちの追跡コマンドをすべて破棄する。
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._queues = {priority: collections.deque() for priority in PRIORITIES}
+        self._submitted = dict.fromkeys(PRIORITIES, 0)  # 積まれたコマンド数
+        self._dispatched = dict.fromkeys(PRIORITIES, 0)  # 取り出されたコマンド数
+        self._coalesced = dict.fromkeys(PRIORITIES, 0)  # 新しいコマンドに置き換えられた数
+        self._dropped = dict.fromkeys(PRIORITIES, 0)  # 安全コマンドやキャンセルで破棄された数
+        self._max_depth = 0  # 送信待ちの最大数
+
+    def put(self, command, future, priority):
+        """コマンドを積む"""
+        with self._condition:
+            if priority == PRIORITY_TRACKING:
+                replaced = self._clear(PRIORITY_TRACKING)
+                self._coalesced[PRIORITY_TRACKING] += replaced
+            elif priority == PRIORITY_SAFETY:
+                dropped = self._clear(PRIORITY_TRACKING)
+                self._dropped[PRIORITY_TRACKING] += dropped
+            self._queues[priority].append((command, future))
+            self._submitted[priority] += 1
+            self._max_depth = max(self._max_depth, self._depth())
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """最も優先度の高いコマンドを(コマンド, Future, 優先度)で取り出す。タイムアウト時はNone"""
+        with self._condition:
+            if not self._condition.wait_for(self._depth, timeout):
+                return None
+            for priority in PRIORITIES:
+                if self._queues[priority]:
+                    command, future = self._queues[priority].popleft()
+                    self._dispatched[priority] += 1
+                    return command, future, priority
+
+    def drain(self):
+        """送信待ちのコマンドをすべて取り出す"""
+        with self._condition:
+            items = []
+            for priority in PRIORITIES:
+                items.extend(self._queues[priority])
+                self._queues[priority].clear()
+            return items
+
+    def depth(self):
+        """送信待ちのコマンド数"""
+        with self._condition:
+            return self._depth()
+
+    def _depth(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def _clear(self, priority):
+        """指定した優先度の送信待ちコマンドを破棄し、Futureをキャンセルする"""
+        q = self._queues[priority]
+        count = len(q)
+        for command, future in q:
+            future.cancel()
+            logger.info({'action': 'command_scheduler', 'command': command, 'status': 'dropped'})
+        q.clear()
+        return count
+
+    def note_cancelled(self, priority):
+        """取り出したコマンドが送信前にキャンセルされていたことを記録する"""
+        with self._condition:
+            self._dropped[priority] += 1
+
+    def stats(self):
+        """優先度クラスごとのキューの深さと破棄数を返す"""
+        with self._condition:
+            classes = {}
+            for priority in PRIORITIES:
+                classes[PRIORITY_NAMES[priority]] = {
+                    'depth': len(self._queues[priority]),
+                    'submitted': self._submitted[priority],
+                    'dispatched': self._dispatched[priority],
+                    'coalesced': self._coalesced[priority],
+                    'dropped': self._dropped[priority],
+                }
+            return {
+                'depth': self._depth(),
+                'max_depth': self._max_depth,
+                'classes': classes,
+            }
@@ -2,14 +2,52 @@ import logging #ログ出力用
 import contextlib #コンテキストマネージャ用
 import os #OS関連
 import socket #ソケット通信
-import subprocess #サブプロセス実行用
 import threading #スレッド関連
 import time #時間関連
 
 import cv2 as cv #OpenCVライブラリ
-import numpy as np #数値計算ライブラリ
+from concurrent.futures import Future #コマンド応答の受け渡し用
 
-from droneapp.models.base import Singleton
+from droneapp.models.capture import CHANNEL_COMMAND
+from droneapp.models.capture import CHANNEL_RESPONSE
+from droneapp.models.capture import CHANNEL_STATE
+from droneapp.models.capture import CHANNEL_VIDEO
+from droneapp.models.capture import CaptureWriter
+from droneapp.models.command_scheduler import CommandScheduler
+from droneapp.models.face_detector import DETECT_WORKERS
+from droneapp.models.face_detector import create_face_detector
+from droneapp.models.face_tracker import DETECT_INTERVAL
+from droneapp.models.face_tracker import DetectThenTrack
+from droneapp.models.face_tracker import FACE_TRACKER_FLOW
+from droneapp.models.frame_hub import FrameHub
+from droneapp.models.command_scheduler import PRIORITY_SAFETY
+from droneapp.models.command_scheduler import PRIORITY_TRACKING
+from droneapp.models.command_scheduler import PRIORITY_USER
+from droneapp.models.command_scheduler import SAFETY_COMMANDS
+from droneapp.models.command_scheduler import command_priority
+from droneapp.models.io_loop import RECEIVE_BATCH
+from droneapp.models.io_loop import get_io_loop
+from droneapp.models.preroll import PREROLL_FOLDER
+from droneapp.models.preroll import PREROLL_MAX_BYTES
+from droneapp.models.preroll import PREROLL_REASON_ANOMALY
+from droneapp.models.preroll import PREROLL_REASON_FACE
+from droneapp.models.preroll import PREROLL_REASON_MANUAL
+from droneapp.models.preroll import PREROLL_SECONDS
+from droneapp.models.preroll import PrerollBuffer
+from droneapp.models.rtt import RttEstimator
+from droneapp.models.snapshot_writer import SnapshotWriter
+from droneapp.models.stage_timings import StageTimings
+from droneapp.models.telemetry import STATE_PORT
+from droneapp.models.telemetry import StateReceiver
+from droneapp.models.telemetry_anomaly import TelemetryAnomalyDetector
+from droneapp.models.telemetry_store import TelemetryStore
+from droneapp.models.tracking_controller import RcTrackingController
+from droneapp.models.video_decoder import CMD_FFMPEG_DECODE
+from droneapp.models.video_decoder import VIDEO_DECODER_FFMPEG
+from droneapp.models.video_decoder import create_video_decoder
+from droneapp.models.video_passthrough import VideoPassthrough
+from droneapp.models.video_recorder import VideoRecorder
+from droneapp.models.video_stats import VideoIngestStats
 
 
 logger = logging.getLogger(__name__) #loggerオブジェクトを取得、他のモジュールからも利用できるようにする
@@ -18,8 +56,20 @@ DEFAULT_DISTANCE = 0.30  # m (30cm)
 DEFAULT_SPEED = 10  # cm/s
 DEFAULT_DEGREE = 10  # 回転角度度数
 DEFAULT_TIMEOUT = 5  # フリップ
+MOTION_TIMEOUT = 20  # 離陸・移動など動作完了後に応答が返るコマンドのタイムアウト（秒）
+LAND_TIMEOUT = 8  # 着陸の応答タイムアウト（秒）、再送するため短めにする
+COMMAND_RETRIES = 3  # 冪等なコマンドの最大再送回数
+
+# 動作を伴わず即座に応答が返るコマンド
+INSTANT_COMMANDS = ('command', 'streamon', 'streamoff', 'speed', 'wifi', 'port',
+                    'mon', 'moff', 'mdirection', 'emergency')
+# 2回届いても結果が変わらないため再送してよいコマンド（問い合わせの'?'コマンドも含む）
+IDEMPOTENT_COMMANDS = ('command', 'streamon', 'streamoff', 'speed', 'mon', 'moff',
+                       'emergency', 'land')
 
 # 映像ストリーミング関連の定数
+VIDEO_PORT = 11111  # 映像ストリーミングのポート番号（Telloの既定値）
+# 追跡の計算に使う基準のフレームサイズ（追跡の閾値やゲインはこのサイズのピクセルで調整してある）
 FRAME_X = int(960/3)  # フレームの幅,1/3に縮小,顔認識のため
 FRAME_Y = int(720/3)  # フレームの高さ
 FRAME_AREA = FRAME_X * FRAME_Y  # フレームの面積
@@ -27,12 +77,23 @@ FRAME_SIZE = FRAME_AREA * 3  # フレームのサイズ,3はRGBなど3チャン
 FRAME_CENTER_X = FRAME_X / 2  # フレームの中心X座標
 FRAME_CENTER_Y = FRAME_Y / 2  # フレームの中心Y座標
 
-CMD_FFMPEG = (f'ffmpeg -hwaccel auto -hwaccel_device opencl -i pipe:0'
-            f' -pix_fmt bgr24 -s {FRAME_X}x{FRAME_Y} -f rawvideo pipe:1')  # ffmpegコマンド
+CMD_FFMPEG = CMD_FFMPEG_DECODE.format(width=FRAME_X, height=FRAME_Y)  # ffmpegコマンド
+
+# 映像の解像度（幅, 高さ）、set_resolution()で実行中に変更できる
+VIDEO_STREAM_SIZE = (640, 480)  # 視聴者に配信するフレーム（デコードするサイズ）
+VIDEO_DETECT_SIZE = (FRAME_X, FRAME_Y)  # 顔検出に使うグレースケールのフレーム
+VIDEO_MAX_SIZE = (960, 720)  # Telloの映像の解像度
+VIDEO_MIN_SIZE = (160, 120)
 
 FACE_DETECT_XML_FILE = './droneapp/models/haarcascade_frontalface_default.xml'  # 顔検出用のXMLファイルパス
 
 SNAPSHOT_IMAGE_FOLDER = './droneapp/static/img/snapshots'  # スナップショット画像の保存フォルダ
+SNAPSHOT_BURST_MAX = 30  # 連写できる最大枚数（フレームはコピーして保持するため、960x720で約27MB）
+
+# 顔追跡の方式
+TRACKING_MODE_RC = 'rc'  # 一定周期でrcの速度指令を送り続ける（滑らか）
+TRACKING_MODE_GO = 'go'  # 検出のたびにgoコマンドで移動する
+TRACKING_MODES = (TRACKING_MODE_RC, TRACKING_MODE_GO)
 
 class ErrorNoFaceDetected(Exception): # 顔が検出されなかった場合の独自例外を作成
     """顔が検出されなかった場合の例外"""
@@ -40,10 +101,85 @@ class ErrorNoFaceDetected(Exception): # 顔が検出されなかった場合の
 class ErrorNoImageDir(Exception): # イメージ保存ディレクトリが存在しない場合の独自例外を作成
     """イメージ保存ディレクトリが存在しない場合の例外"""
 
-class DroneManager(object, metaclass=Singleton):
+class ErrorCommandTimeout(Exception): # コマンドの応答がタイムアウトした場合の独自例外を作成
+    """コマンドの応答がタイムアウトした場合の例外"""
+
+class ErrorDroneStopped(Exception): # 応答待ちの間にDroneManagerが停止した場合の独自例外を作成
+    """DroneManagerが停止したためコマンドが完了しなかった場合の例外"""
+
+class ErrorCommandPreempted(Exception): # 応答待ちの間に緊急停止・着陸が送られた場合の独自例外を作成
+    """応答を待たずに緊急停止・着陸を送ったため、コマンドの結果が分からない場合の例外"""
+
+class ErrorInvalidResolution(Exception): # 映像の解像度が範囲外の場合の独自例外を作成
+    """映像の解像度が範囲外の場合の例外"""
+
+def check_video_size(size):
+    """解像度(幅, 高さ)を検証して整数のタプルで返す"""
+    width, height = (int(v) for v in size)
+    if not (VIDEO_MIN_SIZE[0] <= width <= VIDEO_MAX_SIZE[0] and VIDEO_MIN_SIZE[1] <= height <= VIDEO_MAX_SIZE[1]):
+        raise ErrorInvalidResolution(f'{width}x{height}')
+    return width - width % 2, height - height % 2  # ffmpegの出力は偶数のサイズにする
+
+class _InflightCommand(object):
+    """応答待ちのコマンド"""
+
+    __slots__ = ('command', 'future', 'instant', 'retries', 'attempt', 'sent_at', 'timer', 'preempting')
+
+    def __init__(self, command, future):
+        self.command = command
+        self.future = future
+        self.instant = is_instant_command(command)
+        self.retries = COMMAND_RETRIES if is_idempotent_command(command) else 0
+        self.attempt = 0  # 送信回数-1
+        self.sent_at = None  # 最後に送信した時刻
+        self.timer = None  # 応答タイムアウトのタイマー
+        self.preempting = False  # 応答待ちのコマンドを打ち切って送った（その応答が先に届くことがある）
+
+def decode_response(data):
+    """応答バイト列を文字列に変換する（UTF-8で失敗した場合はlatin-1、それも失敗したら16進数）"""
+    try:
+        return data.decode('utf-8').strip()
+    except UnicodeDecodeError:
+        try:
+            return data.decode('latin-1').strip()
+        except Exception:
+            return data.hex()
+
+def is_instant_command(command):
+    """動作を伴わず即座に応答が返るコマンドかどうか"""
+    name = command.split(' ')[0]
+    return name.endswith('?') or name in INSTANT_COMMANDS
+
+def is_idempotent_command(command):
+    """再送してよいコマンドかどうか"""
+    name = command.split(' ')[0]
+    return name.endswith('?') or name in IDEMPOTENT_COMMANDS
+
+def command_timeout(command):
+    """コマンドの応答タイムアウト（秒）を返す"""
+    if is_instant_command(command):
+        return DEFAULT_TIMEOUT
+    if command.split(' ')[0] == 'land':
+        return LAND_TIMEOUT
+    return MOTION_TIMEOUT
+
+class DroneManager(object):
+    """1台のTelloを操作するクラス
+
+    複数台を扱う場合は、droneapp.models.fleet.Fleetでドローンごとにポートを分けて作成する。
+    コマンド・状態・映像のソケットはすべてIOLoop（既定ではプロセス共通）の1スレッドで処理する。
+    """
+
     def __init__(self, host_ip='0.0.0.0', host_port=8889,
                 drone_ip='192.168.10.1', drone_port=8889,
-                is_imperial=False, speed=DEFAULT_SPEED):
+                is_imperial=False, speed=DEFAULT_SPEED,
+                state_port=STATE_PORT, video_port=VIDEO_PORT,
+                io_loop=None, video_log_sample=0, video_decoder=VIDEO_DECODER_FFMPEG,
+                detect_workers=DETECT_WORKERS, detect_interval=DETECT_INTERVAL,
+                face_tracker=FACE_TRACKER_FLOW,
+                stream_size=VIDEO_STREAM_SIZE, detect_size=VIDEO_DETECT_SIZE,
+                preroll_folder=PREROLL_FOLDER, preroll_seconds=PREROLL_SECONDS,
+                preroll_max_bytes=PREROLL_MAX_BYTES):
         self.host_ip = host_ip #ホストのIPアドレス ,selfはクラスのインスタンス自身を指す
         self.host_port = host_port #ホストのポート番号
         self.drone_ip = drone_ip #ドローンのIPアドレス
@@ -53,17 +189,35 @@ class DroneManager(object, metaclass=Singleton):
         self.is_imperial = is_imperial #距離単位がフィートかどうかのフラグ
         self.speed = speed  # cm/s
 
+        self.io_loop = io_loop or get_io_loop()  # ソケットの読み書きとタイマーを処理するループ
+
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # ポートの再利用を許可
-        self.socket.settimeout(5.0)  # 5秒のタイムアウトを設定
+        self.socket.setblocking(False)  # 読み込み可能になったときだけIOLoopから読む
         self.socket.bind((self.host_ip, self.host_port)) #ホストのIPアドレスとポート番号にバインド
 
-        self.response =None #ドローンからの応答メッセージを格納する変数
-        self.stop_event = threading.Event() #スレッドの停止イベントを管理するオブジェクト
-        self._response_thread = threading.Thread(target=self.receive_response, args=(self.stop_event, )) #ドローンからの応答メッセージを受信するスレッドを作成
-        self._response_thread.daemon = True  # デーモンスレッドに設定（メインプロセス終了時に自動終了）
-        # receive_responseメソッドをセットしている
-        self._response_thread.start() #スレッド（並列）を開始
+        self.response =None #ドローンからの最新の応答メッセージを格納する変数
+        self.stop_event = threading.Event() #停止イベントを管理するオブジェクト
+
+        # コマンド送信関連の初期化
+        # Telloは応答にコマンドIDを含まないため、応答待ちのコマンドを常に1つに制限して対応付ける
+        # 送信・応答・タイムアウトはすべてIOLoopのスレッドで処理する
+        self._scheduler = CommandScheduler()  # 優先度付きの送信待ちキュー
+        self._inflight = None  # 応答待ちのコマンド、なければNone
+        self._quiet_until = 0  # 再送後に重複応答を読み捨てるため、次のコマンドを送らない期限
+        self._preempted = False  # 応答待ちのコマンドを打ち切った直後（次に送るコマンドに印を付ける）
+        self._rtt = RttEstimator()  # 応答時間の推定、タイムアウトと再送間隔に使う
+        self.io_loop.add_reader(self.socket, self.receive_response)
+        self._capture = None  # 受信データの記録先（CaptureWriter）、記録しない間はNone
+        self._recorder = None  # 映像の録画先（VideoRecorder）、録画しない間はNone
+
+        # 状態パケット（ポート8890）の受信を開始、バッテリー残量などは問い合わせずにここから読む
+        self.state_port = state_port
+        self._state_receiver = StateReceiver(self.host_ip, self.state_port)
+        self.telemetry = TelemetryStore()  # 直近の状態の時系列
+        self._state_receiver.add_listener(self.telemetry.append)
+        self._state_receiver.add_datagram_listener(self._capture_state)
+        self._state_receiver.open(self.io_loop)
 
         #パトロールモード関連の初期化
         self.patrol_event = None #パトロールイベントを管理するオブジェクト,onoffの切り替えのためNoneで初期化
@@ -73,22 +227,34 @@ class DroneManager(object, metaclass=Singleton):
 
         #顔追跡モード関連の初期化
         self.is_face_tracking = True  # 顔追跡モードのフラグ、初期値はTrue
-        self._tracking_command_interval = 0.3  # 追跡コマンドの送信間隔（秒）- より短い間隔で素早い反応
+        self._tracking_command_interval = 0.3  # 追跡コマンドの送信間隔（秒）- goモードのみ
         self._last_tracking_time = 0  # 最後に追跡コマンドを送信した時刻
+        self.tracking_mode = TRACKING_MODE_RC  # 顔追跡の方式
+        self._rc_controller = RcTrackingController(
+            self.send_rc, FRAME_X, FRAME_Y,
+            is_active=lambda: self.is_face_tracking and self.tracking_mode == TRACKING_MODE_RC and self.is_airborne())
 
         #映像ストリーミング関連の初期化
-        self.proc = subprocess.Popen(CMD_FFMPEG.split(' '), stdin=subprocess.PIPE, stdout=subprocess.PIPE) #ffmpegのサブプロセスを起動
-        self.proc_stdin = self.proc.stdin #ffmpegの標準入力パイプ
-        self.proc_stdout = self.proc.stdout #ffmpegの標準出力パイプ
-
-        self.video_port = 11111  # 映像ストリーミングのポート番号
-
-        self._receive_video_thread = threading.Thread(
-            target=self._receive_video,
-            args=(self.stop_event, self.proc_stdin,
-                self.host_ip,self.video_port)) #映像受信スレッドを作成
-        
-        self._receive_video_thread.start() #映像受信スレッドを開始
+        self.video_port = video_port  # 映像ストリーミングのポート番号
+        self._video_buffer = bytearray(2048)  # 映像データの受信バッファ
+        self._video_stats = VideoIngestStats(log_sample=video_log_sample)  # 受信状況、video_log_sample個ごとにデバッグログを出す
+        # H.264のデコーダー（'ffmpeg': サブプロセスにパイプで渡す、'pyav': プロセス内でデコード）
+        self._stream_size = check_video_size(stream_size)  # 配信するフレームの解像度
+        self._detect_size = check_video_size(detect_size)  # 顔検出に使うフレームの解像度
+        self._video_decoder = create_video_decoder(video_decoder, self.io_loop, *self._stream_size, self._video_stats)
+        self._frame_hub = FrameHub()  # デコード・顔検出・エンコードを1回だけ行い、結果を全視聴者で共有する
+        self._passthrough = VideoPassthrough()  # デコードせずにfMP4に詰め替えて配信する（オーバーレイなし）
+        # 直近の映像をGOP単位で保持し、API・顔検出・状態の異常をきっかけにその前の映像を保存する
+        self._preroll = PrerollBuffer(preroll_folder, preroll_seconds, preroll_max_bytes,
+                                      label=self.drone_ip)
+        self._face_seen = False  # 直前のフレームに顔が映っていたか（顔が映り始めたら保存する）
+        self._anomaly_detector = TelemetryAnomalyDetector(self._on_telemetry_anomaly)
+        self._state_receiver.add_listener(self._anomaly_detector)
+        self.sock_video = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock_video.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # ポートの再利用を許可
+        self.sock_video.setblocking(False)
+        self.sock_video.bind((self.host_ip, self.video_port))
+        self.io_loop.add_reader(self.sock_video, self._receive_video)
 
         # 顔検出用のカスケード分類器の初期化
         try:
@@ -109,42 +275,63 @@ class DroneManager(object, metaclass=Singleton):
             self.face_cascade = None
             
         self._is_enable_face_detect = False  # 顔検出モードのフラグを初期化
+        self._detect_workers = detect_workers  # 顔検出のワーカープロセス数、0ならストリーミングのスレッドで検出
+        self._face_detector = None  # 顔検出を最初に有効にしたときに作成する
+        self._detect_interval = detect_interval  # 顔検出のフレーム間隔、間のフレームはface_trackerで追跡する
+        self._face_tracker_kind = face_tracker
+        self._face_tracking = None  # DetectThenTrack
+        self._stage_timings = StageTimings()  # 映像処理の段階ごとの処理時間
+        self._frame_latency = StageTimings()  # フレームの最初のデータグラムを受信してから各段階を終えるまでの時間
+        self._latency_overlay = False  # フレームに受信時刻と遅延を描き込む（ガラス・トゥ・ガラスの遅延測定用）
 
         # スナップショット保存フォルダの確認と作成
         if not os.path.exists(SNAPSHOT_IMAGE_FOLDER):
             raise ErrorNoImageDir(f"スナップショット保存フォルダが存在しません: {SNAPSHOT_IMAGE_FOLDER}") 
-        self.is_snapshot = False  # スナップショット撮影フラグを初期化  
+        self._snapshot_writer = SnapshotWriter(SNAPSHOT_IMAGE_FOLDER, label=self.drone_ip)  # ファイルへの書き込みは専用のスレッドで行う
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_requests = []  # 次のフレームで撮影するスナップショットのFuture
+        self._bursts = []  # 連写中の[残り枚数, フレームのリスト, Future]
 
-        # コマンド送信関連の初期化,semaphoreを使って同時送信を防ぐ
-        self._command_semaphore = threading.Semaphore(1)  # コマンド送信のセマフォを初期化
-        self._command_thread = None  # コマンド送信スレッドを管理する変数、Noneで初期化
-
-        # 初期化コマンドを送信（間隔を空ける）
-        time.sleep(1)  # スレッドの開始を待つ
+        # 初期化コマンドを送信（コマンドは順番に1つずつ送信されるため待機は不要）
         self.send_command('command') #ドローンにSDKモード開始コマンドを送信
-        time.sleep(2)  # commandの応答を待つ
+        if (self.state_port, self.video_port) != (STATE_PORT, VIDEO_PORT):
+            # 既定以外のポートで受信する場合は送信先ポートを変更してもらう（Tello EDU, SDK 2.0）
+            self.send_command(f'port {self.state_port} {self.video_port}')
         self.send_command('streamon') #ドローンに映像ストリーミング開始コマンドを送信
         self.set_speed(self.speed)  # ドローンの速度を設定
 
-    def receive_response(self, stop_event): #ドローンからの応答メッセージを受信するメソッド
-        while not stop_event.is_set(): #停止イベントがセットされていない間ループ
+    def receive_response(self, sock): #ドローンからの応答メッセージを受信するメソッド,IOLoopから呼ばれる
+        for _ in range(RECEIVE_BATCH):
             try:
-                self.response, ip = self.socket.recvfrom(3000) #ドローンからの応答メッセージを受信、最大3000バイト,3000はテロのサンプルコード
-                try:
-                    decoded_response = self.response.decode('utf-8')
-                    logger.info({'action': 'receive_response', 'response': decoded_response, 'from': ip}) #ログに受信した応答メッセージを出力
-                except UnicodeDecodeError:
-                    # UTF-8でデコードできない場合は他のエンコーディングを試す
-                    try:
-                        decoded_response = self.response.decode('latin-1')
-                        logger.info({'action': 'receive_response', 'response': decoded_response, 'from': ip, 'encoding': 'latin-1'})
-                    except:
-                        logger.info({'action': 'receive_response', 'raw_bytes': self.response.hex(), 'from': ip})
-            except socket.timeout:
-                continue  # タイムアウトの場合は続行
+                self.response, ip = sock.recvfrom(3000) #ドローンからの応答メッセージを受信、最大3000バイト,3000はテロのサンプルコード
+            except BlockingIOError:
+                return  # 受信済みのデータをすべて読んだ
             except socket.error as e:
                 logger.error({'action': 'receive_response', 'ex': e}) #ログにエラーメッセージを出力
-                break #ループを抜ける
+                return
+            capture = self._capture
+            if capture is not None:
+                capture.write(CHANNEL_RESPONSE, self.response)
+            self._handle_response(self.response, ip)
+
+    def _handle_response(self, data, ip):
+        """受信した応答を、応答待ちのコマンドのFutureに渡す"""
+        decoded_response = decode_response(data)
+        inflight, self._inflight = self._inflight, None
+        if inflight is None:
+            # タイムアウト後に届いた応答など、対応するコマンドがないものは破棄する
+            logger.warning({'action': 'receive_response', 'response': decoded_response, 'from': ip,
+                            'status': 'unsolicited'})
+            return
+        inflight.timer.cancel()
+        if inflight.instant and inflight.attempt == 0 and not inflight.preempting:  # 再送したコマンドの応答はRTTの測定に使わない
+            self._rtt.update(time.monotonic() - inflight.sent_at)
+        logger.info({'action': 'receive_response', 'command': inflight.command, 'response': decoded_response, 'from': ip})
+        inflight.future.set_result(decoded_response)
+        if inflight.attempt > 0 or inflight.preempting:
+            # 再送した分の重複応答や打ち切ったコマンドの応答が次のコマンドの応答と取り違えられないよう、少し待って読み捨てる
+            self._quiet_until = time.monotonic() + self._rtt.rto()
+        self._dispatch_command()
 
     def __del__(self): #デストラクタ、オブジェクトが破棄されるときに呼ばれる
         try:
@@ -153,99 +340,300 @@ class DroneManager(object, metaclass=Singleton):
             pass  # デストラクタでは例外を無視
 
     def stop(self): #ドローンの停止
-        if hasattr(self, 'stop_event'):
-            self.stop_event.set() #停止イベントをセット
-        
-        # スレッドの終了を待機
-        if hasattr(self, '_response_thread'):
-            self._response_thread.join(timeout=2)  # 最大2秒待機
-            
-        if hasattr(self, 'socket'):
-            self.socket.close() #ソケットを閉じる
-        os.kill(self.proc.pid, 9)  # ffmpegプロセスを強制終了
-
-    # 外部からのコマンドを受けて、内部の並列処理に送信するメソッド
-    def send_command(self, command, blocking=True):
-        self._command_thread = threading.Thread(
-            target=self._send_command, 
-            args=(command,blocking))
-        self._command_thread.start()
-
-    # コマンドの内部送信メソッド
-    def _send_command(self, command, blocking=True): #ドローンにコマンドを送信,blocking=Trueなら応答を待つ
-        is_acquired = self._command_semaphore.acquire(blocking=blocking)  # セマフォを取得、最大10秒待機
-        if is_acquired:
-            with contextlib.ExitStack() as stack:
-                stack.callback(self._command_semaphore.release)
-                logger.info({'action': 'send_command', 'command': command}) #ログにコマンド送信の情報を出力
-                self.socket.sendto(command.encode('utf-8'), self.drone_address) #コマンドをドローンに送信
-        else:  
-            logger.warning({'action': 'send_command', 'command': command, 'status': 'not_acquired'}) #セマフォの取得に失敗した場合の警告ログ      
-
-        # 応答を待つ（非同期、バックグラウンドスレッドが処理）
-        time.sleep(1.5)  # 応答待機時間を延長
-        if self.response:
-            try:
-                decoded = self.response.decode('utf-8').strip()
-                logger.info({'action': 'command_response', 'response': decoded})
-            except UnicodeDecodeError:
-                try:
-                    decoded = self.response.decode('latin-1').strip()
-                    logger.info({'action': 'command_response', 'response': decoded, 'encoding': 'latin-1'})
-                except:
-                    logger.info({'action': 'command_response', 'raw_bytes': self.response.hex()})
-        return self.response
-    
+        if not hasattr(self, 'stop_event') or self.stop_event.is_set():
+            return
+        self.stop_event.set() #停止イベントをセット
+        self._rc_controller.stop()
+        self.stop_capture()
+        self.stop_recording()
+        self._preroll.close()
+        self._cancel_snapshots()
+        self._snapshot_writer.close()
+        self._frame_hub.close()
+        self._passthrough.close()
+        if self._face_detector is not None:
+            self._face_detector.close()
+
+        # ソケットの登録解除と応答待ちコマンドの後始末はIOLoopのスレッドで行い、完了を待つ
+        closed = threading.Event()
+        self.io_loop.call_soon(self._close, closed)
+        closed.wait(timeout=2)  # 最大2秒待機
+
+    def _close(self, closed):
+        for sock in (self.socket, self.sock_video):
+            self.io_loop.remove_reader(sock)
+            sock.close() #ソケットを閉じる
+        self._video_decoder.close()
+        self._state_receiver.close()
+
+        # 停止時に残っているコマンドを失敗させる
+        inflight, self._inflight = self._inflight, None
+        if inflight is not None:
+            inflight.timer.cancel()
+            inflight.future.set_exception(ErrorDroneStopped(inflight.command))
+        for command, future in self._scheduler.drain():
+            if future.set_running_or_notify_cancel():
+                future.set_exception(ErrorDroneStopped(command))
+        closed.set()
+
+    # 外部からのコマンドを受けて送信キューに積むメソッド,応答を受け取るFutureを返す
+    def send_command(self, command, blocking=True, priority=None):
+        """コマンドを優先度付きの送信キューに積み、応答文字列が設定されるFutureを返す
+
+        priorityを省略した場合、emergency・landは安全クラス、それ以外はユーザークラスになる。
+        blocking=Falseは追跡クラスとして扱い、送信待ちの古い追跡コマンドを置き換える
+        （置き換えられたコマンドのFutureはキャンセルされる）。
+        """
+        if priority is None:
+            priority = command_priority(command) if blocking else PRIORITY_TRACKING
+        future = Future()
+        if self.stop_event.is_set():
+            future.set_exception(ErrorDroneStopped(command))
+            return future
+        self._scheduler.put(command, future, priority)
+        if priority == PRIORITY_SAFETY:
+            self.io_loop.call_soon(self._preempt_inflight)  # 動作コマンドの完了を待たずに送る
+        self.io_loop.call_soon(self._dispatch_command)
+        return future
+
+    def _preempt_inflight(self):
+        """応答待ちのコマンドを打ち切り、送信待ちの緊急停止・着陸をすぐに送れるようにする,IOLoopのスレッドで実行される
+
+        打ち切ったコマンドのFutureはErrorCommandPreemptedで失敗させる。その応答は緊急停止・着陸の応答より
+        先に届くことがあるが、どちらの応答かは区別できないため、最初の応答を緊急停止・着陸の応答とし、
+        その後RTOの間に届いた応答は読み捨てる。
+        """
+        inflight = self._inflight
+        if inflight is None or inflight.command.split(' ')[0] == 'emergency':
+            return  # emergencyより優先するコマンドはない
+        inflight.timer.cancel()
+        self._inflight = None
+        self._quiet_until = 0
+        self._preempted = True
+        logger.warning({'action': 'send_command', 'command': inflight.command, 'status': 'preempted'})
+        inflight.future.set_exception(ErrorCommandPreempted(inflight.command))
+
+    # 送信キューから優先度順にコマンドを取り出して送信するメソッド,IOLoopのスレッドで実行される
+    def _dispatch_command(self):
+        if self._inflight is not None or self.stop_event.is_set():
+            return  # 応答待ちのコマンドがある間は次のコマンドを送らない
+        wait = self._quiet_until - time.monotonic()
+        if wait > 0:
+            self.io_loop.call_later(wait, self._dispatch_command)
+            return
+        while True:
+            item = self._scheduler.get(timeout=0)
+            if item is None:
+                return
+            command, future, priority = item
+            if future.set_running_or_notify_cancel():
+                break
+            self._scheduler.note_cancelled(priority)  # 送信前にキャンセルされた
+        self._inflight = _InflightCommand(command, future)
+        self._inflight.preempting, self._preempted = self._preempted, False
+        self._send_command(self._inflight)
+
+    def send_rc(self, a, b, c, d):
+        """rcコマンド（速度指令）を送信する。応答がないため送信キューを通さず直接送る"""
+        if self.stop_event.is_set():
+            return
+        inflight = self._inflight
+        if inflight is not None and inflight.command.split(' ')[0] in SAFETY_COMMANDS:
+            return  # 着陸・緊急停止の実行中は速度指令を送らない
+        if inflight is not None and not inflight.instant:
+            return  # up・forward・cwなどの実行中に速度指令を送ると、動作が途中で止まる
+        try:
+            self.socket.sendto(f'rc {a} {b} {c} {d}'.encode('utf-8'), self.drone_address)
+        except socket.error as ex:
+            logger.error({'action': 'send_rc', 'ex': ex})
+
+    def command_stats(self):
+        """送信キューの深さ・破棄数などの統計を返す"""
+        stats = self._scheduler.stats()
+        inflight = self._inflight
+        stats['in_flight'] = inflight.command if inflight else None
+        return stats
+
+    # コマンドの内部送信メソッド,応答が届くかタイムアウトするまで次のコマンドを送らない
+    def _send_command(self, inflight):
+        command = inflight.command
+        logger.info({'action': 'send_command', 'command': command, 'attempt': inflight.attempt}) #ログにコマンド送信の情報を出力
+        inflight.sent_at = time.monotonic()
+        capture = self._capture
+        if capture is not None:
+            capture.write(CHANNEL_COMMAND, command.encode('utf-8'))
+        try:
+            self.socket.sendto(command.encode('utf-8'), self.drone_address) #コマンドをドローンに送信
+        except socket.error as ex:
+            logger.error({'action': 'send_command', 'command': command, 'ex': ex})
+
+        # 即応コマンドはRTOで、動作コマンドは動作時間にRTOを加えた時間で待つ
+        if inflight.instant:
+            timeout = self._rtt.timeout(inflight.attempt)
+        else:
+            timeout = command_timeout(command) + self._rtt.rto()
+        inflight.timer = self.io_loop.call_later(timeout, self._on_command_timeout, inflight)
+
+    def _on_command_timeout(self, inflight):
+        """応答がタイムアウトしたとき、冪等なコマンドなら再送し、それ以外は失敗させる"""
+        if self._inflight is not inflight:
+            return  # 既に応答済み
+        if inflight.attempt < inflight.retries:
+            inflight.attempt += 1
+            self._rtt.note_retransmission()
+            logger.warning({'action': 'send_command', 'command': inflight.command, 'status': 'retransmit'})
+            self._send_command(inflight)
+            return
+
+        self._inflight = None
+        self._rtt.note_timeout()
+        logger.warning({'action': 'send_command', 'command': inflight.command, 'status': 'timeout'})
+        inflight.future.set_exception(ErrorCommandTimeout(inflight.command))
+        # 遅れて届いた応答が次のコマンドの応答と取り違えられないよう、少し待って読み捨てる
+        self._quiet_until = time.monotonic() + self._rtt.rto()
+        self._dispatch_command()
+
+    def start_capture(self, path):
+        """コマンド・応答・状態・映像のデータグラムをpathに記録し始める"""
+        self.stop_capture()
+        self._capture = CaptureWriter(path)
+        logger.info({'action': 'start_capture', 'path': path})
+
+    def stop_capture(self):
+        """記録を終了し、記録した件数を返す。記録していなければNone"""
+        capture, self._capture = self._capture, None
+        if capture is None:
+            return None
+        capture.close()
+        return capture.stats()
+
+    def capture_stats(self):
+        capture = self._capture
+        return capture.stats() if capture is not None else None
+
+    def start_recording(self, prefix):
+        """受信したH.264をデコードせずにprefix-0000.h264から順に区間ファイルに録画し始める"""
+        self.stop_recording()
+        self._recorder = VideoRecorder(prefix)
+        logger.info({'action': 'start_recording', 'prefix': prefix})
+
+    def stop_recording(self):
+        """録画を終了し、録画した区間数などを返す。録画していなければNone"""
+        recorder, self._recorder = self._recorder, None
+        if recorder is None:
+            return None
+        recorder.close()
+        return recorder.stats()
+
+    def recording_stats(self):
+        recorder = self._recorder
+        return recorder.stats() if recorder is not None else None
+
+    def save_preroll(self, reason=PREROLL_REASON_MANUAL, force=True):
+        """保持している直近の映像をファイルに書き出す。結果のFuture（自動保存で間隔が短すぎればNone）を返す"""
+        return self._preroll.trigger(reason, force)
+
+    def preroll_stats(self):
+        stats = self._preroll.stats()
+        stats['anomalies'] = self._anomaly_detector.anomalies
+        return stats
+
+    def _on_telemetry_anomaly(self, kind, value):
+        # IOLoopのスレッドから呼ばれるため、書き出しの完了は待たない
+        self.save_preroll(PREROLL_REASON_ANOMALY, force=False)
+
+    def _capture_state(self, data):
+        capture = self._capture
+        if capture is not None:
+            capture.write(CHANNEL_STATE, data)
+
+    def inject_datagram(self, channel, data):
+        """記録したデータグラムを受信したものとして処理する（CaptureReplayer用）"""
+        if channel == CHANNEL_RESPONSE:
+            self.io_loop.call_soon(self._handle_response, data, self.drone_address)
+        elif channel == CHANNEL_STATE:
+            self.io_loop.call_soon(self._state_receiver.handle_datagram, data)
+        elif channel == CHANNEL_VIDEO:
+            self.io_loop.call_soon(self._replay_video, data)
+
+    def _replay_video(self, data):
+        self._video_stats.on_packet(len(data))
+        self._write_video(data)
+
+    def rtt_stats(self):
+        """コマンド応答のRTT・RTO・再送回数を返す"""
+        return self._rtt.stats()
+
     def takeoff(self):#ドローンの離陸
-        # 事前にバッテリーをチェック
-        self.send_command('battery?')
-        time.sleep(1)
-        if self.response:
-            try:
-                battery_level = int(self.response.decode('utf-8').strip())
-                if battery_level < 20:
-                    logger.warning(f"警告: バッテリー残量が少ないです ({battery_level}%)")
-                    if battery_level < 10:
-                        logger.error(f"エラー: バッテリー残量が危険レベルです ({battery_level}%)")
-                        return False
-                logger.info(f"バッテリー残量: {battery_level}%")
-            except (UnicodeDecodeError, ValueError):
-                logger.warning("バッテリー残量の確認に失敗しました")
+        # 事前にバッテリーをチェック（状態パケットから読む）
+        try:
+            battery_level = self.get_battery()
+            if battery_level < 20:
+                logger.warning(f"警告: バッテリー残量が少ないです ({battery_level}%)")
+                if battery_level < 10:
+                    logger.error(f"エラー: バッテリー残量が危険レベルです ({battery_level}%)")
+                    return False
+            logger.info(f"バッテリー残量: {battery_level}%")
+        except (ErrorCommandTimeout, ErrorDroneStopped, ValueError):
+            logger.warning("バッテリー残量の確認に失敗しました")
         
         # 離陸コマンドを送信
         self.send_command('takeoff')
         return True
 
+    def get_state(self):
+        """最新の状態（姿勢・速度・高さ・バッテリーなど）をTelloStateで返す。未受信の場合はNone"""
+        return self._state_receiver.latest()
+
+    def is_airborne(self):
+        """状態パケットの高さ（h）から飛行中かどうかを返す。状態パケットが届いていなければFalse"""
+        height = self._state_receiver.get('h')
+        return height is not None and height > 0
+
+    def get_telemetry(self, fields, seconds, points):
+        """直近seconds秒の状態の時系列をpoints点に間引いて返す"""
+        return self.telemetry.query(fields, start=time.time() - seconds, points=points)
+
+    def get_battery(self):
+        """バッテリー残量（%）を返す。状態パケットが届いていない場合は'battery?'で問い合わせる"""
+        battery_level = self._state_receiver.get('bat')
+        if battery_level is None:
+            battery_level = self.send_command('battery?').result()
+        return int(battery_level)
+
     def land(self): #ドローンの着陸
-        self.send_command('land') #着陸コマンドを送信
+        return self.send_command('land') #着陸コマンドを送信（最優先）
+
+    def emergency(self): #モーターを緊急停止
+        return self.send_command('emergency')
 
     # ドローンの移動
-    def move(self, direction, distance):
+    def move(self, direction, distance, priority=PRIORITY_USER):
         distance = float(distance)
         if self.is_imperial:
             distance = int(round(distance * 30.48))  # フィートをcmに変換
         else:
             distance = int(round(distance * 100))  # メートルをcmに変換,小数点は四捨五入
-        return self.send_command(f'{direction} {distance}') #上昇の時はdirectionに'up、distanceに 20'のように指定
+        return self.send_command(f'{direction} {distance}', priority=priority) #上昇の時はdirectionに'up、distanceに 20'のように指定
         #f文字列リテラル、変数に文字列を埋め込むことができる
 
-    def up(self, distance=DEFAULT_DISTANCE):
-        return self.move('up', distance) #ドローンを上昇させる
+    def up(self, distance=DEFAULT_DISTANCE, priority=PRIORITY_USER):
+        return self.move('up', distance, priority) #ドローンを上昇させる
 
-    def down(self, distance=DEFAULT_DISTANCE):
-        return self.move('down', distance) #ドローンを下降させる
+    def down(self, distance=DEFAULT_DISTANCE, priority=PRIORITY_USER):
+        return self.move('down', distance, priority) #ドローンを下降させる
 
-    def left(self, distance=DEFAULT_DISTANCE):
-        return self.move('left', distance) #ドローンを左に移動させる
+    def left(self, distance=DEFAULT_DISTANCE, priority=PRIORITY_USER):
+        return self.move('left', distance, priority) #ドローンを左に移動させる
 
-    def right(self, distance=DEFAULT_DISTANCE):
-        return self.move('right', distance) #ドローンを右に移動させる
+    def right(self, distance=DEFAULT_DISTANCE, priority=PRIORITY_USER):
+        return self.move('right', distance, priority) #ドローンを右に移動させる
 
-    def forward(self, distance=DEFAULT_DISTANCE):
-        return self.move('forward', distance) #ドローンを前進させる
+    def forward(self, distance=DEFAULT_DISTANCE, priority=PRIORITY_USER):
+        return self.move('forward', distance, priority) #ドローンを前進させる
 
-    def back(self, distance=DEFAULT_DISTANCE):
-        return self.move('back', distance) #ドローンを後退させる
+    def back(self, distance=DEFAULT_DISTANCE, priority=PRIORITY_USER):
+        return self.move('back', distance, priority) #ドローンを後退させる
     
     def enable_face_tracking(self):
         """顔追跡モードを有効にする"""
@@ -265,15 +653,24 @@ class DroneManager(object, metaclass=Singleton):
         status = "enabled" if self.is_face_tracking else "disabled"
         logger.info({'action': 'face_tracking', 'status': status, 'toggled': True})
         return f"Face tracking {status}"
+
+    def set_tracking_mode(self, mode):
+        """顔追跡の方式（'rc'または'go'）を設定する"""
+        if mode not in TRACKING_MODES:
+            logger.error(f"追跡の方式は {TRACKING_MODES} のいずれかで指定してください")
+            return False
+        self.tracking_mode = mode
+        logger.info({'action': 'face_tracking', 'mode': mode})
+        return True
     
     def set_speed(self, speed):
         return self.send_command(f'speed {speed}') #ドローンの速度を設定
 
-    def clockwise(self, degree=DEFAULT_DEGREE): #ドローンを時計回りに回転させる
-        return self.send_command(f'cw {degree}')
+    def clockwise(self, degree=DEFAULT_DEGREE, priority=PRIORITY_USER): #ドローンを時計回りに回転させる
+        return self.send_command(f'cw {degree}', priority=priority)
     
-    def counter_clockwise(self, degree=DEFAULT_DEGREE): #ドローンを反時計回りに回転させる
-        return self.send_command(f'ccw {degree}')
+    def counter_clockwise(self, degree=DEFAULT_DEGREE, priority=PRIORITY_USER): #ドローンを反時計回りに回転させる
+        return self.send_command(f'ccw {degree}', priority=priority)
 
     def flip(self, direction): #ドローンをフリップさせる
         if direction not in ['l', 'r', 'f', 'b']:
@@ -326,61 +723,79 @@ class DroneManager(object, metaclass=Singleton):
                     while not stop_event.is_set():
                         status += 1
                         if status == 1:
-                            self.up()
+                            self.up(priority=PRIORITY_TRACKING)
                         if status == 2:
-                            self.clockwise()
+                            self.clockwise(priority=PRIORITY_TRACKING)
                         if status == 3:
-                            self.down()
+                            self.down(priority=PRIORITY_TRACKING)
                         if status == 4:
                             status = 0
                         time.sleep(5)  # 各動作の完了を待つ
             else:
                 logger.warning({'action': 'patrol', 'status': 'not acquired'})
 
-    # 映像受信スレッドの実行メソッド
-    def _receive_video(self, stop_event, pip_in, host_ip, video_port):
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock_video:
-            sock_video.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # ポートの再利用を許可
-            sock_video.settimeout(0.5)  # タイムアウト0.5秒
-            sock_video.bind((host_ip, video_port))
-            data = bytearray(2048)  # 2048バイトのバッファを用意
-            while not stop_event.is_set():
-                try:
-                    size, addr = sock_video.recvfrom_into(data)  # 映像データを受信
-                    logger.info({'action': '_receive_video', 'data': data})
-                except socket.timeout as ex:
-                    logger.warning({'action': '_receive_video', 'ex': ex})
-                    time.sleep(0.5)
-                    continue
-                except socket.error as ex:
-                    logger.error({'action': '_receive_video', 'ex': ex})
-                    break
+    # 映像データを受信してffmpegに渡すメソッド,IOLoopから呼ばれる
+    def _receive_video(self, sock_video):
+        data = self._video_buffer
+        for _ in range(RECEIVE_BATCH):
+            try:
+                size, addr = sock_video.recvfrom_into(data)  # 映像データを受信
+            except BlockingIOError:
+                return  # 受信済みのデータをすべて読んだ
+            except socket.error as ex:
+                logger.error({'action': '_receive_video', 'ex': ex})
+                return
+            received = time.time()  # フレームの遅延の起点（ffmpegやブラウザの時刻と比べられるように壁時計）
+            chunk = data[:size]
+            self._video_stats.on_packet(size)
+            capture = self._capture
+            if capture is not None:
+                capture.write(CHANNEL_VIDEO, chunk)
+            recorder = self._recorder
+            if recorder is not None:
+                recorder.write(chunk)
+            self._write_video(chunk, received)
 
-                try:
-                    pip_in.write(data[:size])  # ffmpegの標準入力に書き込む
-                    pip_in.flush()  # バッファをフラッシュ
-                except Exception as ex:
-                    logger.error({'action': '_receive_video', 'ex': ex})
-                    break
+    def video_stats(self):
+        """映像データの受信レート・途切れ・ffmpegへの書き込みの詰まりを返す"""
+        stats = self._video_stats.stats()
+        stats['decoder'] = self._video_decoder.name
+        stats['resolution'] = self.get_resolution()
+        stats['pending_bytes'] = self._video_decoder.pending_bytes()
+        stats['hub'] = self._frame_hub.stats()
+        stats['passthrough'] = self._passthrough.stats()
+        stats['pool'] = self._video_decoder.pool.stats()
+        if self._face_detector is not None:
+            stats['detection'] = self._face_detector.stats()
+            stats['detection']['interval'] = self._detect_interval
+        stats['stages'] = self._stage_timings.stats()
+        stats['latency'] = self.latency_stats()
+        stats['snapshot'] = self.snapshot_stats()
+        return stats
+
+    def _write_video(self, chunk, received=None):
+        """映像データをfMP4の配信とデコーダーに渡す。デコーダーが終了していれば映像の受信をやめる"""
+        self._passthrough.write(chunk)
+        self._preroll.write(chunk, received)
+        if not self._video_decoder.write(chunk, received):
+            self.io_loop.remove_reader(self.sock_video)
 
     # 映像をバイナリ形式で取得する
+    # デコードされたフレーム（配信する解像度のBGR）を返すジェネレータ
+    # フレームはデコーダーのバッファを使い回すため、次のフレームを要求した時点で返却される
+    # それ以降も使う場合はコピーすること
     def video_binary_generator(self):
         while True:
-                try:
-                    frame = self.proc_stdout.read(FRAME_SIZE)  # フレームサイズ分読み込む
-                except Exception as ex:
-                    logger.error({'action': 'video_binary_generator', 'ex': ex})
-                    continue
-                if not frame:
-                    logger.warning(f'video_binary_generator: No frame data received')
-                    continue
-                
-                if len(frame) != FRAME_SIZE:
-                    logger.warning(f'video_binary_generator: Expected {FRAME_SIZE} bytes, got {len(frame)} bytes')
-                    continue
-
-                frame = np.frombuffer(frame, np.uint8).reshape(FRAME_Y, FRAME_X, 3)  # バイト列をNumPy配列に変換
+            frame = self._video_decoder.read_frame()
+            if frame is None:
+                if self.stop_event.is_set():
+                    return
+                continue
+            self.record_frame_latency('decode', self._video_decoder.arrival(frame))
+            try:
                 yield frame
+            finally:
+                self._video_decoder.release(frame)
 
     # 顔検出モードを有効にする/無効にするメソッド
     def enable_face_detect(self):
@@ -389,46 +804,118 @@ class DroneManager(object, metaclass=Singleton):
             logger.error("顔検出カスケードが利用できません。顔検出を有効にできません。")
             return False
         
+        if self._face_detector is None:
+            self._face_detector = create_face_detector(
+                self.face_cascade, FACE_DETECT_XML_FILE, self._detect_size, self._detect_workers)
+            self._face_tracking = DetectThenTrack(self._face_detector, self._detect_interval,
+                                                  self._face_tracker_kind, self._stage_timings)
         self._is_enable_face_detect = True
+        self.start_video_pipeline()  # MJPEGの視聴者がいなくても（fMP4で表示していても）検出・追跡する
+        self._rc_controller.start()  # 速度指令の送信ループを開始（追跡が有効な間だけ送信する）
         logger.info("顔検出モードを有効にしました")
         return True
 
     def disable_face_detect(self):
         """顔検出モードを無効にする"""
         self._is_enable_face_detect = False
+        self._rc_controller.stop()
         logger.info("顔検出モードを無効にしました")
 
+    def get_resolution(self):
+        return {'stream': list(self._stream_size), 'detect': list(self._detect_size)}
+
+    def set_resolution(self, stream_size=None, detect_size=None):
+        """配信・顔検出の解像度を変更する。DroneManagerを作り直す必要はない"""
+        if stream_size is not None:
+            stream_size = check_video_size(stream_size)
+        if detect_size is not None:
+            detect_size = check_video_size(detect_size)
+        if stream_size is not None and stream_size != self._stream_size:
+            self._stream_size = stream_size
+            self._video_decoder.set_size(*stream_size)
+        if detect_size is not None and detect_size != self._detect_size:
+            self._detect_size = detect_size
+            if self._face_detector is not None:
+                # 共有メモリのサイズが変わるため、検出器を作り直して差し替える
+                old_detector = self._face_detector
+                self._face_detector = create_face_detector(
+                    self.face_cascade, FACE_DETECT_XML_FILE, detect_size, self._detect_workers)
+                self._face_tracking.detector = self._face_detector
+                old_detector.close()
+        logger.info({'action': 'set_resolution', 'stream': self._stream_size, 'detect': self._detect_size})
+        return self.get_resolution()
+
+    def set_detect_interval(self, interval):
+        """顔検出のフレーム間隔を変更する（1なら毎フレーム検出）"""
+        self._detect_interval = max(1, int(interval))
+        if self._face_tracking is not None:
+            self._face_tracking.set_interval(self._detect_interval)
+        logger.info({'action': 'set_detect_interval', 'interval': self._detect_interval})
+        return self._detect_interval
+
+    def record_frame_latency(self, stage, received):
+        """受信時刻receivedのフレームが段階stageを終えたことを記録する（receivedがNoneなら何もしない）"""
+        if received is not None:
+            self._frame_latency.record(stage, time.time() - received)
+
+    def set_latency_overlay(self, enabled):
+        """フレームの左上に受信時刻（エポックミリ秒）と受信からの経過時間を描き込むかどうか
+
+        tello_simulatorは左下に生成時刻を描き込むので、両者と表示した時刻を比べればガラス・トゥ・ガラスの遅延が分かる。
+        """
+        self._latency_overlay = bool(enabled)
+        logger.info({'action': 'set_latency_overlay', 'enabled': self._latency_overlay})
+        return self._latency_overlay
+
+    def latency_stats(self):
+        """フレームの最初のデータグラムを受信してから、各段階を終えるまでの時間（ヒストグラム付き）"""
+        return {'overlay': self._latency_overlay, 'stages': self._frame_latency.stats()}
+
     # 映像をJPEG形式のバイナリで取得するジェネレータ,顔検出も行う,追跡機能付き
     def video_jpeg_generator(self):
+        for _, jpeg_binary, _ in self._video_pipeline():
+            yield jpeg_binary
+
+    # 顔検出・追跡・JPEGエンコードを行い、(描画済みのフレーム, JPEG, 受信時刻)を返すジェネレータ
+    def _video_pipeline(self):
         try:
             for frame in self.video_binary_generator():
-                # フレームのコピーを作成して安全な処理を行う
-                processed_frame = frame.copy()
+                received = self._video_decoder.arrival(frame)
+                if self._bursts:
+                    self._collect_burst(frame)  # 枠などを描画する前のフレームを連写に使う
+
+                # フレームはこのループの間だけ使うバッファなので、コピーせずにそのまま描画する
+                processed_frame = frame
                 
-                if self._is_enable_face_detect and self.face_cascade is not None and not self.face_cascade.empty():
+                if self._is_enable_face_detect and self._face_tracking is not None:
                     try:
                         if self.is_patrol:
                             self.stop_patrol()
 
-                        # 顔検出処理
-                        gray = cv.cvtColor(processed_frame, cv.COLOR_BGR2GRAY)
-                        faces = self.face_cascade.detectMultiScale(
-                            gray, 
-                            scaleFactor=1.1, 
-                            minNeighbors=4, 
-                            minSize=(30, 30),
-                            flags=cv.CASCADE_SCALE_IMAGE
-                        )
+                        # 顔検出（detect_intervalごと）と、その間の追跡で顔の位置を得る
+                        # 追跡の指令は新しい検出・追跡結果でのみ更新する
+                        started = time.perf_counter()
+                        faces, face_timestamp, is_new_detection = self._face_tracking.process(
+                            processed_frame, time.monotonic())
+                        self._stage_timings.record('face', time.perf_counter() - started)
+                        self.record_frame_latency('detect', received)
+                        if faces and not self._face_seen:
+                            self.save_preroll(PREROLL_REASON_FACE, force=False)  # 顔が映る前の映像を残す
+                        self._face_seen = bool(faces)
                         
+                        # 追跡の計算は基準のフレームサイズ（FRAME_X x FRAME_Y）の座標で行う
+                        frame_height, frame_width = processed_frame.shape[:2]
+                        scale_x, scale_y = FRAME_X / frame_width, FRAME_Y / frame_height
+
                         # 検出された顔に矩形を描画
                         for (x, y, w, h) in faces:
                             cv.rectangle(processed_frame, (x, y), (x + w, y + h), (0, 255, 0), 2)  # 緑色の矩形で顔を囲む
                             # 顔の中心座標を計算（整数変換）
-                            face_center_x = int(x + w/2)
-                            face_center_y = int(y + h/2)
+                            face_center_x = int((x + w/2) * scale_x)
+                            face_center_y = int((y + h/2) * scale_y)
                             diff_x = FRAME_CENTER_X - face_center_x  # 顔の中心とフレームの中心の差分（X軸）
                             diff_y = FRAME_CENTER_Y - face_center_y  # 顔の中心とフレームの中心の差分（Y軸）
-                            face_area = w * h # 顔の面積
+                            face_area = w * scale_x * h * scale_y # 顔の面積
                             percent_face = face_area / FRAME_AREA # 顔の面積の割合
                             drone_x, drone_y, drone_z, speed = 0, 0, 0, self.speed # ドローンの移動量と速度を初期化
 
@@ -459,16 +946,21 @@ class DroneManager(object, metaclass=Singleton):
                             elif percent_face < 0.1:  # 顔がフレームの10%未満を占めている場合
                                 drone_x = 15   # ドローンを前進（X軸プラス）- 移動量削減
 
-                            # ドローンの移動コマンドを送信（追跡モードが有効で、移動量がある場合のみ）
+                            # rcモードでは検出結果を渡すだけで、送信は速度指令のループが行う
+                            if is_new_detection and self.tracking_mode == TRACKING_MODE_RC:
+                                self._rc_controller.update_detection(face_center_x, face_center_y, percent_face,
+                                                                     face_timestamp)
+
+                            # ドローンの移動コマンドを送信（goモードで追跡が有効、移動量がある場合のみ）
                             current_time = time.time()
-                            if (self.is_face_tracking and 
+                            if (is_new_detection and self.is_face_tracking and self.tracking_mode == TRACKING_MODE_GO and
                                 (drone_x != 0 or drone_y != 0 or drone_z != 0) and
                                 (current_time - self._last_tracking_time) > self._tracking_command_interval):
                                 
                                 # より高速で反応の良い移動のため速度を調整
                                 smooth_speed = min(speed, 50)  # 最大速度を50cm/sに上げて反応を改善
                                 self.send_command(f'go {drone_x} {drone_y} {drone_z} {smooth_speed}',
-                                                    blocking=False) # 非同期でコマンド送信
+                                                    priority=PRIORITY_TRACKING) # 追跡クラスで送信（最新の補正のみ保持）
                                 self._last_tracking_time = current_time
                                 
                                 # デバッグ情報をログ出力
@@ -481,7 +973,7 @@ class DroneManager(object, metaclass=Singleton):
                             # cv.circle(processed_frame, (face_center_x, face_center_y), 5, (0, 0, 255), -1)  # 赤い点
                             
                             # フレーム中心の十字線を描画（デバッグ用）
-                            center_x, center_y = int(FRAME_CENTER_X), int(FRAME_CENTER_Y)
+                            center_x, center_y = frame_width // 2, frame_height // 2
                             cv.line(processed_frame, (center_x-10, center_y), (center_x+10, center_y), (255, 255, 0), 1)  # 水平線
                             cv.line(processed_frame, (center_x, center_y-10), (center_x, center_y+10), (255, 255, 0), 1)  # 垂直線
                             
@@ -491,21 +983,26 @@ class DroneManager(object, metaclass=Singleton):
                         logger.error(f'Face detection error: {face_detect_error}')
                         # 顔検出エラーが発生してもストリーミングは継続
 
+                if self._latency_overlay and received is not None:
+                    cv.putText(processed_frame, f'{received * 1000:.0f} +{(time.time() - received) * 1000:.0f}ms',
+                               (20, 40), cv.FONT_HERSHEY_SIMPLEX, 1.0, (0, 255, 255), 2)
+
                 # フレームをJPEGにエンコード
+                started = time.perf_counter()
                 _, jpeg = cv.imencode('.jpg', processed_frame)  # フレームをJPEGにエンコード
                 jpeg_binary = jpeg.tobytes()  # バイト列に変換
+                self._stage_timings.record('encode', time.perf_counter() - started)
+                self.record_frame_latency('encode', received)
 
-                # スナップショットの保存
-                if self.is_snapshot:
-                    backup_file = time.strftime("%Y%m%d-%H%M%S") + '.jpg' # タイムスタンプ付きのファイル名
-                    snapshot_file = 'snapshot.jpg'
-                    for filename in (backup_file, snapshot_file):
-                        filepath = os.path.join(SNAPSHOT_IMAGE_FOLDER, filename)
-                        with open(filepath, 'wb') as f:
-                            f.write(jpeg_binary)  # JPEGバイナリを書き込む
-                        logger.info(f'Snapshot saved: {filepath}')
-                    self.is_snapshot = False  # フラグをリセット
-                yield jpeg_binary
+                # スナップショットの保存（書き込みはSnapshotWriterのスレッドで行い、ここでは待たない）
+                if self._snapshot_requests:
+                    with self._snapshot_lock:
+                        requests, self._snapshot_requests = self._snapshot_requests, []
+                    # 取り消されたもの（待ちきれずにタイムアウトしたもの）は撮影しない
+                    requests = [future for future in requests if future.set_running_or_notify_cancel()]
+                    size = (processed_frame.shape[1], processed_frame.shape[0])
+                    self._chain_snapshot(lambda: self._snapshot_writer.save_jpeg(jpeg_binary, size), requests)
+                yield processed_frame, jpeg_binary, received
                 
         except Exception as e:
             logger.error(f'Video JPEG generator error: {e}')
@@ -513,23 +1010,122 @@ class DroneManager(object, metaclass=Singleton):
         
     # スナップショット撮影をリクエストするメソッド
     def snapshot(self):
-        """スナップショット撮影をリクエストする"""
-        self.is_snapshot = True
-        retry = 0
-        while retry < 3:
-            if not self.is_snapshot:
-                return True
-            time.sleep(0.1)
-            retry += 1
-        return False
+        """次のフレーム（枠などを描画したJPEG）を保存する。書き込んだファイルのパスのリストを返すFutureを返す
+
+        映像の処理が動いていなければ開始する（映像を受信していない間は完了しない）。
+        """
+        future = Future()
+        with self._snapshot_lock:
+            self._snapshot_requests.append(future)
+        self.start_video_pipeline()
+        return future
+
+    def snapshot_burst(self, count):
+        """次のcount枚の連続したフレームを、配信する解像度（既定では640x480）のまま枠などを描画せずに保存する
+
+        書き込んだファイルのパスのリストを返すFutureを返す。
+        Telloの映像の解像度（960x720）で保存するには、先にset_resolution()でstreamを変更する。
+        """
+        count = max(1, min(int(count), SNAPSHOT_BURST_MAX))
+        future = Future()
+        with self._snapshot_lock:
+            self._bursts.append([count, [], future])
+        self.start_video_pipeline()
+        return future
+
+    def _collect_burst(self, frame):
+        # デコーダーのバッファは再利用されるため、連写中の全員で1つのコピーを共有する
+        copied = frame.copy()
+        with self._snapshot_lock:
+            finished = []
+            for burst in self._bursts:
+                if not burst[1] and not burst[2].set_running_or_notify_cancel():
+                    finished.append(burst)  # 撮影を始める前に取り消された
+                    continue
+                burst[1].append(copied)
+                burst[0] -= 1
+                if burst[0] == 0:
+                    finished.append(burst)
+            for burst in finished:
+                self._bursts.remove(burst)
+        for _, frames, future in finished:
+            if future.cancelled():
+                continue
+            self._chain_snapshot(lambda: self._snapshot_writer.save_frames(frames), [future])
+
+    @staticmethod
+    def _chain_snapshot(submit, futures):
+        """SnapshotWriterに書き込みを依頼し、その結果をfuturesに渡す"""
+        if not futures:
+            return
+        try:
+            written = submit()
+        except Exception as ex:
+            for future in futures:
+                future.set_exception(ex)
+            return
+
+        def done(source):
+            for future in futures:
+                if source.exception() is not None:
+                    future.set_exception(source.exception())
+                else:
+                    future.set_result(source.result())
+        written.add_done_callback(done)
+
+    def _cancel_snapshots(self):
+        with self._snapshot_lock:
+            futures = [future for future in self._snapshot_requests] + [burst[2] for burst in self._bursts]
+            self._snapshot_requests, self._bursts = [], []
+        for future in futures:
+            if future.running() or future.set_running_or_notify_cancel():
+                future.set_exception(ErrorDroneStopped('snapshot'))
+
+    def add_snapshot_listener(self, listener):
+        """スナップショットのファイルを書き込むたびに呼ぶ関数を登録する（SnapshotGallery.addなど）"""
+        self._snapshot_writer.add_listener(listener)
+
+    def snapshot_stats(self):
+        stats = self._snapshot_writer.stats()
+        with self._snapshot_lock:
+            stats['requests'] = len(self._snapshot_requests)
+            stats['bursts'] = len(self._bursts)
+        return stats
 
     
     # 映像フレームジェネレータ（server.pyで使用される）
     def video_frame_generator(self):
-        """映像フレームのジェネレータ - server.pyからアクセスされる"""
+        """映像フレームのジェネレータ - server.pyからアクセスされる
+
+        視聴者が何人いても処理は1つのスレッドで行い、各視聴者は最新のJPEGを受け取る（遅い視聴者はフレームを飛ばす）。
+        """
+        for jpeg_binary, _ in self.timed_video_frame_generator():
+            yield jpeg_binary
+
+    def start_video_pipeline(self):
+        """デコード・顔検出・エンコードのスレッドを開始する（開始済みなら何もしない）
+
+        /video/streamingの視聴者がいなくても、顔検出・追跡・スナップショットのために動かす必要がある。
+        """
+        self._frame_hub.start(self._video_pipeline())
+
+    def timed_video_frame_generator(self):
+        """video_frame_generatorと同じだが、(JPEG, フレームの最初のデータグラムの受信時刻)を返す
+
+        受信時刻はrecord_frame_latency()に渡して、送り出すまでの遅延を記録するのに使う（分からなければNone）。
+        """
+        self.start_video_pipeline()
         try:
-            for jpeg_binary in self.video_jpeg_generator():
-                yield jpeg_binary
+            for jpeg_binary, received in self._frame_hub.subscribe(self.stop_event):
+                yield jpeg_binary, received
         except Exception as ex:
             logger.error({'action': 'video_frame_generator', 'ex': ex})
             return
+
+    # fMP4のジェネレータ（server.pyのパススルー配信で使用される）
+    def video_fmp4_generator(self):
+        """受信したH.264をデコードせずに詰め替えたfMP4のセグメントを返すジェネレータ
+
+        最初に初期化セグメント、その後はフレームごとのフラグメントを返す。顔の枠などのオーバーレイは含まない。
+        """
+        return self._passthrough.subscribe(self.stop_event)
@@ -0,0 +1,230 @@
+import logging #ログ出力用
+import multiprocessing #ワーカープロセス
+import threading #スレッド関連
+import time #時間関連
+from multiprocessing import shared_memory #フレームの受け渡し用の共有メモリ
+
+import cv2 as cv #OpenCVライブラリ
+import numpy as np #数値計算ライブラリ
+
+logger = logging.getLogger(__name__)
+
+DETECT_WORKERS = 2  # 顔検出のワーカープロセス数（0ならストリーミングのスレッドで検出する）
+DETECT_TIME_SMOOTHING = 0.1  # 検出時間の移動平均の係数
+
+# detectMultiScaleのパラメータ
+DETECT_SCALE_FACTOR = 1.1
+DETECT_MIN_NEIGHBORS = 4
+DETECT_MIN_SIZE = (30, 30)
+
+
+def detect_faces(cascade, gray):
+    """グレースケールの画像から顔を検出し、(x, y, w, h)のリストを返す"""
+    faces = cascade.detectMultiScale(
+        gray,
+        scaleFactor=DETECT_SCALE_FACTOR,
+        minNeighbors=DETECT_MIN_NEIGHBORS,
+        minSize=DETECT_MIN_SIZE,
+        flags=cv.CASCADE_SCALE_IMAGE
+    )
+    return [tuple(int(v) for v in face) for face in faces]
+
+
+def scale_boxes(boxes, scale):
+    """検出用のフレームの矩形を、元のフレームの座標に拡大する"""
+    scale_x, scale_y = scale
+    if scale_x == 1 and scale_y == 1:
+        return boxes
+    return [(int(x * scale_x), int(y * scale_y), int(w * scale_x), int(h * scale_y)) for x, y, w, h in boxes]
+
+
+class FaceDetection(object):
+    """顔検出の結果"""
+
+    __slots__ = ('sequence', 'timestamp', 'boxes', 'elapsed')
+
+    def __init__(self, sequence, timestamp, boxes, elapsed):
+        self.sequence = sequence  # 検出を依頼した順番
+        self.timestamp = timestamp  # 検出したフレームの時刻（time.monotonic()）
+        self.boxes = boxes  # 顔の矩形(x, y, w, h)のリスト（検出を依頼したフレームの座標）
+        self.elapsed = elapsed  # 検出にかかった時間（秒）
+
+
+def _detect_worker(cascade_file, shm_name, shape, tasks, results):
+    """ワーカープロセスの本体。共有メモリのスロットのフレームから顔を検出して結果を返す"""
+    cascade = cv.CascadeClassifier(cascade_file)  # 分類器はプロセスごとに持つ
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frames = np.ndarray(shape, np.uint8, buffer=shm.buf)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            slot, sequence, timestamp, scale = task
+            started = time.perf_counter()
+            boxes = detect_faces(cascade, frames[slot])
+            results.put((slot, sequence, timestamp, scale_boxes(boxes, scale), time.perf_counter() - started))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        del frames
+        shm.close()
+
+
+class _DetectorBase(object):
+    """最新の検出結果と統計を保持する共通部分
+
+    検出はdetect_size（幅, 高さ）に縮小したグレースケールのフレームで行い、結果の矩形は元のフレームの座標に戻す。
+    """
+
+    def __init__(self, detect_size):
+        self.detect_size = detect_size
+        self._small = None  # 縮小したフレームの作業領域
+        self._lock = threading.Lock()
+        self._latest = None
+        self._sequence = 0
+        self.submitted = 0  # 検出を依頼したフレーム数
+        self.skipped = 0  # ワーカーが空いていないため検出しなかったフレーム数
+        self.completed = 0  # 検出が完了したフレーム数
+        self.detect_time = 0.0  # 検出時間の移動平均（秒）
+
+    def _prepare(self, frame, gray):
+        """frame（BGR）を検出用のサイズのグレースケールにしてgrayに書き込み、(gray, 拡大率)を返す"""
+        height, width = frame.shape[:2]
+        detect_width, detect_height = self.detect_size
+        if (width, height) != (detect_width, detect_height):
+            self._small = cv.resize(frame, (detect_width, detect_height), dst=self._small,
+                                    interpolation=cv.INTER_AREA)
+            frame = self._small
+        gray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY, dst=gray)
+        return gray, (width / detect_width, height / detect_height)
+
+    def _set_result(self, result):
+        with self._lock:
+            self.completed += 1
+            self.detect_time += (result.elapsed - self.detect_time) * DETECT_TIME_SMOOTHING
+            if self._latest is None or result.sequence > self._latest.sequence:
+                self._latest = result
+
+    def latest(self):
+        """最新の検出結果（FaceDetection）。まだなければNone"""
+        return self._latest
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'size': list(self.detect_size),
+                'submitted': self.submitted,
+                'skipped': self.skipped,
+                'completed': self.completed,
+                'detect_ms': round(self.detect_time * 1000, 2),
+            }
+
+
+class InlineFaceDetector(_DetectorBase):
+    """呼び出したスレッドでそのまま顔を検出する（ワーカープロセスを使わない場合）"""
+
+    workers = 0
+
+    def __init__(self, cascade, detect_size):
+        super().__init__(detect_size)
+        self._cascade = cascade
+        self._gray = None
+
+    def submit(self, frame, timestamp):
+        self._gray, scale = self._prepare(frame, self._gray)
+        self._sequence += 1
+        self.submitted += 1
+        started = time.perf_counter()
+        boxes = scale_boxes(detect_faces(self._cascade, self._gray), scale)
+        self._set_result(FaceDetection(self._sequence, timestamp, boxes, time.perf_counter() - started))
+        return True
+
+    def close(self):
+        pass
+
+
+class FaceDetectionPool(_DetectorBase):
+    """ワーカープロセスで顔を検出する
+
+    フレームは検出用のサイズのグレースケールにして共有メモリのスロット（ワーカー数分）に書き込み、番号だけをキューで渡す。
+    空いているスロットがなければそのフレームは検出しない（ストリーミングを待たせない）。
+    結果は受信スレッドが受け取り、latest()で最新の結果を返す。
+    ワーカーはspawnで起動するため、起動元のスクリプトは if __name__ == '__main__': で保護すること。
+    """
+
+    def __init__(self, cascade_file, detect_size, workers=DETECT_WORKERS):
+        super().__init__(detect_size)
+        self.workers = workers
+        width, height = detect_size
+        shape = (workers, height, width)
+        self._shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+        self._frames = np.ndarray(shape, np.uint8, buffer=self._shm.buf)
+        self._free_slots = list(range(workers))
+        self._closed = False
+        context = multiprocessing.get_context('spawn')  # 親のスレッドやソケットを引き継がない
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._processes = [
+            context.Process(target=_detect_worker, name=f'face-detect-{i}', daemon=True,
+                            args=(cascade_file, self._shm.name, shape, self._tasks, self._results))
+            for i in range(workers)]
+        for process in self._processes:
+            process.start()
+        self._receiver = threading.Thread(target=self._receive_results, name='face-detect-results')
+        self._receiver.daemon = True
+        self._receiver.start()
+        logger.info({'action': 'face_detection_pool', 'workers': workers, 'status': 'started'})
+
+    def submit(self, frame, timestamp):
+        """フレーム（BGR）の検出を依頼する。ワーカーが空いていなければFalse"""
+        with self._lock:  # close()と同時に共有メモリに書き込まないよう、書き込みまでロックする
+            if self._closed or not self._free_slots:
+                self.skipped += 1
+                return False
+            slot = self._free_slots.pop()
+            self._sequence += 1
+            self.submitted += 1
+            sequence = self._sequence
+            _, scale = self._prepare(frame, self._frames[slot])  # 共有メモリに直接書き込む
+        self._tasks.put((slot, sequence, timestamp, scale))
+        return True
+
+    def _receive_results(self):
+        while True:
+            try:
+                result = self._results.get()
+            except (EOFError, OSError):
+                return
+            if result is None:
+                return
+            slot, sequence, timestamp, boxes, elapsed = result
+            with self._lock:
+                self._free_slots.append(slot)
+            self._set_result(FaceDetection(sequence, timestamp, boxes, elapsed))
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        self._results.put(None)
+        self._receiver.join(timeout=1)
+        del self._frames
+        self._shm.close()
+        self._shm.unlink()
+        logger.info({'action': 'face_detection_pool', 'status': 'stopped'})
+
+
+def create_face_detector(cascade, cascade_file, detect_size, workers=DETECT_WORKERS):
+    """workersが0ならInlineFaceDetector、それ以外はFaceDetectionPoolを作成する"""
+    if workers <= 0:
+        return InlineFaceDetector(cascade, detect_size)
+    return FaceDetectionPool(cascade_file, detect_size, workers)
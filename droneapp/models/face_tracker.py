@@ -0,0 +1,185 @@
+import logging #ログ出力用
+import time #時間関連
+
+import cv2 as cv #OpenCVライブラリ
+import numpy as np #数値計算ライブラリ
+
+from droneapp.models.tracking_controller import DETECTION_STALE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# 検出の合間に使う追跡器
+FACE_TRACKER_FLOW = 'flow'  # 顔の領域の特徴点をオプティカルフローで追う（追加のパッケージ不要）
+FACE_TRACKER_KCF = 'kcf'  # OpenCVのKCF（opencv-contrib-pythonが必要）
+FACE_TRACKER_CSRT = 'csrt'  # OpenCVのCSRT（opencv-contrib-pythonが必要、KCFより正確で重い）
+FACE_TRACKERS = (FACE_TRACKER_FLOW, FACE_TRACKER_KCF, FACE_TRACKER_CSRT)
+
+DETECT_INTERVAL = 1  # 顔検出を行うフレーム間隔（1なら毎フレーム検出し、追跡器は使わない）
+TRACK_MIN_CONFIDENCE = 0.5  # これより追跡の信頼度が下がったら次のフレームで検出し直す
+FLOW_MAX_POINTS = 40  # オプティカルフローで追う特徴点の最大数
+FLOW_MIN_POINTS = 6  # 追えた特徴点がこれより少なければ見失ったとみなす
+FLOW_MAX_ERROR = 1.0  # 往復で追跡した特徴点のずれの許容値（ピクセル）
+
+
+class OpticalFlowTracker(object):
+    """顔の矩形内の特徴点をLucas-Kanade法で追い、矩形の移動と拡大率を推定する"""
+
+    def __init__(self):
+        self._gray = None  # 現在のフレームのグレースケール
+        self._prev = None  # 前のフレームのグレースケール
+        self._points = None
+        self._box = None
+
+    def _to_gray(self, frame):
+        # 2つのバッファを交互に使い、フレームごとに確保しない
+        self._gray, self._prev = self._prev, self._gray
+        self._gray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY, dst=self._gray)
+        return self._gray
+
+    def init(self, frame, box):
+        gray = self._to_gray(frame)
+        x, y, w, h = box
+        points = cv.goodFeaturesToTrack(gray[y:y + h, x:x + w], FLOW_MAX_POINTS, 0.01, 3)
+        if points is None or len(points) < FLOW_MIN_POINTS:
+            self._points = None
+            return False
+        self._points = points + np.float32([x, y])
+        self._box = box
+        return True
+
+    def update(self, frame):
+        """(矩形, 信頼度)を返す。見失った場合は矩形がNone"""
+        if self._points is None:
+            return None, 0.0
+        gray = self._to_gray(frame)
+        points, status, _ = cv.calcOpticalFlowPyrLK(self._prev, gray, self._points, None,
+                                                    winSize=(15, 15), maxLevel=2)
+        back, back_status, _ = cv.calcOpticalFlowPyrLK(gray, self._prev, points, None,
+                                                       winSize=(15, 15), maxLevel=2)
+        error = np.linalg.norm((self._points - back).reshape(-1, 2), axis=1)
+        good = (status.ravel() == 1) & (back_status.ravel() == 1) & (error < FLOW_MAX_ERROR)
+        confidence = float(good.mean())
+        if good.sum() < FLOW_MIN_POINTS:
+            self._points = None
+            return None, confidence
+
+        old = self._points[good].reshape(-1, 2)
+        new = points[good].reshape(-1, 2)
+        dx, dy = np.median(new - old, axis=0)
+        old_spread = np.median(np.linalg.norm(old - old.mean(axis=0), axis=1))
+        new_spread = np.median(np.linalg.norm(new - new.mean(axis=0), axis=1))
+        scale = new_spread / old_spread if old_spread > 0 else 1.0
+
+        x, y, w, h = self._box
+        center_x = x + w / 2 + dx
+        center_y = y + h / 2 + dy
+        w, h = w * scale, h * scale
+        frame_h, frame_w = gray.shape[:2]
+        x = int(min(max(center_x - w / 2, 0), frame_w - 1))
+        y = int(min(max(center_y - h / 2, 0), frame_h - 1))
+        self._box = (x, y, int(min(w, frame_w - x)), int(min(h, frame_h - y)))
+        self._points = new.reshape(-1, 1, 2)
+        return self._box, confidence
+
+
+class OpenCvTracker(object):
+    """OpenCVの追跡器（KCF・CSRT）"""
+
+    def __init__(self, kind):
+        self._create = _opencv_tracker_factory(kind)
+        self._tracker = None
+
+    def init(self, frame, box):
+        self._tracker = self._create()
+        self._tracker.init(frame, tuple(box))
+        return True
+
+    def update(self, frame):
+        if self._tracker is None:
+            return None, 0.0
+        ok, box = self._tracker.update(frame)
+        if not ok:
+            self._tracker = None
+            return None, 0.0
+        return tuple(int(v) for v in box), 1.0
+
+
+def _opencv_tracker_factory(kind):
+    name = 'TrackerKCF_create' if kind == FACE_TRACKER_KCF else 'TrackerCSRT_create'
+    for module in (cv, getattr(cv, 'legacy', None)):
+        if module is not None and hasattr(module, name):
+            return getattr(module, name)
+    return None
+
+
+def create_tracker(kind):
+    """追跡器を作成する。OpenCVの追跡器が使えない場合はオプティカルフローにする"""
+    if kind in (FACE_TRACKER_KCF, FACE_TRACKER_CSRT):
+        if _opencv_tracker_factory(kind) is not None:
+            return OpenCvTracker(kind)
+        logger.warning({'action': 'create_tracker', 'tracker': kind,
+                        'status': 'unavailable (opencv-contrib-python is required), using flow'})
+    return OpticalFlowTracker()
+
+
+class DetectThenTrack(object):
+    """顔検出をinterval フレームごと（または追跡の信頼度が下がったとき）に行い、その間は追跡器で顔を追う
+
+    検出はFaceDetectionPoolなどで非同期に行われるため、新しい検出結果が届いた時点のフレームで追跡器を初期化し直す。
+    intervalが1なら毎フレーム検出を依頼し、最新の検出結果をそのまま使う。
+    """
+
+    def __init__(self, detector, interval=DETECT_INTERVAL, tracker=FACE_TRACKER_FLOW, timings=None):
+        self.detector = detector
+        self.interval = interval
+        self.tracker_kind = tracker
+        self._tracker = None
+        self._tracking = False  # 追跡中の顔があるか
+        self._lost = False  # 追跡中の顔を見失ったか（次のフレームで検出し直す）
+        self._frames_since_detect = interval  # 最初のフレームで検出する
+        self._last_detection = 0  # 最後に使った検出結果の番号
+        self._timings = timings  # StageTimings、段階ごとの処理時間を記録する
+
+    def set_interval(self, interval):
+        self.interval = max(1, int(interval))
+
+    def _time(self, stage, started):
+        if self._timings is not None:
+            self._timings.record(stage, time.perf_counter() - started)
+
+    def process(self, frame, now):
+        """フレームを処理し、(顔の矩形のリスト, 矩形の時刻, 新しい結果かどうか)を返す"""
+        self._frames_since_detect += 1
+        if self.interval <= 1 or self._lost or self._frames_since_detect >= self.interval:
+            started = time.perf_counter()
+            if self.detector.submit(frame, now):
+                self._frames_since_detect = 0
+                self._lost = False
+            self._time('detect_submit', started)
+
+        detection = self.detector.latest()
+        if detection is not None and detection.sequence != self._last_detection:
+            # 新しい検出結果で追跡をやり直す
+            self._last_detection = detection.sequence
+            self._tracking = False
+            if detection.boxes and self.interval > 1:
+                started = time.perf_counter()
+                if self._tracker is None:
+                    self._tracker = create_tracker(self.tracker_kind)
+                self._tracking = self._tracker.init(frame, detection.boxes[0])
+                self._time('track_init', started)
+            return detection.boxes, detection.timestamp, True
+
+        if self._tracking:
+            started = time.perf_counter()
+            box, confidence = self._tracker.update(frame)
+            self._time('track', started)
+            if box is None or confidence < TRACK_MIN_CONFIDENCE:
+                self._tracking = False
+                self._lost = True  # 次のフレームで検出し直す
+                return [], now, False
+            return [box], now, True
+
+        if self.interval <= 1 and detection is not None and now - detection.timestamp < DETECTION_STALE_SECONDS:
+            return detection.boxes, detection.timestamp, False  # 検出中は直前の結果を表示する
+        return [], now, False
@@ -0,0 +1,95 @@
+import logging #ログ出力用
+import threading #スレッド関連
+
+from droneapp.models.drone_manager import DroneManager
+from droneapp.models.drone_manager import VIDEO_PORT
+from droneapp.models.telemetry import STATE_PORT
+
+logger = logging.getLogger(__name__)
+
+COMMAND_PORT = 8889  # コマンドの受信ポート（Telloの既定値）
+PORT_STRIDE = 100  # 2台目以降のドローンのポートをずらす間隔
+
+
+class ErrorUnknownDrone(Exception): # 登録されていないドローンが指定された場合の独自例外を作成
+    """登録されていないドローンIDが指定された場合の例外"""
+
+
+class ErrorDroneExists(Exception): # 同じドローンを二重に登録しようとした場合の独自例外を作成
+    """同じドローンIDが既に登録されている場合の例外"""
+
+
+class Fleet(object):
+    """複数台のドローンのDroneManagerを、ドローンのアドレスをIDとして管理する
+
+    ポートを指定しない場合、host_ipを指定しない（インターフェースを共有する）n台目（0始まり）のドローンには
+    コマンド・状態・映像の各ポートに n * PORT_STRIDE を加えたポートを割り当てる。
+    host_ipを指定したドローンは自分のインターフェースで受信するので、既定のポートのままにする
+    （Telloの送信先ポートを変える port コマンドも送らない）。
+    """
+
+    def __init__(self, host_ip='0.0.0.0', port_stride=PORT_STRIDE):
+        self.host_ip = host_ip
+        self.port_stride = port_stride
+        self._drones = {}  # ドローンID -> DroneManager（登録順）
+        self._slots = 0  # インターフェースを共有するドローンに割り当て済みのポートの組の数
+        self._lock = threading.Lock()
+
+    def add(self, drone_ip, drone_port=8889, host_ip=None, host_port=None,
+            state_port=None, video_port=None, **kwargs):
+        """ドローンを登録してDroneManagerを作成する。ドローンIDはdrone_ip"""
+        drone_id = drone_ip
+        with self._lock:
+            if drone_id in self._drones:
+                raise ErrorDroneExists(drone_id)
+            if host_ip is None:
+                offset = self._slots * self.port_stride
+                self._slots += 1
+            else:
+                offset = 0  # 専用のインターフェースなのでポートが重ならない
+            drone = DroneManager(
+                host_ip=host_ip or self.host_ip,
+                host_port=host_port or COMMAND_PORT + offset,
+                drone_ip=drone_ip, drone_port=drone_port,
+                state_port=state_port or STATE_PORT + offset,
+                video_port=video_port or VIDEO_PORT + offset,
+                **kwargs)
+            self._drones[drone_id] = drone
+        logger.info({'action': 'fleet_add', 'drone_id': drone_id, 'host_port': drone.host_port,
+                     'state_port': drone.state_port, 'video_port': drone.video_port})
+        return drone
+
+    def get(self, drone_id=None):
+        """ドローンIDのDroneManagerを返す。省略時は最初に登録したドローン"""
+        with self._lock:
+            if drone_id is None:
+                if not self._drones:
+                    raise ErrorUnknownDrone(drone_id)
+                return next(iter(self._drones.values()))
+            try:
+                return self._drones[drone_id]
+            except KeyError:
+                raise ErrorUnknownDrone(drone_id) from None
+
+    def remove(self, drone_id):
+        """ドローンの登録を解除して停止する"""
+        with self._lock:
+            drone = self._drones.pop(drone_id, None)
+        if drone is None:
+            raise ErrorUnknownDrone(drone_id)
+        drone.stop()
+
+    def ids(self):
+        with self._lock:
+            return list(self._drones)
+
+    def __len__(self):
+        return len(self._drones)
+
+    def stop(self):
+        """すべてのドローンを停止する"""
+        with self._lock:
+            drones = list(self._drones.values())
+            self._drones.clear()
+        for drone in drones:
+            drone.stop()
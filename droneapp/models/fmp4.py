@@ -0,0 +1,166 @@
+# H.264のアクセスユニットをデコードせずにフラグメント化MP4（fMP4）に詰め替えるための最小限のマルチプレクサ
+# ブラウザのMedia Source Extensionsで再生できる形式（初期化セグメント + moof/mdatのフラグメント）を作る
+import struct #バイナリのパック
+
+from droneapp.models.h264 import NAL_AUD
+from droneapp.models.h264 import NAL_IDR
+from droneapp.models.h264 import NAL_PPS
+from droneapp.models.h264 import NAL_SPS
+from droneapp.models.h264 import parse_sps
+from droneapp.models.h264 import split_nals
+
+TIMESCALE = 90000  # 時刻の単位（1/90000秒、MPEGの慣例）
+TRACK_ID = 1
+
+# trunのサンプルフラグ
+SAMPLE_FLAGS_KEYFRAME = 0x02000000  # 他のフレームに依存しない
+SAMPLE_FLAGS_DELTA = 0x01010000  # 他のフレームに依存する・同期サンプルではない
+
+_MATRIX = struct.pack('>9I', 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000)  # 単位行列
+
+
+def box(kind, *payloads):
+    """MP4のボックス（サイズ + 種類 + 中身）を作る"""
+    payload = b''.join(payloads)
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def full_box(kind, version, flags, *payloads):
+    """バージョンとフラグを持つボックスを作る"""
+    return box(kind, struct.pack('>I', (version << 24) | flags), *payloads)
+
+
+def codec_string(sps):
+    """MSEのaddSourceBufferに渡すコーデック文字列（例: avc1.4d401f）"""
+    return 'avc1.' + bytes(sps[1:4]).hex()
+
+
+def init_segment(sps, pps):
+    """SPS・PPS（スタートコードを除くNALユニット）から初期化セグメント（ftyp + moov）を作る"""
+    info = parse_sps(sps)
+    width, height = info['width'], info['height']
+    avcc = box(b'avcC', struct.pack('>5B', 1, sps[1], sps[2], sps[3], 0xFF),  # NALユニットの長さは4バイト
+               struct.pack('>BH', 0xE1, len(sps)), sps,
+               struct.pack('>BH', 1, len(pps)), pps)
+    avc1 = box(b'avc1',
+               bytes(6), struct.pack('>H', 1),  # data_reference_index
+               bytes(16), struct.pack('>HH', width, height),
+               struct.pack('>II', 0x00480000, 0x00480000),  # 72dpi
+               bytes(4), struct.pack('>H', 1),  # frame_count
+               bytes(32), struct.pack('>Hh', 0x0018, -1),
+               avcc)
+    stbl = box(b'stbl',
+               full_box(b'stsd', 0, 0, struct.pack('>I', 1), avc1),
+               full_box(b'stts', 0, 0, struct.pack('>I', 0)),
+               full_box(b'stsc', 0, 0, struct.pack('>I', 0)),
+               full_box(b'stsz', 0, 0, struct.pack('>II', 0, 0)),
+               full_box(b'stco', 0, 0, struct.pack('>I', 0)))
+    minf = box(b'minf',
+               full_box(b'vmhd', 0, 1, bytes(8)),
+               box(b'dinf', full_box(b'dref', 0, 0, struct.pack('>I', 1), full_box(b'url ', 0, 1))),
+               stbl)
+    mdia = box(b'mdia',
+               full_box(b'mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0, TIMESCALE, 0, 0x55C4, 0)),  # 言語 'und'
+               full_box(b'hdlr', 0, 0, bytes(4), b'vide', bytes(12), b'VideoHandler\x00'),
+               minf)
+    trak = box(b'trak',
+               full_box(b'tkhd', 0, 3, struct.pack('>IIIII', 0, 0, TRACK_ID, 0, 0), bytes(8),
+                        struct.pack('>hhhH', 0, 0, 0, 0), _MATRIX,
+                        struct.pack('>II', width << 16, height << 16)),
+               mdia)
+    moov = box(b'moov',
+               full_box(b'mvhd', 0, 0, struct.pack('>IIIIIH', 0, 0, TIMESCALE, 0, 0x00010000, 0x0100),
+                        bytes(10), _MATRIX, bytes(24), struct.pack('>I', TRACK_ID + 1)),
+               trak,
+               box(b'mvex', full_box(b'trex', 0, 0, struct.pack('>IIIII', TRACK_ID, 1, 0, 0, 0))))
+    ftyp = box(b'ftyp', b'isom', struct.pack('>I', 0x200), b'isom', b'iso6', b'avc1', b'mp41')
+    return ftyp + moov
+
+
+def to_sample(nals):
+    """NALユニットのリストをMP4のサンプル（4バイトの長さ + NALユニット）にする
+
+    SPS・PPSは初期化セグメントに入れるため、AUDとともにサンプルからは除く。
+    """
+    return b''.join(struct.pack('>I', len(nal)) + nal for nal in nals
+                    if nal[0] & 0x1F not in (NAL_SPS, NAL_PPS, NAL_AUD))
+
+
+def fragment(sequence, decode_time, duration, sample, keyframe):
+    """1サンプルのフラグメント（moof + mdat）を作る"""
+    flags = SAMPLE_FLAGS_KEYFRAME if keyframe else SAMPLE_FLAGS_DELTA
+
+    def moof(data_offset):
+        return box(b'moof',
+                   full_box(b'mfhd', 0, 0, struct.pack('>I', sequence)),
+                   box(b'traf',
+                       full_box(b'tfhd', 0, 0x020000, struct.pack('>I', TRACK_ID)),  # default-base-is-moof
+                       full_box(b'tfdt', 1, 0, struct.pack('>Q', decode_time)),
+                       # data-offset, sample-duration, sample-size, sample-flagsあり
+                       full_box(b'trun', 0, 0x000701,
+                                struct.pack('>IiIII', 1, data_offset, duration, len(sample), flags))))
+
+    header = moof(0)
+    return moof(len(header) + 8) + box(b'mdat', sample)
+
+
+class Fmp4Muxer(object):
+    """Annex B形式のアクセスユニットを順に受け取り、fMP4のセグメントにする
+
+    SPS・PPSを受け取るまで（または変わった後）は初期化セグメントを作り直す。
+    フレームの長さはTelloの映像に時刻がないため、到着間隔の移動平均を使う。
+    """
+
+    def __init__(self, frame_rate=30):
+        self.sps = None
+        self.pps = None
+        self.codec = None  # コーデック文字列
+        self.size = None  # (幅, 高さ)
+        self.init = None  # 初期化セグメント、SPS・PPSが揃うまではNone
+        self._sequence = 0
+        self._decode_time = 0
+        self._duration = TIMESCALE // frame_rate
+        self._last_arrival = None
+
+    def add(self, unit, arrival):
+        """アクセスユニットを受け取り、(フラグメント, キーフレームか, 初期化セグメントが変わったか)を返す
+
+        初期化セグメントがまだ作れない場合はフラグメントがNone。
+        """
+        nals = split_nals(unit)
+        changed = False
+        keyframe = False
+        for nal in nals:
+            kind = nal[0] & 0x1F
+            if kind == NAL_SPS and nal != self.sps:
+                self.sps, changed = nal, True
+            elif kind == NAL_PPS and nal != self.pps:
+                self.pps, changed = nal, True
+            elif kind == NAL_IDR:
+                keyframe = True
+        if changed and self.sps is not None and self.pps is not None:
+            try:
+                self.init = init_segment(self.sps, self.pps)
+                info = parse_sps(self.sps)
+                self.codec = codec_string(self.sps)
+                self.size = (info['width'], info['height'])
+            except ValueError:
+                self.init = None
+        else:
+            changed = False
+
+        if self._last_arrival is not None:
+            # 途切れた場合の長い間隔は使わない（10fps～60fpsの範囲）
+            interval = min(max(arrival - self._last_arrival, 1 / 60), 1 / 10)
+            self._duration += int((interval * TIMESCALE - self._duration) * 0.1)
+        self._last_arrival = arrival
+        if self.init is None:
+            return None, keyframe, changed
+
+        sample = to_sample(nals)
+        if not sample:
+            return None, keyframe, changed
+        self._sequence += 1
+        data = fragment(self._sequence, self._decode_time, self._duration, sample, keyframe)
+        self._decode_time += self._duration
+        return data, keyframe, changed
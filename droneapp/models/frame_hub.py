@@ -0,0 +1,105 @@
+import logging #ログ出力用
+import threading #スレッド関連
+
+logger = logging.getLogger(__name__)
+
+FRAME_WAIT_TIMEOUT = 1.0  # 利用者が新しいフレームを待つ最大時間（秒）、停止の確認のため
+
+
+class FrameHub(object):
+    """1つの生成スレッドが最新のフレームとJPEGを公開し、複数の利用者がそれを読む
+
+    公開は最新の1枚を差し替えるだけで、利用者を待たない。
+    利用者は前回読んだ番号より新しいフレームを待つので、処理が遅い利用者は途中のフレームを飛ばす。
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._sequence = 0  # 公開したフレームの番号
+        self._frame = None  # 最新のフレーム（NumPy配列）
+        self._jpeg = None  # 最新のフレームのJPEG
+        self._received = None  # 最新のフレームの最初のデータグラムの受信時刻
+        self._closed = False
+        self._producer = None
+        self.consumers = 0  # 接続中の利用者数
+        self.skipped = 0  # 利用者が読み飛ばしたフレーム数の合計
+
+    def start(self, frames):
+        """framesの(フレーム, JPEG, 受信時刻)を公開するスレッドを開始する（開始済みなら何もしない）"""
+        with self._condition:
+            if self._producer is not None or self._closed:
+                return
+            self._producer = threading.Thread(target=self._run, args=(frames,), name='frame-hub')
+            self._producer.daemon = True
+            self._producer.start()
+        logger.info({'action': 'frame_hub', 'status': 'started'})
+
+    def _run(self, frames):
+        try:
+            for frame, jpeg, received in frames:
+                self.publish(frame, jpeg, received)
+                if self._closed:
+                    break
+        finally:
+            with self._condition:
+                self._producer = None  # 次の利用者が来たら再開できるようにする
+                self._condition.notify_all()
+            logger.info({'action': 'frame_hub', 'status': 'stopped'})
+
+    def publish(self, frame, jpeg, received=None):
+        with self._condition:
+            self._frame = frame
+            self._jpeg = jpeg
+            self._received = received
+            self._sequence += 1
+            self._condition.notify_all()
+
+    def latest(self):
+        """(番号, フレーム, JPEG)を返す。まだ公開されていなければ番号は0
+
+        フレームはデコーダーのバッファで数フレーム後に再利用されるため、保持する場合はコピーすること。
+        """
+        with self._condition:
+            return self._sequence, self._frame, self._jpeg
+
+    def wait(self, after, timeout=FRAME_WAIT_TIMEOUT):
+        """番号がafterより新しいフレームを待って(番号, フレーム, JPEG, 受信時刻)を返す。タイムアウトや停止時はNone"""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._sequence > after or self._closed, timeout):
+                return None
+            if self._closed:
+                return None
+            return self._sequence, self._frame, self._jpeg, self._received
+
+    def subscribe(self, stop_event=None):
+        """新しいフレームの(JPEG, 受信時刻)を順に返すジェネレータ（読み飛ばしあり）"""
+        with self._condition:
+            self.consumers += 1
+        try:
+            sequence = 0
+            while not self._closed and not (stop_event is not None and stop_event.is_set()):
+                latest = self.wait(sequence)
+                if latest is None:
+                    continue
+                if sequence:
+                    with self._condition:
+                        self.skipped += latest[0] - sequence - 1
+                sequence, _, jpeg, received = latest
+                yield jpeg, received
+        finally:
+            with self._condition:
+                self.consumers -= 1
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'published': self._sequence,
+                'consumers': self.consumers,
+                'skipped': self.skipped,
+                'running': self._producer is not None,
+            }
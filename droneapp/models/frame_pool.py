@@ -0,0 +1,53 @@
+import collections #キュー
+import logging #ログ出力用
+import threading #スレッド関連
+
+import numpy as np #数値計算ライブラリ
+
+logger = logging.getLogger(__name__)
+
+FRAME_POOL_SIZE = 6  # 確保するフレームバッファの数（読み込み中・デコード済み・処理中の分）
+
+
+class FramePool(object):
+    """同じ形のNumPyのフレームバッファを使い回すためのプール
+
+    acquire()で空きバッファを取り出し、使い終わったらrelease()で返す。
+    返されたバッファは最も後に再利用されるため、直前のフレームは次の数フレームの間は書き換わらない。
+    すべて使用中の場合は返されるまで待つ。
+    """
+
+    def __init__(self, shape, size=FRAME_POOL_SIZE, dtype=np.uint8):
+        self.shape = shape
+        self.size = size
+        self._buffers = [np.empty(shape, dtype) for _ in range(size)]
+        # readintoに渡すバイト列のビュー（フレームごとに作らないよう、最初に作っておく）
+        self._views = {id(buffer): memoryview(buffer).cast('B') for buffer in self._buffers}
+        self._free = collections.deque(self._buffers)
+        self._condition = threading.Condition()
+        self.waits = 0  # 空きバッファを待った回数
+
+    def acquire(self, timeout=None):
+        """空きバッファを取り出す。timeoutまでに空かなければNone"""
+        with self._condition:
+            if not self._free:
+                self.waits += 1
+                if not self._condition.wait_for(lambda: self._free, timeout):
+                    return None
+            return self._free.popleft()
+
+    def release(self, buffer):
+        """バッファをプールに返す（プールのバッファ以外は無視する）"""
+        if id(buffer) not in self._views:
+            return
+        with self._condition:
+            self._free.append(buffer)
+            self._condition.notify()
+
+    def view(self, buffer):
+        """バッファ全体を指すバイト列のmemoryview"""
+        return self._views[id(buffer)]
+
+    def stats(self):
+        with self._condition:
+            return {'size': self.size, 'free': len(self._free), 'waits': self.waits}
@@ -0,0 +1,177 @@
+import collections #LRUキャッシュ
+import logging #ログ出力用
+import os #ファイル操作
+import sqlite3 #スナップショットの索引
+import threading #スレッド関連
+
+import cv2 as cv #OpenCVライブラリ
+
+logger = logging.getLogger(__name__)
+
+GALLERY_INDEX_FILE = 'gallery.sqlite3'  # スナップショットの索引（データのフォルダに作る）
+THUMBNAIL_FOLDER = 'thumbnails'  # サムネイルの保存先（データのフォルダ内）
+THUMBNAIL_SIZE = (160, 120)  # サムネイルの最大サイズ（幅, 高さ）、縦横比は保つ
+THUMBNAIL_JPEG_QUALITY = 80
+THUMBNAIL_CACHE_SIZE = 512  # メモリに保持するサムネイルの数（約5KB/枚）
+GALLERY_PER_PAGE = 50  # 1ページの件数の既定値
+GALLERY_MAX_PER_PAGE = 200
+GALLERY_EXCLUDE = ('snapshot',)  # このように始まるファイル（ドローンごとの最新のスナップショットの複製）は索引に入れない
+
+KIND_SNAPSHOT = 'snapshot'
+KIND_BURST = 'burst'
+
+
+class ErrorUnknownSnapshot(Exception):
+    """索引にないスナップショットを指定した場合の例外"""
+
+
+class SnapshotGallery(object):
+    """スナップショットのファイルをSQLiteの索引で管理し、ページ単位の一覧とサムネイルを返す
+
+    一覧は索引だけを読み、元の画像は読まない。サムネイルは最初に要求されたときに作ってファイルに保存し、
+    最近使ったものをメモリにも保持する（LRU）。
+    SnapshotWriterのリスナーとしてadd()を登録すると、撮影したファイルが索引に追加される。
+    索引とサムネイルは、静的ファイルとして配信されないようにスナップショットとは別のフォルダ（data_folder）に置く。
+    """
+
+    def __init__(self, folder, data_folder, thumbnail_size=THUMBNAIL_SIZE, cache_size=THUMBNAIL_CACHE_SIZE):
+        self.folder = folder
+        self.data_folder = data_folder
+        self.thumbnail_size = thumbnail_size
+        self.cache_size = cache_size
+        self._thumbnail_folder = os.path.join(data_folder, THUMBNAIL_FOLDER)
+        os.makedirs(self._thumbnail_folder, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(data_folder, GALLERY_INDEX_FILE), check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS snapshots ('
+            ' name TEXT PRIMARY KEY, taken REAL NOT NULL, bytes INTEGER NOT NULL,'
+            ' width INTEGER, height INTEGER, kind TEXT NOT NULL, drone TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS snapshots_taken ON snapshots (taken)')
+        self._db.commit()
+        self._cache = collections.OrderedDict()  # ファイル名 -> サムネイルのJPEG
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.generated = 0  # 元の画像から作ったサムネイルの数
+
+    def add(self, entries):
+        """撮影したファイルを索引に追加する。entriesは{'path': , 'taken': , 'bytes': , 'width': , 'height': , 'kind': , 'drone': }のリスト"""
+        rows = [(os.path.basename(entry['path']), entry['taken'], entry['bytes'], entry.get('width'),
+                 entry.get('height'), entry.get('kind', KIND_SNAPSHOT), entry.get('drone'))
+                for entry in entries if not os.path.basename(entry['path']).startswith(GALLERY_EXCLUDE)]
+        if not rows:
+            return
+        with self._lock:
+            for row in rows:
+                try:
+                    self._db.execute('INSERT INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?)', row)
+                except sqlite3.IntegrityError as ex:
+                    # ファイル名は一意なので、同じ名前が既に索引にあるのは上書きされた場合だけ（既存の行は残す）
+                    logger.error({'action': 'gallery_add', 'file': row[0], 'ex': ex})
+            self._db.commit()
+
+    def sync(self):
+        """フォルダと索引を突き合わせ、索引にないファイルを追加し、なくなったファイルを削除する（起動時用）
+
+        追加するファイルのメタデータはファイルの属性から取り、画像は読まない（幅・高さはサムネイル作成時に埋める）。
+        """
+        files = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.lower().endswith('.jpg') and not entry.name.startswith(GALLERY_EXCLUDE):
+                    stat = entry.stat()
+                    files[entry.name] = (stat.st_mtime, stat.st_size)
+        with self._lock:
+            indexed = {name for name, in self._db.execute('SELECT name FROM snapshots')}
+            added = [(name, taken, size, None, None, KIND_BURST if '-burst-' in name else KIND_SNAPSHOT, None)
+                     for name, (taken, size) in files.items() if name not in indexed]
+            removed = [(name,) for name in indexed - files.keys()]
+            self._db.executemany('INSERT INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?)', added)
+            self._db.executemany('DELETE FROM snapshots WHERE name = ?', removed)
+            self._db.commit()
+        for name, in removed:
+            self._forget_thumbnail(name)
+        logger.info({'action': 'gallery_sync', 'files': len(files), 'added': len(added), 'removed': len(removed)})
+        return {'added': len(added), 'removed': len(removed)}
+
+    def page(self, page=1, per_page=GALLERY_PER_PAGE, kind=None):
+        """新しい順にpage番目（1から）のページを返す"""
+        per_page = max(1, min(per_page, GALLERY_MAX_PER_PAGE))
+        page = max(1, page)
+        where, params = ('WHERE kind = ?', (kind,)) if kind else ('', ())
+        with self._lock:
+            total, = self._db.execute(f'SELECT COUNT(*) FROM snapshots {where}', params).fetchone()
+            rows = self._db.execute(
+                f'SELECT name, taken, bytes, width, height, kind, drone FROM snapshots {where}'
+                ' ORDER BY taken DESC, name DESC LIMIT ? OFFSET ?',
+                params + (per_page, (page - 1) * per_page)).fetchall()
+        items = [{'name': name, 'taken': taken, 'bytes': size, 'width': width, 'height': height,
+                  'kind': kind, 'drone': drone} for name, taken, size, width, height, kind, drone in rows]
+        return {'total': total, 'page': page, 'per_page': per_page,
+                'pages': (total + per_page - 1) // per_page, 'items': items}
+
+    def thumbnail(self, name):
+        """サムネイルのJPEGを返す（メモリ → サムネイルのファイル → 元の画像の順に探す）"""
+        with self._lock:
+            jpeg = self._cache.get(name)
+            if jpeg is not None:
+                self._cache.move_to_end(name)
+                self.cache_hits += 1
+                return jpeg
+            self.cache_misses += 1
+            known = self._db.execute('SELECT 1 FROM snapshots WHERE name = ?', (name,)).fetchone()
+        if known is None:
+            raise ErrorUnknownSnapshot(name)
+
+        path = os.path.join(self._thumbnail_folder, name)
+        try:
+            with open(path, 'rb') as f:
+                jpeg = f.read()
+        except FileNotFoundError:
+            jpeg = self._generate(name, path)
+        with self._lock:
+            self._cache[name] = jpeg
+            self._cache.move_to_end(name)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return jpeg
+
+    def _generate(self, name, path):
+        # 縮小しながらデコードする（1/4のサイズで読めば、元の画像を全部デコードするより速い）
+        image = cv.imread(os.path.join(self.folder, name), cv.IMREAD_REDUCED_COLOR_4)
+        if image is None:
+            raise ErrorUnknownSnapshot(name)
+        height, width = image.shape[:2]
+        scale = min(self.thumbnail_size[0] / width, self.thumbnail_size[1] / height, 1.0)
+        if scale < 1.0:
+            image = cv.resize(image, (max(1, int(width * scale)), max(1, int(height * scale))),
+                              interpolation=cv.INTER_AREA)
+        _, jpeg = cv.imencode('.jpg', image, [cv.IMWRITE_JPEG_QUALITY, THUMBNAIL_JPEG_QUALITY])
+        jpeg = jpeg.tobytes()
+        with open(path, 'wb') as f:
+            f.write(jpeg)
+        with self._lock:
+            # 起動時の同期で追加したファイルは幅・高さが分からないので、ここで埋める（縮小前のおおよその値）
+            self._db.execute('UPDATE snapshots SET width = ?, height = ? WHERE name = ? AND width IS NULL',
+                             (width * 4, height * 4, name))
+            self._db.commit()
+            self.generated += 1
+        return jpeg
+
+    def _forget_thumbnail(self, name):
+        with self._lock:
+            self._cache.pop(name, None)
+        try:
+            os.remove(os.path.join(self._thumbnail_folder, name))
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def stats(self):
+        with self._lock:
+            total, = self._db.execute('SELECT COUNT(*) FROM snapshots').fetchone()
+            return {'snapshots': total, 'cached': len(self._cache), 'cache_hits': self.cache_hits,
+                    'cache_misses': self.cache_misses, 'generated': self.generated}
@@ -0,0 +1,251 @@
+# H.264（Annex B形式）のバイト列をNALユニット・アクセスユニットに分割するためのユーティリティ
+
+START_CODE = b'\x00\x00\x01'
+
+# NALユニットの種類
+NAL_SLICE = 1  # 非IDRスライス
+NAL_IDR = 5  # IDRスライス（キーフレーム）
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9  # アクセスユニット区切り
+
+
+def nal_type(nal):
+    """NALユニット（スタートコードを含んでもよい）の種類を返す"""
+    offset = 0
+    if nal.startswith(b'\x00\x00\x00\x01'):
+        offset = 4
+    elif nal.startswith(START_CODE):
+        offset = 3
+    if len(nal) <= offset:
+        return None
+    return nal[offset] & 0x1F
+
+
+def find_start_codes(data, start=0):
+    """dataに含まれるスタートコードの位置（0x000001の先頭、直前に0x00があればその位置）を返す"""
+    positions = []
+    index = data.find(START_CODE, start)
+    while index != -1:
+        positions.append(index - 1 if index > 0 and data[index - 1] == 0 else index)
+        index = data.find(START_CODE, index + 3)
+    return positions
+
+
+class AccessUnitSplitter(object):
+    """Annex B形式のバイト列を順に受け取り、1フレーム分（アクセスユニット）ずつ取り出す
+
+    SPS・PPS・SEI・AUDは次のスライスと同じアクセスユニットにまとめる。
+    スライスは1フレーム1スライスを前提とする（Telloとx264の既定の出力）。
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._positions = []  # _bufferの中で見つけたスタートコードの位置
+        self._scanned = 0  # スタートコードを探し終えた位置（次はここから探す）
+        self._unit = bytearray()  # 組み立て中のアクセスユニット
+
+    def feed(self, data):
+        """バイト列を追加し、完成したアクセスユニット（bytes）のリストを返す"""
+        self._buffer += data
+        # 追加した分だけを探す（前回の末尾にまたがるスタートコードのため、最後の2バイトから）
+        self._positions += find_start_codes(self._buffer, self._scanned)
+        self._scanned = max(len(self._buffer) - len(START_CODE) + 1, 0)
+        positions = self._positions
+        if len(positions) < 2:
+            return []
+        units = []
+        for begin, end in zip(positions, positions[1:]):
+            nal = bytes(self._buffer[begin:end])
+            unit = self._add_nal(nal)
+            if unit is not None:
+                units.append(unit)
+        consumed = positions[-1]
+        del self._buffer[:consumed]  # 最後のNALユニットは続きが届くまで保持する
+        self._positions = [0]
+        self._scanned -= consumed
+        return units
+
+    def flush(self):
+        """残りのデータを1つのアクセスユニットとして返す（ストリーム終了時）。残りがなければNone"""
+        self._unit += self._buffer  # 最後のNALユニットがAUDでも、組み立て中のデータと一緒に返す
+        self._buffer.clear()
+        self._positions = []
+        self._scanned = 0
+        unit = bytes(self._unit) if self._unit else None
+        self._unit.clear()
+        return unit
+
+    def _add_nal(self, nal):
+        kind = nal_type(nal)
+        if kind == NAL_AUD and self._unit:
+            # AUDは新しいアクセスユニットの始まり
+            unit = bytes(self._unit)
+            self._unit[:] = nal
+            return unit
+        self._unit += nal
+        if kind in (NAL_SLICE, NAL_IDR):
+            unit = bytes(self._unit)
+            self._unit.clear()
+            return unit
+        return None
+
+
+class AccessUnitStarts(object):
+    """データグラムがアクセスユニットの先頭かどうかを、先頭のNALユニットの種類だけで判定する
+
+    データを溜めずに判定するため、アクセスユニットがデータグラムの先頭から始まることを前提とする
+    （Telloとtello_simulatorはフレームごとにデータグラムを分ける）。
+    SPS・PPS・SEI・AUDに続くスライスは、同じアクセスユニットとみなす。
+    """
+
+    def __init__(self):
+        self._in_parameters = False  # SPSなどの後、スライスを待っている
+
+    def is_start(self, chunk):
+        """アクセスユニットの先頭なら、その種類（NAL_SLICE・NAL_IDR・NAL_SPSなど）を返す。そうでなければNone"""
+        if not chunk.startswith(START_CODE) and not chunk.startswith(b'\x00' + START_CODE):
+            return None  # 前のデータグラムの続き
+        kind = nal_type(chunk)
+        if kind in (NAL_SPS, NAL_PPS, NAL_SEI, NAL_AUD):
+            started = not self._in_parameters
+            # SPSなどとスライスが同じデータグラムに入っている場合（tello_simulator）は、次はスライスを待たない
+            self._in_parameters = not any(nal_type(chunk[position:position + 5]) in (NAL_SLICE, NAL_IDR)
+                                          for position in find_start_codes(chunk))
+            return kind if started else None
+        if kind in (NAL_SLICE, NAL_IDR):
+            started, self._in_parameters = not self._in_parameters, False
+            return kind if started else None
+        return None
+
+
+def is_keyframe(unit):
+    """アクセスユニットがIDRスライス（キーフレーム）を含むかどうか"""
+    for position in find_start_codes(unit):
+        if nal_type(unit[position:position + 5]) == NAL_IDR:
+            return True
+    return False
+
+
+def split_nals(unit):
+    """アクセスユニットをNALユニット（スタートコードを除く）のリストに分割する"""
+    positions = find_start_codes(unit)
+    nals = []
+    for begin, end in zip(positions, positions[1:] + [len(unit)]):
+        begin = unit.index(START_CODE, begin) + len(START_CODE)
+        nal = unit[begin:end]
+        if nal:
+            nals.append(bytes(nal))
+    return nals
+
+
+def _remove_emulation_prevention(nal):
+    """NALユニットのペイロードから0x000003の0x03（エミュレーション防止バイト）を取り除く"""
+    return bytes(nal).replace(b'\x00\x00\x03', b'\x00\x00')
+
+
+class _BitReader(object):
+    """SPSを読むためのビット単位の読み込み（指数ゴロム符号を含む）"""
+
+    def __init__(self, data):
+        self._data = data
+        self._position = 0
+
+    def bit(self):
+        byte = self._data[self._position >> 3]
+        value = (byte >> (7 - (self._position & 7))) & 1
+        self._position += 1
+        return value
+
+    def bits(self, count):
+        value = 0
+        for _ in range(count):
+            value = (value << 1) | self.bit()
+        return value
+
+    def ue(self):
+        zeros = 0
+        while self.bit() == 0:
+            zeros += 1
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+    def se(self):
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+# chroma_format_idcなどの拡張項目を持つプロファイル
+_HIGH_PROFILES = (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135)
+
+
+def parse_sps(nal):
+    """SPS（スタートコードを除くNALユニット）からプロファイル・レベル・画像サイズを読み取る
+
+    {'profile': , 'compatibility': , 'level': , 'width': , 'height': }を返す。
+    """
+    data = _remove_emulation_prevention(nal)
+    if len(data) < 4 or data[0] & 0x1F != NAL_SPS:
+        raise ValueError('SPSではありません')
+    profile, compatibility, level = data[1], data[2], data[3]
+    reader = _BitReader(data[4:])
+    try:
+        reader.ue()  # seq_parameter_set_id
+        chroma_format = 1
+        separate_colour_plane = 0
+        if profile in _HIGH_PROFILES:
+            chroma_format = reader.ue()
+            if chroma_format == 3:
+                separate_colour_plane = reader.bit()
+            reader.ue()  # bit_depth_luma_minus8
+            reader.ue()  # bit_depth_chroma_minus8
+            reader.bit()  # qpprime_y_zero_transform_bypass_flag
+            if reader.bit():  # seq_scaling_matrix_present_flag
+                for i in range(12 if chroma_format == 3 else 8):
+                    if reader.bit():
+                        _skip_scaling_list(reader, 16 if i < 6 else 64)
+        reader.ue()  # log2_max_frame_num_minus4
+        pic_order_cnt_type = reader.ue()
+        if pic_order_cnt_type == 0:
+            reader.ue()  # log2_max_pic_order_cnt_lsb_minus4
+        elif pic_order_cnt_type == 1:
+            reader.bit()  # delta_pic_order_always_zero_flag
+            reader.se()  # offset_for_non_ref_pic
+            reader.se()  # offset_for_top_to_bottom_field
+            for _ in range(reader.ue()):
+                reader.se()  # offset_for_ref_frame
+        reader.ue()  # max_num_ref_frames
+        reader.bit()  # gaps_in_frame_num_value_allowed_flag
+        width_in_mbs = reader.ue() + 1
+        height_in_map_units = reader.ue() + 1
+        frame_mbs_only = reader.bit()
+        if not frame_mbs_only:
+            reader.bit()  # mb_adaptive_frame_field_flag
+        reader.bit()  # direct_8x8_inference_flag
+        crop_left = crop_right = crop_top = crop_bottom = 0
+        if reader.bit():  # frame_cropping_flag
+            crop_left, crop_right, crop_top, crop_bottom = reader.ue(), reader.ue(), reader.ue(), reader.ue()
+    except IndexError:
+        raise ValueError('SPSが途中で終わっています')
+
+    # クロップの単位（4:2:0なら2ピクセル単位）
+    if chroma_format == 0 or separate_colour_plane:
+        crop_x, crop_y = 1, 2 - frame_mbs_only
+    else:
+        crop_x = 1 if chroma_format == 3 else 2
+        crop_y = (2 if chroma_format == 1 else 1) * (2 - frame_mbs_only)
+    return {
+        'profile': profile,
+        'compatibility': compatibility,
+        'level': level,
+        'width': width_in_mbs * 16 - crop_x * (crop_left + crop_right),
+        'height': (2 - frame_mbs_only) * height_in_map_units * 16 - crop_y * (crop_top + crop_bottom),
+    }
+
+
+def _skip_scaling_list(reader, size):
+    last_scale = next_scale = 8
+    for _ in range(size):
+        if next_scale != 0:
+            next_scale = (last_scale + reader.se() + 256) % 256
+        last_scale = next_scale or last_scale
@@ -0,0 +1,196 @@
+import collections #両端キュー
+import heapq #タイマーの優先度キュー
+import itertools #連番
+import logging #ログ出力用
+import selectors #epoll/kqueueなどのI/O多重化
+import socket #ソケット通信
+import threading #スレッド関連
+import time #時間関連
+
+logger = logging.getLogger(__name__)
+
+RECEIVE_BATCH = 64  # 1回の読み込み可能通知で受信するデータグラムの最大数（他のソケットを待たせないため）
+
+
+class Timer(object):
+    """call_laterで登録したタイマー,cancel()で取り消せる"""
+
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class IOLoop(object):
+    """selectorsを使い、1つのスレッドで複数のソケット・パイプの読み書きとタイマーを処理するループ
+
+    ソケットが読み書き可能になったときだけコールバックを呼ぶので、タイムアウト付きの
+    ポーリングやsleepは不要。ドローンが何台になってもスレッドは1つのままで済む。
+    コールバックはすべてループのスレッドで実行されるため、ブロックする処理を書かないこと。
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._callbacks = collections.deque()  # 次の周回で実行する(関数, 引数)
+        self._timers = []  # (期限, 連番, Timer)のヒープ
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._thread_ident = None
+        self._stopping = False
+
+        # 他のスレッドからselect()を起こすためのソケットペア
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self._selector.register(self._wakeup_reader, selectors.EVENT_READ, (self._drain_wakeup, None))
+
+    def start(self):
+        """ループのスレッドを開始する"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='io-loop')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=2):
+        """ループを停止する"""
+        self._stopping = True
+        self._wakeup()
+        if self._thread is not None and not self.in_loop():
+            self._thread.join(timeout=timeout)
+
+    def in_loop(self):
+        """ループのスレッドから呼ばれているかどうか"""
+        return threading.get_ident() == self._thread_ident
+
+    def call_soon(self, callback, *args):
+        """次の周回でcallback(*args)を実行する（どのスレッドからでも呼べる）"""
+        with self._lock:
+            self._callbacks.append((callback, args))
+        if not self.in_loop():
+            self._wakeup()
+
+    def call_later(self, delay, callback, *args):
+        """delay秒後にcallback(*args)を実行するTimerを返す（どのスレッドからでも呼べる）"""
+        timer = Timer(time.monotonic() + delay, callback, args)
+        with self._lock:
+            heapq.heappush(self._timers, (timer.deadline, next(self._sequence), timer))
+        if not self.in_loop():
+            self._wakeup()
+        return timer
+
+    def add_reader(self, fileobj, callback):
+        """fileobjが読み込み可能になるたびにcallback(fileobj)を呼ぶ"""
+        self._run_in_loop(self._update, fileobj, selectors.EVENT_READ, callback)
+
+    def remove_reader(self, fileobj):
+        self._run_in_loop(self._update, fileobj, selectors.EVENT_READ, None)
+
+    def add_writer(self, fileobj, callback):
+        """fileobjが書き込み可能になるたびにcallback(fileobj)を呼ぶ"""
+        self._run_in_loop(self._update, fileobj, selectors.EVENT_WRITE, callback)
+
+    def remove_writer(self, fileobj):
+        self._run_in_loop(self._update, fileobj, selectors.EVENT_WRITE, None)
+
+    def _run_in_loop(self, callback, *args):
+        # セレクタはスレッドセーフではないため、登録・解除はループのスレッドで行う
+        if self.in_loop():
+            callback(*args)
+        else:
+            self.call_soon(callback, *args)
+
+    def _update(self, fileobj, event, callback):
+        try:
+            key = self._selector.get_key(fileobj)
+        except (KeyError, ValueError):
+            key = None
+        reader, writer = key.data if key else (None, None)
+        if event == selectors.EVENT_READ:
+            reader = callback
+        else:
+            writer = callback
+        mask = (selectors.EVENT_READ if reader else 0) | (selectors.EVENT_WRITE if writer else 0)
+        if key is None:
+            if mask:
+                self._selector.register(fileobj, mask, (reader, writer))
+        elif mask:
+            self._selector.modify(fileobj, mask, (reader, writer))
+        else:
+            self._selector.unregister(fileobj)
+
+    def _wakeup(self):
+        try:
+            self._wakeup_writer.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # 既に起こしている、または停止済み
+
+    def _drain_wakeup(self, sock):
+        try:
+            while sock.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def _next_timeout(self):
+        with self._lock:
+            if self._callbacks:
+                return 0
+            if not self._timers:
+                return None
+            return max(self._timers[0][0] - time.monotonic(), 0)
+
+    def _run(self):
+        self._thread_ident = threading.get_ident()
+        while not self._stopping:
+            for key, mask in self._selector.select(self._next_timeout()):
+                reader, writer = key.data
+                if mask & selectors.EVENT_READ and reader:
+                    self._invoke(reader, (key.fileobj, ))
+                if mask & selectors.EVENT_WRITE and writer:
+                    self._invoke(writer, (key.fileobj, ))
+
+            # 期限が来たタイマーを実行
+            now = time.monotonic()
+            ready = []
+            with self._lock:
+                while self._timers and self._timers[0][0] <= now:
+                    ready.append(heapq.heappop(self._timers)[2])
+                callbacks, self._callbacks = self._callbacks, collections.deque()
+            for timer in ready:
+                if not timer.cancelled:
+                    self._invoke(timer.callback, timer.args)
+            for callback, args in callbacks:
+                self._invoke(callback, args)
+
+        self._selector.close()
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+
+    @staticmethod
+    def _invoke(callback, args):
+        try:
+            callback(*args)
+        except Exception as ex:  # 1つのコールバックの例外でループ全体を止めない
+            logger.exception({'action': 'io_loop', 'callback': getattr(callback, '__name__', callback), 'ex': ex})
+
+
+_default_loop = None
+_default_loop_lock = threading.Lock()
+
+
+def get_io_loop():
+    """プロセス共通のIOLoopを返す（初回呼び出し時に開始する）"""
+    global _default_loop
+    with _default_loop_lock:
+        if _default_loop is None:
+            _default_loop = IOLoop()
+            _default_loop.start()
+        return _default_loop
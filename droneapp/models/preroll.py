@@ -0,0 +1,145 @@
+import collections #キュー
+import logging #ログ出力用
+import os #ファイル操作
+import threading #スレッド関連
+import time #時間関連
+from concurrent.futures import Future #書き出せない場合の結果
+from concurrent.futures import ThreadPoolExecutor #ファイルへの書き出し用
+
+from droneapp.models.h264 import AccessUnitSplitter
+from droneapp.models.h264 import is_keyframe
+
+logger = logging.getLogger(__name__)
+
+PREROLL_FOLDER = './prerolls'  # 保存先のフォルダ
+PREROLL_SECONDS = 10  # 保持する映像の長さ（秒）、GOP単位なので最大1GOP分長くなる
+PREROLL_MAX_BYTES = 16 * 1024 * 1024  # 保持する映像の上限（バイト）、超えたら古いGOPから捨てる
+PREROLL_COOLDOWN = 10  # 顔検出・異常検知による自動保存の最小間隔（秒）、理由ごと
+
+# 保存の理由
+PREROLL_REASON_MANUAL = 'manual'  # API
+PREROLL_REASON_FACE = 'face'  # 顔が映り始めた
+PREROLL_REASON_ANOMALY = 'anomaly'  # 状態パケットの異常（衝突・落下など）
+
+
+class ErrorPrerollEmpty(Exception):
+    """保持している映像がない（キーフレームをまだ受信していない）場合の例外"""
+
+
+class _Gop(object):
+    """キーフレームから次のキーフレームの手前までのアクセスユニット"""
+
+    __slots__ = ('timestamp', 'units', 'bytes')
+
+    def __init__(self, timestamp):
+        self.timestamp = timestamp  # キーフレームの受信時刻（time.time()）
+        self.units = []
+        self.bytes = 0
+
+
+class PrerollBuffer(object):
+    """直近の映像をGOP単位でメモリに保持し、イベントが起きたらその前の映像をファイルに書き出す
+
+    write()はIOLoopのスレッドから呼ばれ、アクセスユニットに分けてリングに積むだけにする。
+    保持する量はseconds（時間）とmax_bytes（バイト数）の両方で制限する。
+    trigger()はその時点のリングを切り取り、書き出しは専用のスレッドで行う（Futureで結果を返す）。
+    """
+
+    def __init__(self, folder=PREROLL_FOLDER, seconds=PREROLL_SECONDS, max_bytes=PREROLL_MAX_BYTES,
+                 cooldown=PREROLL_COOLDOWN, label='tello'):
+        self.folder = folder
+        self.label = label  # ファイル名に付ける名前（ドローンのIPアドレスなど）
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._splitter = AccessUnitSplitter()
+        self._gops = collections.deque()
+        self._bytes = 0  # リングに保持しているバイト数
+        self._latest = 0  # 最後に映像データを受け取った時刻
+        self._last_triggered = {}  # 理由 -> 最後に保存した時刻
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='preroll')
+        self.saved = 0  # 保存したファイル数
+        self.suppressed = 0  # 最小間隔内のため保存しなかった回数
+        self.overflows = 0  # 1GOPがmax_bytesを超えたため捨てた回数
+
+    def write(self, chunk, timestamp=None):
+        """受信した映像データを渡す"""
+        if timestamp is None:
+            timestamp = time.time()
+        units = self._splitter.feed(chunk)
+        if not units:
+            return
+        with self._lock:
+            self._latest = timestamp
+            for unit in units:
+                if is_keyframe(unit):
+                    self._gops.append(_Gop(timestamp))
+                elif not self._gops:
+                    continue  # 最初のキーフレームまでは保持しない
+                gop = self._gops[-1]
+                gop.units.append(unit)
+                gop.bytes += len(unit)
+                self._bytes += len(unit)
+            self._evict(timestamp)
+
+    def _evict(self, now):
+        gops = self._gops
+        # 2番目のGOPがseconds以上前に始まっていれば、最初のGOPは不要
+        while len(gops) > 1 and (self._bytes > self.max_bytes or gops[1].timestamp <= now - self.seconds):
+            self._bytes -= gops.popleft().bytes
+        if gops and self._bytes > self.max_bytes:
+            # 1GOPだけで上限を超えたので、次のキーフレームまで保持しない
+            self._gops.clear()
+            self._bytes = 0
+            self.overflows += 1
+
+    def trigger(self, reason=PREROLL_REASON_MANUAL, force=True):
+        """保持している映像をファイルに書き出す。結果（{'path': , 'bytes': , 'seconds': , 'reason': }）のFutureを返す
+
+        forceがFalseの場合、同じ理由で最小間隔内に保存していればNoneを返す（自動保存用）。
+        保持している映像がなければ、ファイルを作らずにErrorPrerollEmptyで失敗したFutureを返す。
+        """
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_triggered.get(reason, 0) < self.cooldown:
+                self.suppressed += 1
+                return None
+            if not self._gops:
+                logger.warning({'action': 'preroll', 'reason': reason, 'status': 'empty'})
+                future = Future()
+                future.set_exception(ErrorPrerollEmpty(reason))
+                return future
+            self._last_triggered[reason] = now
+            units = [unit for gop in self._gops for unit in gop.units]  # bytesなのでリストのコピーだけでよい
+            start = self._gops[0].timestamp
+        path = os.path.join(self.folder, time.strftime('%Y%m%d-%H%M%S', time.localtime(now)) +
+                            f'-{int(now * 1000) % 1000:03d}-{self.label}-{reason}.h264')
+        logger.info({'action': 'preroll', 'reason': reason, 'path': path, 'units': len(units)})
+        return self._executor.submit(self._save, path, units, now - start, reason)
+
+    def _save(self, path, units, seconds, reason):
+        os.makedirs(self.folder, exist_ok=True)
+        with open(path, 'wb') as f:
+            for unit in units:
+                f.write(unit)
+        size = sum(len(unit) for unit in units)
+        with self._lock:
+            self.saved += 1
+        logger.info({'action': 'preroll', 'path': path, 'bytes': size, 'status': 'saved'})
+        return {'path': path, 'bytes': size, 'seconds': round(seconds, 3), 'reason': reason}
+
+    def close(self):
+        self._executor.shutdown(wait=True)  # 書き出し中のファイルは書き終える
+
+    def stats(self):
+        with self._lock:
+            return {
+                'seconds': round(self._latest - self._gops[0].timestamp, 3) if self._gops else 0,
+                'gops': len(self._gops),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'saved': self.saved,
+                'suppressed': self.suppressed,
+                'overflows': self.overflows,
+            }
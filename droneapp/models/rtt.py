@@ -0,0 +1,82 @@
+import threading #スレッド関連
+
+# 再送タイムアウト(RTO)の設定（秒）、TCPのRTO計算(RFC 6298)に準拠
+RTO_INITIAL = 1.0  # RTTの測定値がないときのRTO
+RTO_MIN = 0.3  # RTOの下限
+RTO_MAX = 5.0  # RTOの上限
+RTT_ALPHA = 1 / 8  # SRTTの平滑化係数
+RTT_BETA = 1 / 4  # RTTVARの平滑化係数
+RTT_K = 4  # RTO = SRTT + K * RTTVAR
+
+
+class RttEstimator(object):
+    """コマンド応答の往復時間(RTT)を平滑化して再送タイムアウト(RTO)を計算する
+
+    Karnのアルゴリズムに従い、再送したコマンドの応答はRTTの測定に使わない。
+    タイムアウトが起きるたびにRTOを倍にし、次に有効な測定値が得られたら元に戻す。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.srtt = None  # 平滑化RTT
+        self.rttvar = None  # RTTの変動
+        self.last_rtt = None  # 直近のRTT
+        self.samples = 0  # 測定回数
+        self.retransmissions = 0  # 再送回数
+        self.timeouts = 0  # 再送しても応答がなかった回数
+        self._backoff = 1  # タイムアウト時のRTOの倍率
+
+    def update(self, rtt):
+        """RTTの測定値を反映する"""
+        with self._lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - rtt)
+                self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * rtt
+            self.last_rtt = rtt
+            self.samples += 1
+            self._backoff = 1
+
+    def rto(self):
+        """現在のRTO（秒）"""
+        with self._lock:
+            return self._rto()
+
+    def _rto(self):
+        if self.srtt is None:
+            rto = RTO_INITIAL
+        else:
+            rto = self.srtt + RTT_K * self.rttvar
+        return min(max(rto * self._backoff, RTO_MIN), RTO_MAX)
+
+    def timeout(self, attempt):
+        """attempt回目（0始まり）の送信の応答タイムアウト,再送ごとに倍にする"""
+        with self._lock:
+            return min(self._rto() * (2 ** attempt), RTO_MAX)
+
+    def note_retransmission(self):
+        with self._lock:
+            self.retransmissions += 1
+
+    def note_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+            self._backoff = min(self._backoff * 2, 64)
+
+    def stats(self):
+        """RTTの統計を返す（時間はミリ秒）"""
+        def ms(value):
+            return None if value is None else round(value * 1000, 3)
+
+        with self._lock:
+            return {
+                'srtt_ms': ms(self.srtt),
+                'rttvar_ms': ms(self.rttvar),
+                'last_rtt_ms': ms(self.last_rtt),
+                'rto_ms': ms(self._rto()),
+                'samples': self.samples,
+                'retransmissions': self.retransmissions,
+                'timeouts': self.timeouts,
+            }
@@ -0,0 +1,118 @@
+import logging #ログ出力用
+import os #ファイル操作
+import threading #スレッド関連
+import time #時間関連
+from concurrent.futures import ThreadPoolExecutor #ファイルへの書き出し用
+
+import cv2 as cv #OpenCVライブラリ
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = 'snapshot-{label}.jpg'  # ドローンごとの最新のスナップショット
+SNAPSHOT_JPEG_QUALITY = 95  # 連写したフレームのJPEG品質
+SNAPSHOT_QUEUE_LIMIT = 4  # 書き込み待ちの上限（連写は1件で数十枚になるため少なめ）
+
+
+class ErrorSnapshotBusy(Exception):
+    """書き込み待ちのスナップショットが多すぎる場合の例外"""
+
+
+class SnapshotWriter(object):
+    """スナップショットのJPEGと連写したフレームを専用のスレッドでファイルに書き込む
+
+    映像のスレッドはデータを渡すだけで、ファイルへの書き込みと連写のJPEGエンコードは待たない。
+    各メソッドは書き込んだファイルのパスのリストを返すFutureを返す。
+    add_listener()で登録した関数は、書き込みが終わるたびにファイルの情報のリストを渡されて呼ばれる（書き込みのスレッドから）。
+    """
+
+    def __init__(self, folder, label='tello'):
+        self.folder = folder
+        self.label = label  # ファイル名と情報に付ける名前（ドローンのIPアドレスなど）
+        self._listeners = []
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='snapshot-writer')
+        self._lock = threading.Lock()
+        self._pending = 0  # 書き込み待ちの件数
+        self.saved = 0  # 書き込んだファイル数
+        self.write_time = 0.0  # 書き込みにかかった時間の合計（秒）
+
+    def _submit(self, function, *args):
+        with self._lock:
+            if self._pending >= SNAPSHOT_QUEUE_LIMIT:
+                raise ErrorSnapshotBusy(f'{self._pending} snapshots pending')
+            self._pending += 1
+        return self._executor.submit(self._run, function, *args)
+
+    def add_listener(self, listener):
+        """書き込んだファイルの情報（{'path': , 'taken': , 'bytes': , 'width': , 'height': , 'kind': , 'drone': }）のリストを受け取る関数を登録する"""
+        self._listeners.append(listener)
+
+    def _run(self, function, *args):
+        started = time.perf_counter()
+        try:
+            entries = function(*args)
+        finally:
+            with self._lock:
+                self._pending -= 1
+        paths = [entry['path'] for entry in entries]
+        with self._lock:
+            self.saved += len(paths)
+            self.write_time += time.perf_counter() - started
+        logger.info({'action': 'snapshot', 'files': [os.path.basename(path) for path in paths]})
+        for listener in self._listeners:
+            try:
+                listener(entries)
+            except Exception as ex:
+                logger.error({'action': 'snapshot', 'listener': repr(listener), 'ex': ex})  # 書き込み自体は成功している
+        return paths
+
+    def _entry(self, path, taken, size, width, height, kind):
+        return {'path': path, 'taken': taken, 'bytes': size, 'width': width, 'height': height,
+                'kind': kind, 'drone': self.label}
+
+    def _name(self, taken, suffix):
+        """日時（ミリ秒まで）とドローンの名前からファイル名の元を作る。既にあれば連番を付ける（書き込みのスレッドで呼ぶ）"""
+        name = time.strftime('%Y%m%d-%H%M%S', time.localtime(taken)) + f'-{int(taken * 1000) % 1000:03d}-{self.label}'
+        unique, number = name, 1
+        while os.path.exists(os.path.join(self.folder, unique + suffix)):
+            unique, number = f'{name}-{number}', number + 1
+        return unique
+
+    def save_jpeg(self, jpeg, size=None):
+        """エンコード済みのJPEGを日時のファイル名とsnapshot-<ドローンの名前>.jpgに書き込む。sizeはJPEGの(幅, 高さ)"""
+        return self._submit(self._write_jpeg, jpeg, size, time.time())
+
+    def _write_jpeg(self, jpeg, size, taken):
+        width, height = size or (None, None)
+        name = self._name(taken, '.jpg')
+        entries = []
+        for filename, kind in ((name + '.jpg', 'snapshot'), (SNAPSHOT_FILE.format(label=self.label), 'latest')):
+            path = os.path.join(self.folder, filename)
+            with open(path, 'wb') as f:
+                f.write(jpeg)
+            entries.append(self._entry(path, taken, len(jpeg), width, height, kind))
+        return entries
+
+    def save_frames(self, frames):
+        """連写したフレーム（BGRのNumPy配列のリスト）をJPEGにエンコードして連番のファイルに書き込む"""
+        return self._submit(self._write_frames, frames, time.time())
+
+    def _write_frames(self, frames, taken):
+        name = self._name(taken, '-burst-00.jpg')
+        entries = []
+        for number, frame in enumerate(frames):
+            ok, jpeg = cv.imencode('.jpg', frame, [cv.IMWRITE_JPEG_QUALITY, SNAPSHOT_JPEG_QUALITY])
+            if not ok:
+                continue
+            path = os.path.join(self.folder, f'{name}-burst-{number:02d}.jpg')
+            with open(path, 'wb') as f:
+                f.write(jpeg.tobytes())
+            height, width = frame.shape[:2]
+            entries.append(self._entry(path, taken, len(jpeg), width, height, 'burst'))
+        return entries
+
+    def close(self):
+        self._executor.shutdown(wait=True)  # 書き込み待ちのファイルは書き終える
+
+    def stats(self):
+        with self._lock:
+            return {'pending': self._pending, 'saved': self.saved, 'write_ms': round(self.write_time * 1000, 2)}
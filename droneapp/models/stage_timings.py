@@ -0,0 +1,55 @@
+import bisect #ヒストグラムの区間の検索
+import threading #スレッド関連
+
+TIMING_SMOOTHING = 0.05  # 処理時間の移動平均の係数
+TIMING_BUCKETS_MS = (1, 2, 3, 5, 7, 10, 15, 20, 30, 50, 70, 100, 150, 200, 300, 500, 700, 1000, 2000)  # ヒストグラムの区間の上限（ミリ秒）、最後の区間はそれ以上
+TIMING_PERCENTILES = (50, 95, 99)
+
+
+class StageTimings(object):
+    """映像処理の段階ごとの処理時間（移動平均・最大・回数・ヒストグラム）
+
+    パーセンタイルはヒストグラムの区間の上限で近似する（最後の区間は最大値）。
+    """
+
+    def __init__(self, smoothing=TIMING_SMOOTHING, buckets_ms=TIMING_BUCKETS_MS):
+        self.smoothing = smoothing
+        self._bounds = [bound / 1000 for bound in buckets_ms]
+        self._labels = [f'<={bound}' for bound in buckets_ms] + [f'>{buckets_ms[-1]}']
+        self._lock = threading.Lock()
+        self._stages = {}  # 段階名 -> [回数, 移動平均（秒）, 最大（秒）, 区間ごとの回数]
+
+    def record(self, stage, seconds):
+        bucket = bisect.bisect_left(self._bounds, seconds)
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                counts = [0] * len(self._labels)
+                counts[bucket] = 1
+                self._stages[stage] = [1, seconds, seconds, counts]
+                return
+            entry[0] += 1
+            entry[1] += (seconds - entry[1]) * self.smoothing
+            if seconds > entry[2]:
+                entry[2] = seconds
+            entry[3][bucket] += 1
+
+    def _percentile(self, count, peak, counts, percentile):
+        threshold = count * percentile / 100
+        total = 0
+        for bucket, number in enumerate(counts):
+            total += number
+            if total >= threshold:
+                return min(self._bounds[bucket], peak) if bucket < len(self._bounds) else peak
+        return peak
+
+    def stats(self):
+        with self._lock:
+            stats = {}
+            for stage, (count, mean, peak, counts) in self._stages.items():
+                stats[stage] = {'count': count, 'mean_ms': round(mean * 1000, 3), 'max_ms': round(peak * 1000, 3)}
+                for percentile in TIMING_PERCENTILES:
+                    value = self._percentile(count, peak, counts, percentile)
+                    stats[stage][f'p{percentile}_ms'] = round(value * 1000, 3)
+                stats[stage]['histogram'] = {label: number for label, number in zip(self._labels, counts) if number}
+            return stats
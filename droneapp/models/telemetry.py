@@ -0,0 +1,156 @@
+import array #固定長の数値配列
+import logging #ログ出力用
+import math #NaN判定
+import socket #ソケット通信
+import threading #スレッド関連
+import time #時間関連
+
+from droneapp.models.io_loop import RECEIVE_BATCH
+
+logger = logging.getLogger(__name__)
+
+STATE_PORT = 8890  # Telloが状態パケットを送ってくるポート番号
+STATE_STALE_SECONDS = 1.0  # これより古い状態は無効とみなす（状態パケットは約10Hzで届く）
+
+# 状態パケットのフィールド（並び順が配列のレイアウトになる）
+# 例: 'mid:-1;x:0;y:0;z:0;mpry:0,0,0;pitch:0;roll:0;yaw:0;vgx:0;vgy:0;vgz:0;templ:60;temph:62;
+#      tof:10;h:0;bat:87;baro:120.45;time:0;agx:-2.00;agy:1.00;agz:-999.00;\r\n'
+STATE_FIELDS = (
+    'pitch', 'roll', 'yaw',  # 姿勢（度）
+    'vgx', 'vgy', 'vgz',  # 速度（cm/s）
+    'templ', 'temph',  # 最低・最高温度（℃）
+    'tof',  # ToFセンサーの距離（cm）
+    'h',  # 離陸地点からの高さ（cm）
+    'bat',  # バッテリー残量（%）
+    'baro',  # 気圧計の高度（m）
+    'time',  # モーター稼働時間（秒）
+    'agx', 'agy', 'agz',  # 加速度（0.001g）
+    'mid', 'x', 'y', 'z',  # ミッションパッド（EDUのみ）
+)
+FIELD_INDEX = {name: index for index, name in enumerate(STATE_FIELDS)}
+
+
+def parse_state(data, values):
+    """状態パケットを解析してvalues（STATE_FIELDSの並びの配列）に書き込み、書き込んだ数を返す"""
+    count = 0
+    for item in data.decode('ascii', errors='ignore').split(';'):
+        key, _, value = item.partition(':')
+        index = FIELD_INDEX.get(key.strip())
+        if index is None:  # mpryなど対象外のフィールド
+            continue
+        try:
+            values[index] = float(value)
+        except ValueError:
+            continue
+        count += 1
+    return count
+
+
+class TelloState(object):
+    """ある時点の状態を保持するレコード"""
+
+    __slots__ = STATE_FIELDS + ('timestamp',)
+
+    def __init__(self, values, timestamp):
+        for name, value in zip(STATE_FIELDS, values):
+            setattr(self, name, value)
+        self.timestamp = timestamp  # 受信時刻（time.time()）
+
+    def as_dict(self):
+        state = {}
+        for name in STATE_FIELDS:
+            value = getattr(self, name)
+            state[name] = None if math.isnan(value) else value
+        state['timestamp'] = self.timestamp
+        return state
+
+
+class StateReceiver(object):
+    """ポート8890の状態パケットをIOLoopで受信し、最新の値だけを固定長の配列に保持する
+
+    読み出しは配列を読むだけなので、ドローンとの往復は発生しない。
+    """
+
+    def __init__(self, host_ip='0.0.0.0', port=STATE_PORT):
+        self.host_ip = host_ip
+        self.port = port
+        self._values = array.array('d', [math.nan] * len(STATE_FIELDS))  # 最新の値
+        self._scratch = array.array('d', [math.nan] * len(STATE_FIELDS))  # 解析用の作業領域
+        self._lock = threading.Lock()
+        self.timestamp = None  # 最新の状態を受信した時刻
+        self.packets = 0  # 受信したパケット数
+        self.errors = 0  # 解析できなかったパケット数
+        self._listeners = []  # 状態を受信するたびに呼ばれる関数
+        self._datagram_listeners = []  # 受信したパケットをそのまま受け取る関数（キャプチャ用）
+        self._socket = None
+        self._io_loop = None
+
+    def open(self, io_loop):
+        """ソケットを開き、IOLoopで受信を開始する"""
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.setblocking(False)
+        self._socket.bind((self.host_ip, self.port))
+        self._io_loop = io_loop
+        io_loop.add_reader(self._socket, self._receive_state)
+
+    def close(self):
+        """受信を止めてソケットを閉じる（IOLoopのスレッドから呼ぶこと）"""
+        if self._socket is not None:
+            self._io_loop.remove_reader(self._socket)
+            self._socket.close()
+            self._socket = None
+
+    def add_listener(self, callback):
+        """状態を受信するたびにcallback(values, timestamp)を呼ぶ。valuesは再利用されるので保持しないこと"""
+        self._listeners.append(callback)
+
+    def add_datagram_listener(self, callback):
+        """状態パケットを受信するたびに、解析前のデータでcallback(data)を呼ぶ"""
+        self._datagram_listeners.append(callback)
+
+    def _receive_state(self, sock_state):
+        for _ in range(RECEIVE_BATCH):
+            try:
+                data, _ = sock_state.recvfrom(1024)
+            except BlockingIOError:
+                return  # 受信済みのデータをすべて読んだ
+            except socket.error as ex:
+                logger.error({'action': '_receive_state', 'ex': ex})
+                return
+            for callback in self._datagram_listeners:
+                callback(data)
+            self.handle_datagram(data)
+
+    def handle_datagram(self, data, timestamp=None):
+        """状態パケットを1つ解析して最新の値を更新する"""
+        if timestamp is None:
+            timestamp = time.time()
+        if parse_state(data, self._scratch) == 0:
+            self.errors += 1
+            return
+        with self._lock:
+            self._values[:] = self._scratch
+            self.timestamp = timestamp
+            self.packets += 1
+        for callback in self._listeners:
+            callback(self._scratch, timestamp)
+
+    def is_fresh(self):
+        """最新の状態が有効期限内かどうか"""
+        timestamp = self.timestamp
+        return timestamp is not None and time.time() - timestamp < STATE_STALE_SECONDS
+
+    def get(self, name, default=None):
+        """フィールドの最新値を返す。未受信・期限切れの場合はdefault"""
+        if not self.is_fresh():
+            return default
+        value = self._values[FIELD_INDEX[name]]
+        return default if math.isnan(value) else value
+
+    def latest(self):
+        """最新の状態をTelloStateで返す。未受信の場合はNone"""
+        with self._lock:
+            if self.timestamp is None:
+                return None
+            return TelloState(self._values, self.timestamp)
@@ -0,0 +1,56 @@
+import logging #ログ出力用
+import math #NaN判定・平方根
+
+from droneapp.models.telemetry import FIELD_INDEX
+
+logger = logging.getLogger(__name__)
+
+# 異常とみなす閾値
+ANOMALY_ACCELERATION = 2500  # 加速度の大きさ（0.001g）、2.5gを超えたら衝突とみなす
+ANOMALY_HEIGHT_DROP = 50  # 1回の状態パケットの間の高さの低下（cm）、約0.1秒で50cmは落下とみなす
+ANOMALY_TILT = 60  # ピッチ・ロールの傾き（度）、これを超えたら転倒とみなす
+
+_AGX, _AGY, _AGZ = FIELD_INDEX['agx'], FIELD_INDEX['agy'], FIELD_INDEX['agz']
+_HEIGHT = FIELD_INDEX['h']
+_PITCH, _ROLL = FIELD_INDEX['pitch'], FIELD_INDEX['roll']
+
+
+class TelemetryAnomalyDetector(object):
+    """状態パケットから衝突・落下・転倒を検知し、on_anomaly(種類, 値)を呼ぶ
+
+    StateReceiver.add_listener()に登録して使う（IOLoopのスレッドから呼ばれる）。
+    """
+
+    def __init__(self, on_anomaly, acceleration=ANOMALY_ACCELERATION, height_drop=ANOMALY_HEIGHT_DROP,
+                 tilt=ANOMALY_TILT):
+        self._on_anomaly = on_anomaly
+        self.acceleration = acceleration
+        self.height_drop = height_drop
+        self.tilt = tilt
+        self._last_height = math.nan
+        self._active = False  # 異常が続いている間は1回だけ通知する
+        self.anomalies = 0  # 検知した回数
+
+    def __call__(self, values, timestamp):
+        acceleration = math.sqrt(values[_AGX] ** 2 + values[_AGY] ** 2 + values[_AGZ] ** 2)
+        height = values[_HEIGHT]
+        drop = self._last_height - height
+        self._last_height = height
+        tilt = max(abs(values[_PITCH]), abs(values[_ROLL]))
+        # NaN（未受信のフィールド）との比較はFalseになる
+        if acceleration > self.acceleration:
+            self._report('acceleration', acceleration)
+        elif drop > self.height_drop:
+            self._report('height_drop', drop)
+        elif tilt > self.tilt:
+            self._report('tilt', tilt)
+        else:
+            self._active = False
+
+    def _report(self, kind, value):
+        if self._active:
+            return
+        self._active = True
+        self.anomalies += 1
+        logger.warning({'action': 'telemetry_anomaly', 'kind': kind, 'value': round(value, 1)})
+        self._on_anomaly(kind, value)
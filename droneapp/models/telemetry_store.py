@@ -0,0 +1,101 @@
+import threading #スレッド関連
+import time #時間関連
+
+import numpy as np #数値計算ライブラリ
+
+from droneapp.models.telemetry import FIELD_INDEX
+from droneapp.models.telemetry import STATE_FIELDS
+
+TELEMETRY_WINDOW_SECONDS = 600  # 保持する時間（秒）
+TELEMETRY_RATE = 10  # 状態パケットの受信頻度（Hz）
+TELEMETRY_POINTS = 300  # 範囲取得時の既定の点数
+
+
+class ErrorUnknownField(Exception): # 存在しないフィールドが指定された場合の独自例外を作成
+    """存在しないテレメトリフィールドが指定された場合の例外"""
+
+
+class TelemetryStore(object):
+    """状態パケットの全フィールドを、事前確保したNumPyのリングバッファに時系列で保持する
+
+    追加はバッファの1行を上書きするだけなので、サンプルごとにPythonオブジェクトを作らない。
+    範囲取得では指定した点数に間引き、区間ごとの最小・最大・平均を返す。
+    """
+
+    def __init__(self, seconds=TELEMETRY_WINDOW_SECONDS, rate=TELEMETRY_RATE):
+        self.capacity = int(seconds * rate)
+        self._times = np.full(self.capacity, np.nan, dtype=np.float64)  # 受信時刻
+        self._data = np.full((self.capacity, len(STATE_FIELDS)), np.nan, dtype=np.float32)  # 各フィールドの値
+        self._index = 0  # 次に書き込む行
+        self._count = 0  # 保持しているサンプル数
+        self._lock = threading.Lock()
+
+    def append(self, values, timestamp):
+        """1サンプル追加する。valuesはSTATE_FIELDSの並びの配列"""
+        with self._lock:
+            self._data[self._index] = values
+            self._times[self._index] = timestamp
+            self._index = (self._index + 1) % self.capacity
+            if self._count < self.capacity:
+                self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def _ordered(self, columns):
+        """保持しているサンプルを古い順に並べた(時刻, 値)のコピーを返す"""
+        with self._lock:
+            if self._count < self.capacity:
+                return self._times[:self._count].copy(), self._data[:self._count, columns]
+            order = np.r_[self._index:self.capacity, 0:self._index]
+            return self._times[order], self._data[order][:, columns]
+
+    def query(self, fields=STATE_FIELDS, start=None, end=None, points=TELEMETRY_POINTS):
+        """start〜end（time.time()の時刻）のサンプルをpoints点に間引いて返す
+
+        戻り値は {'t': [...], 'fields': {名前: {'min': [...], 'max': [...], 'mean': [...]}}}。
+        サンプル数がpoints以下の場合は間引かずに返す（min・max・meanは同じ値）。
+        """
+        for name in fields:
+            if name not in FIELD_INDEX:
+                raise ErrorUnknownField(name)
+        columns = [FIELD_INDEX[name] for name in fields]
+        times, data = self._ordered(columns)
+
+        if end is None:
+            end = time.time()
+        lo = 0 if start is None else np.searchsorted(times, start, side='left')
+        hi = np.searchsorted(times, end, side='right')
+        times, data = times[lo:hi], data[lo:hi].astype(np.float64)
+
+        n = len(times)
+        if n <= points:
+            return self._result(fields, times, data, data, data)
+
+        # 区間の境界（サンプル数で均等に分割）
+        edges = np.linspace(0, n, points + 1).astype(np.intp)[:-1]
+        valid = ~np.isnan(data)
+        counts = np.add.reduceat(valid, edges, axis=0)
+        sums = np.add.reduceat(np.where(valid, data, 0.0), edges, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / counts
+        mins = np.fmin.reduceat(data, edges, axis=0)
+        maxs = np.fmax.reduceat(data, edges, axis=0)
+        bucket_times = np.add.reduceat(times, edges) / np.diff(np.append(edges, n))
+        return self._result(fields, bucket_times, mins, maxs, means)
+
+    @staticmethod
+    def _result(fields, times, mins, maxs, means):
+        def to_list(column):
+            return [None if np.isnan(v) else round(float(v), 3) for v in column]
+
+        return {
+            't': [round(float(t), 3) for t in times],
+            'fields': {
+                name: {
+                    'min': to_list(mins[:, i]),
+                    'max': to_list(maxs[:, i]),
+                    'mean': to_list(means[:, i]),
+                } for i, name in enumerate(fields)
+            },
+        }
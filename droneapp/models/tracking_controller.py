@@ -0,0 +1,114 @@
+import logging #ログ出力用
+import threading #スレッド関連
+import time #時間関連
+
+logger = logging.getLogger(__name__)
+
+RC_RATE = 20  # rcコマンドの送信周期（Hz）
+DETECTION_STALE_SECONDS = 0.5  # これより古い検出結果では動かさない（速度0を送る）
+
+# 追跡の感度（不感帯はピクセル、ゲインは1ピクセルあたりのrc値）
+HORIZONTAL_DEADBAND = 40  # 水平方向の不感帯
+VERTICAL_DEADBAND = 30  # 垂直方向の不感帯
+HORIZONTAL_GAIN = 0.3  # 左右の速度ゲイン
+VERTICAL_GAIN = 0.4  # 上下の速度ゲイン
+DISTANCE_GAIN = 150  # 前後の速度ゲイン（顔の面積割合の誤差あたり）
+FACE_AREA_TARGET = 0.2  # 目標とする顔の面積割合
+FACE_AREA_DEADBAND = 0.1  # 面積割合の不感帯（0.1〜0.3の間は前後に動かない）
+
+
+def _clamp(value, limit):
+    return int(max(-limit, min(limit, value)))
+
+
+class RcTrackingController(object):
+    """最新の顔検出結果から速度指令を計算し、rc a b c d を一定周期で送る
+
+    映像のスレッドはupdate_detection()で検出結果を置くだけで、送信は専用のスレッドが行う。
+    送るのはis_active()がTrueで、検出結果が新しい間だけ。
+    検出結果が古くなったり無効になったりした場合は、速度0を一度だけ送ってその場に留まる。
+    """
+
+    def __init__(self, send_rc, frame_x, frame_y, is_active=lambda: True,
+                 rate=RC_RATE, max_speed=50):
+        self._send_rc = send_rc  # send_rc(a, b, c, d)
+        self.frame_x = frame_x
+        self.frame_y = frame_y
+        self._is_active = is_active  # Falseを返す間は送信しない（着陸中など）
+        self.period = 1.0 / rate
+        self.max_speed = max_speed  # rc値の上限（-100〜100）
+        self._detection = None  # (顔の中心X, 顔の中心Y, 顔の面積割合, 検出時刻)
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.last_rc = (0, 0, 0, 0)  # 最後に送信したrc値
+
+    def update_detection(self, face_center_x, face_center_y, percent_face, timestamp=None):
+        """最新の顔検出結果を設定する"""
+        if timestamp is None:
+            timestamp = time.monotonic()
+        self._detection = (face_center_x, face_center_y, percent_face, timestamp)
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.is_running():
+            return
+        self._stop_event.clear()
+        self._detection = None
+        self._thread = threading.Thread(target=self._run, name='rc-tracking')
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info({'action': 'rc_tracking', 'status': 'started'})
+
+    def stop(self):
+        if not self.is_running():
+            return
+        self._stop_event.set()
+        self._thread.join(timeout=1)
+        self._thread = None
+        logger.info({'action': 'rc_tracking', 'status': 'stopped'})
+
+    def compute(self, detection, now):
+        """検出結果からrc値(a: 左右, b: 前後, c: 上下, d: ヨー)を計算する"""
+        if detection is None or now - detection[3] > DETECTION_STALE_SECONDS:
+            return 0, 0, 0, 0
+        face_center_x, face_center_y, percent_face, _ = detection
+        diff_x = self.frame_x / 2 - face_center_x  # 正なら顔は中心より左
+        diff_y = self.frame_y / 2 - face_center_y  # 正なら顔は中心より上
+
+        a = b = c = 0
+        if abs(diff_x) > HORIZONTAL_DEADBAND:
+            a = _clamp(-diff_x * HORIZONTAL_GAIN, self.max_speed)  # rcのaは右が正
+        if abs(diff_y) > VERTICAL_DEADBAND:
+            c = _clamp(diff_y * VERTICAL_GAIN, self.max_speed)
+        if abs(percent_face - FACE_AREA_TARGET) > FACE_AREA_DEADBAND:
+            b = _clamp((FACE_AREA_TARGET - percent_face) * DISTANCE_GAIN, self.max_speed)
+        return a, b, c, 0
+
+    def _run(self):
+        next_tick = time.monotonic()
+        was_active = False
+        while not self._stop_event.is_set():
+            detection, now = self._detection, time.monotonic()
+            is_fresh = detection is not None and now - detection[3] <= DETECTION_STALE_SECONDS
+            if is_fresh and self._is_active():
+                self.last_rc = self.compute(detection, now)
+                self._send_rc(*self.last_rc)
+                was_active = True
+            elif was_active:
+                # 顔を見失った・追跡が無効になったら一度だけ停止指令を送る
+                self.last_rc = (0, 0, 0, 0)
+                self._send_rc(*self.last_rc)
+                was_active = False
+
+            # 処理時間に関係なく一定周期で送るため、次の送信時刻を基準に待つ
+            next_tick += self.period
+            delay = next_tick - time.monotonic()
+            if delay < 0:
+                next_tick = time.monotonic()
+                delay = 0
+            self._stop_event.wait(delay)
+
+        if was_active:
+            self._send_rc(0, 0, 0, 0)
@@ -0,0 +1,307 @@
+import collections #キュー
+import logging #ログ出力用
+import os #OS関連
+import subprocess #サブプロセス実行用
+import threading #スレッド関連
+import time #時間関連
+
+import numpy as np #数値計算ライブラリ
+
+from droneapp.models.frame_pool import FramePool
+from droneapp.models.h264 import AccessUnitSplitter
+from droneapp.models.h264 import AccessUnitStarts
+from droneapp.models.h264 import NAL_SLICE
+from droneapp.models.h264 import is_keyframe
+
+try:
+    import av  # PyAV（libavcodecのバインディング）、pyavデコーダーを使う場合のみ必要
+except ImportError:
+    av = None
+
+logger = logging.getLogger(__name__)
+
+VIDEO_DECODER_FFMPEG = 'ffmpeg'  # ffmpegのサブプロセスにパイプで渡してデコードする
+VIDEO_DECODER_PYAV = 'pyav'  # PyAVでプロセス内でデコードする
+VIDEO_DECODERS = (VIDEO_DECODER_FFMPEG, VIDEO_DECODER_PYAV)
+
+CMD_FFMPEG_DECODE = ('ffmpeg -hwaccel auto -hwaccel_device opencl -i pipe:0'
+                     ' -pix_fmt bgr24 -s {width}x{height} -f rawvideo pipe:1')
+VIDEO_PENDING_LIMIT = 1024 * 1024  # ffmpegに書き込めずに溜まった映像データの上限（バイト）、超えた分は破棄する
+VIDEO_UNIT_QUEUE = 30  # デコード待ちのアクセスユニットの上限（約1秒分）
+VIDEO_FRAME_QUEUE = 2  # 読み出し待ちのフレームの上限、読み出しが遅い場合は古いフレームを捨てる
+POOL_WAIT_TIMEOUT = 0.5  # フレームバッファの空きを待つ最大時間（秒）、停止の確認のため
+VIDEO_ARRIVAL_QUEUE = 300  # ffmpegの出力を待っているアクセスユニットの受信時刻の上限（約10秒分）
+
+
+class ErrorVideoDecoder(Exception):
+    """映像デコーダーを作成できない場合の例外"""
+
+
+def create_video_decoder(name, io_loop, width, height, stats):
+    """名前に対応する映像デコーダーを作成する"""
+    if name == VIDEO_DECODER_FFMPEG:
+        return FfmpegPipeDecoder(io_loop, width, height, stats)
+    if name == VIDEO_DECODER_PYAV:
+        if av is None:
+            raise ErrorVideoDecoder('pyavデコーダーにはPyAVが必要です（pip install av）')
+        return PyAvDecoder(width, height, stats)
+    raise ErrorVideoDecoder(f'不明な映像デコーダー: {name}')
+
+
+class FfmpegPipeDecoder(object):
+    """ffmpegのサブプロセスの標準入力にH.264を書き込み、標準出力からBGRのフレームを読む
+
+    書き込みはIOLoopのスレッドから行う。パイプが詰まったら溜めておき、書き込み可能になったら書く。
+    フレームはプールのバッファに直接読み込み、使い終わったらrelease()で返してもらう。
+    出力サイズを変更するとffmpegを起動し直す（次のキーフレームから映像が出る）。
+    ffmpegの出力にはタイムスタンプがないため、アクセスユニットの受信時刻を順に並べておき、出てきたフレームに順に対応させる
+    （ffmpegがフレームを捨てるとずれるので、データを破棄したときと起動し直したときは次のキーフレームから数え直す）。
+    """
+
+    name = VIDEO_DECODER_FFMPEG
+
+    def __init__(self, io_loop, width, height, stats):
+        self.io_loop = io_loop
+        self._stats = stats
+        self._pending = bytearray()  # ffmpegに書き込めずに溜まっている映像データ
+        self._unit_starts = AccessUnitStarts()
+        self._arrivals = collections.deque(maxlen=VIDEO_ARRIVAL_QUEUE)  # デコード待ちのアクセスユニットの受信時刻
+        self._frame_arrivals = {}  # id(フレームのバッファ) -> 受信時刻
+        self._start(width, height)
+
+    def _start(self, width, height):
+        self.width = width
+        self.height = height
+        self.pool = FramePool((height, width, 3))
+        self._waiting_keyframe = True  # ffmpegはキーフレームまでフレームを出さない
+        self._arrivals.clear()
+        command = CMD_FFMPEG_DECODE.format(width=width, height=height)
+        self.proc = subprocess.Popen(command.split(' '), stdin=subprocess.PIPE, stdout=subprocess.PIPE) #ffmpegのサブプロセスを起動
+        self.proc_stdin = self.proc.stdin #ffmpegの標準入力パイプ
+        self.proc_stdout = self.proc.stdout #ffmpegの標準出力パイプ
+        os.set_blocking(self.proc_stdin.fileno(), False)  # ffmpegが詰まってもIOLoopを止めない
+
+    def set_size(self, width, height):
+        """出力するフレームのサイズを変更する"""
+        self.io_loop.call_soon(self._restart, width, height)
+
+    def _restart(self, width, height):
+        # 書き込みと同じIOLoopのスレッドで、古いffmpegを止めて新しいサイズで起動する
+        old_proc, old_stdin = self.proc, self.proc_stdin
+        self.io_loop.remove_writer(old_stdin)
+        self._pending.clear()
+        self._start(width, height)
+        self._kill(old_proc)
+
+    def pending_bytes(self):
+        return len(self._pending)
+
+    def write(self, chunk, timestamp=None):
+        """映像データを書き込む。timestampはデータグラムの受信時刻（time.time()）。ffmpegが終了していればFalseを返す"""
+        kind = self._unit_starts.is_start(chunk)
+        if kind is not None and not (self._waiting_keyframe and kind == NAL_SLICE):
+            self._waiting_keyframe = False
+            self._arrivals.append(timestamp if timestamp is not None else time.time())
+        if self._pending:
+            if len(self._pending) + len(chunk) > VIDEO_PENDING_LIMIT:
+                self._stats.on_drop(len(chunk))
+                self._arrivals.clear()
+                self._waiting_keyframe = True
+                return True  # ffmpegが詰まっているので破棄する（次のキーフレームで復帰する）
+            self._pending += chunk
+            return True
+        try:
+            written = os.write(self.proc_stdin.fileno(), chunk)  # ffmpegの標準入力に書き込む
+        except BlockingIOError:
+            written = 0
+        except OSError as ex:
+            logger.error({'action': '_receive_video', 'ex': ex})
+            return False
+        if written < len(chunk):
+            self._stats.on_write_stall()
+            self._pending += chunk[written:]
+            self.io_loop.add_writer(self.proc_stdin, self._flush)
+        return True
+
+    def _flush(self, pipe):
+        """溜まっている映像データをffmpegに書き込む,IOLoopから呼ばれる"""
+        try:
+            written = os.write(pipe.fileno(), self._pending)
+        except BlockingIOError:
+            return
+        except OSError as ex:
+            logger.error({'action': '_receive_video', 'ex': ex})
+            written = len(self._pending)
+        del self._pending[:written]
+        if not self._pending:
+            self.io_loop.remove_writer(pipe)
+
+    def read_frame(self):
+        """次のフレームをプールのバッファに読み込んで返す。読めなかった場合はNone"""
+        pool, stdout = self.pool, self.proc_stdout  # サイズ変更で差し替えられても、読み始めたものを使う
+        frame = pool.acquire()
+        view = pool.view(frame)
+        frame_size = len(view)
+        filled = 0
+        # 途中までしか読めなかった場合は続きを読み、フレームの区切りがずれないようにする
+        while filled < frame_size:
+            try:
+                size = stdout.readinto(view[filled:] if filled else view)
+            except Exception as ex:
+                logger.error({'action': 'video_binary_generator', 'ex': ex})
+                size = 0
+            if not size:
+                # ffmpegが終了した
+                if filled:
+                    logger.warning(f'video_binary_generator: Expected {frame_size} bytes, got {filled} bytes')
+                else:
+                    logger.warning(f'video_binary_generator: No frame data received')
+                pool.release(frame)
+                return None
+            filled += size
+        try:
+            self._frame_arrivals[id(frame)] = self._arrivals.popleft()
+        except IndexError:
+            self._frame_arrivals[id(frame)] = None  # 数え直している間は分からない
+        return frame
+
+    def arrival(self, frame):
+        """フレームの最初のデータグラムを受信した時刻（time.time()）、分からなければNone"""
+        return self._frame_arrivals.get(id(frame))
+
+    def release(self, frame):
+        self.pool.release(frame)  # サイズ変更前のバッファはプールに戻らず破棄される
+
+    def close(self):
+        self.io_loop.remove_writer(self.proc_stdin)
+        self._kill(self.proc)
+
+    @staticmethod
+    def _kill(proc):
+        os.kill(proc.pid, 9)  # ffmpegプロセスを強制終了
+        try:
+            proc.wait(timeout=1)  # ゾンビプロセスを残さない
+        except subprocess.TimeoutExpired:
+            pass
+
+
+class PyAvDecoder(object):
+    """受信したH.264をアクセスユニットに分割し、PyAVでプロセス内でデコードする
+
+    IOLoopのスレッドは分割してキューに積むだけで、デコードは専用のスレッドで行う。
+    デコードが追いつかない場合は次のキーフレームまで破棄して、壊れたフレームを出さないようにする。
+    デコードしたフレームはプールのバッファに移し、使い終わったらrelease()で返してもらう。
+    アクセスユニットの最初のデータグラムの受信時刻をパケットのptsに入れ、デコードしたフレームのptsから取り出す。
+    """
+
+    name = VIDEO_DECODER_PYAV
+
+    def __init__(self, width, height, stats):
+        self.width = width
+        self.height = height
+        self._stats = stats
+        self.pool = FramePool((height, width, 3))
+        self._splitter = AccessUnitSplitter()
+        self._units = collections.deque()  # デコード待ちの(アクセスユニット, 受信時刻)
+        self._unit_received = None  # 組み立て中のアクセスユニットの最初のデータグラムの受信時刻
+        self._frame_arrivals = {}  # id(フレームのバッファ) -> 受信時刻
+        self._frames = collections.deque()  # 読み出し待ちのフレーム（VIDEO_FRAME_QUEUEまで）
+        self._condition = threading.Condition()
+        self._waiting_keyframe = True  # キーフレームが届くまではデコードしない
+        self._closed = False
+        self.decoded = 0  # デコードしたフレーム数
+        self.errors = 0  # デコードできなかったアクセスユニット数
+        self._thread = threading.Thread(target=self._run, name='pyav-decoder')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def set_size(self, width, height):
+        """出力するフレームのサイズを変更する（次にデコードしたフレームから）"""
+        with self._condition:
+            self.width = width
+            self.height = height
+            self.pool = FramePool((height, width, 3))
+
+    def pending_bytes(self):
+        with self._condition:
+            return sum(len(unit) for unit, _ in self._units)
+
+    def write(self, chunk, timestamp=None):
+        """映像データを書き込む。timestampはデータグラムの受信時刻（time.time()）"""
+        if timestamp is None:
+            timestamp = time.time()
+        if self._unit_received is None:
+            self._unit_received = timestamp
+        for unit in self._splitter.feed(chunk):
+            # アクセスユニットは次のアクセスユニットの始まりを受信したときに完成する
+            received, self._unit_received = self._unit_received, timestamp
+            if self._waiting_keyframe:
+                if not is_keyframe(unit):
+                    self._stats.on_drop(len(unit))
+                    continue
+                self._waiting_keyframe = False
+            with self._condition:
+                if len(self._units) >= VIDEO_UNIT_QUEUE:
+                    # デコードが追いつかないので溜まっている分を捨て、次のキーフレームから再開する
+                    self._stats.on_drop(sum(len(u) for u, _ in self._units) + len(unit))
+                    self._units.clear()
+                    self._waiting_keyframe = True
+                    continue
+                self._units.append((unit, received))
+                self._condition.notify_all()
+        return True
+
+    def _run(self):
+        codec = av.CodecContext.create('h264', 'r')
+        while True:
+            with self._condition:
+                while not self._units and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                unit, received = self._units.popleft()
+            packet = av.Packet(unit)
+            packet.pts = int(received * 1000000)  # マイクロ秒
+            try:
+                frames = codec.decode(packet)
+            except av.error.FFmpegError as ex:
+                self.errors += 1
+                logger.debug({'action': 'pyav_decode', 'ex': ex})
+                continue
+            for frame in frames:
+                with self._condition:
+                    width, height, pool = self.width, self.height, self.pool
+                buffer = None
+                while buffer is None:
+                    if self._closed:
+                        return
+                    buffer = pool.acquire(timeout=POOL_WAIT_TIMEOUT)
+                np.copyto(buffer, frame.to_ndarray(format='bgr24', width=width, height=height))
+                self._frame_arrivals[id(buffer)] = frame.pts / 1000000 if frame.pts is not None else None
+                with self._condition:
+                    if len(self._frames) >= VIDEO_FRAME_QUEUE:
+                        self.pool.release(self._frames.popleft())  # 読み出されなかった古いフレームを捨てる
+                    self._frames.append(buffer)
+                    self.decoded += 1
+                    self._condition.notify_all()
+
+    def read_frame(self):
+        """次のフレームを待って返す。閉じられた場合はNone"""
+        with self._condition:
+            while not self._frames and not self._closed:
+                self._condition.wait()
+            if not self._frames:
+                return None
+            return self._frames.popleft()
+
+    def arrival(self, frame):
+        """フレームの最初のデータグラムを受信した時刻（time.time()）、分からなければNone"""
+        return self._frame_arrivals.get(id(frame))
+
+    def release(self, frame):
+        self.pool.release(frame)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
@@ -0,0 +1,108 @@
+import collections #キュー
+import logging #ログ出力用
+import threading #スレッド関連
+import time #時間関連
+
+from droneapp.models.fmp4 import Fmp4Muxer
+from droneapp.models.h264 import AccessUnitSplitter
+
+logger = logging.getLogger(__name__)
+
+VIEWER_QUEUE = 60  # 視聴者ごとの送信待ちフラグメントの上限（約2秒分）、超えたら次のキーフレームまで送らない
+VIEWER_WAIT_TIMEOUT = 1.0  # 視聴者が次のフラグメントを待つ最大時間（秒）、停止の確認のため
+
+
+class _Viewer(object):
+    """視聴者ごとの送信待ちのセグメント"""
+
+    def __init__(self):
+        self.queue = collections.deque()
+        self.waiting_keyframe = True  # 次のキーフレームから（初期化セグメントを付けて）送る
+        self.dropped = 0  # 送信が追いつかず捨てたフラグメント数
+
+
+class VideoPassthrough(object):
+    """受信したH.264をデコードせずにfMP4に詰め替え、視聴者ごとに配信する
+
+    write()はIOLoopのスレッドから呼ばれ、アクセスユニットへの分割とfMP4への詰め替えだけを行う（視聴者がいなければ何もしない）。
+    視聴者は次のキーフレームから受け取り、送信が追いつかなければ次のキーフレームまで読み飛ばす。
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._viewers = []
+        self._splitter = None  # 視聴者がいる間だけ使う
+        self._muxer = Fmp4Muxer()
+        self._closed = False
+        self.fragments = 0  # 作成したフラグメント数
+        self.bytes = 0  # 作成したフラグメントのバイト数
+
+    def write(self, chunk):
+        """受信した映像データを渡す"""
+        if not self._viewers:
+            self._splitter = None
+            return
+        if self._splitter is None:
+            self._splitter = AccessUnitSplitter()  # 途中のデータは次のスタートコードまで捨てられる
+        now = time.monotonic()
+        for unit in self._splitter.feed(chunk):
+            data, keyframe, changed = self._muxer.add(unit, now)
+            if data is not None:
+                self._publish(data, keyframe, changed)
+
+    def _publish(self, data, keyframe, changed):
+        with self._condition:
+            self.fragments += 1
+            self.bytes += len(data)
+            for viewer in self._viewers:
+                if changed:
+                    viewer.waiting_keyframe = True  # 解像度などが変わったので初期化セグメントから送り直す
+                if viewer.waiting_keyframe:
+                    if not keyframe:
+                        continue
+                    viewer.waiting_keyframe = False
+                    viewer.queue.append(self._muxer.init)
+                elif len(viewer.queue) >= VIEWER_QUEUE:
+                    viewer.dropped += len(viewer.queue)
+                    viewer.queue.clear()
+                    viewer.waiting_keyframe = True
+                    continue
+                viewer.queue.append(data)
+            self._condition.notify_all()
+
+    def subscribe(self, stop_event=None):
+        """初期化セグメントとフラグメント（bytes）を順に返すジェネレータ"""
+        viewer = _Viewer()
+        with self._condition:
+            self._viewers.append(viewer)
+        logger.info({'action': 'video_passthrough', 'viewers': len(self._viewers), 'status': 'subscribed'})
+        try:
+            while not self._closed and not (stop_event is not None and stop_event.is_set()):
+                with self._condition:
+                    if not self._condition.wait_for(lambda: viewer.queue or self._closed, VIEWER_WAIT_TIMEOUT):
+                        continue
+                    if self._closed:
+                        return
+                    segments = list(viewer.queue)
+                    viewer.queue.clear()
+                for segment in segments:
+                    yield segment
+        finally:
+            with self._condition:
+                self._viewers.remove(viewer)
+            logger.info({'action': 'video_passthrough', 'viewers': len(self._viewers), 'status': 'unsubscribed'})
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'viewers': len(self._viewers),
+                'fragments': self.fragments,
+                'bytes': self.bytes,
+                'dropped': sum(viewer.dropped for viewer in self._viewers),
+                'codec': self._muxer.codec,
+            }
@@ -0,0 +1,252 @@
+import bisect #索引の二分探索
+import collections #キュー
+import glob #区間ファイルの一覧
+import logging #ログ出力用
+import os #ファイル操作
+import struct #バイナリ形式の読み書き
+import threading #スレッド関連
+import time #時間関連
+
+from droneapp.models.h264 import AccessUnitSplitter
+from droneapp.models.h264 import NAL_PPS
+from droneapp.models.h264 import NAL_SPS
+from droneapp.models.h264 import is_keyframe
+from droneapp.models.h264 import split_nals
+
+logger = logging.getLogger(__name__)
+
+# 録画は一定時間ごとの区間（NAME-0000.h264, NAME-0001.h264, ...）に分け、各区間はキーフレームから始める
+# 区間ごとに索引ファイル（.kidx）を作り、キーフレームの受信時刻と区間内の位置を記録する
+#   索引ファイル: MAGIC(8) バージョン(uint16) 予約(uint16) {時刻(float64, time.time()) 位置(uint64)}*
+# 索引は書き込みながら追記するため、途中で終了した録画もそのまま読める
+SEGMENT_SUFFIX = '.h264'
+INDEX_SUFFIX = '.kidx'
+INDEX_MAGIC = b'TELLOKIX'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<8sHH')
+INDEX_ENTRY = struct.Struct('<dQ')
+
+RECORD_SEGMENT_SECONDS = 60  # 区間の長さ（秒）、この時間を過ぎた次のキーフレームで次の区間に切り替える
+RECORD_QUEUE_LIMIT = 8 * 1024 * 1024  # 書き込み待ちの上限（バイト）、超えた分は破棄して次のキーフレームから再開する
+RECORD_FILE_BUFFER = 1024 * 1024  # ファイルの書き込みバッファ（バイト）
+READ_CHUNK = 64 * 1024  # 録画を読み出す単位（バイト）
+
+
+class ErrorInvalidRecording(Exception):
+    """録画の索引ファイルの形式が正しくない場合の例外"""
+
+
+def segment_path(prefix, number):
+    return f'{prefix}-{number:04d}{SEGMENT_SUFFIX}'
+
+
+class VideoRecorder(object):
+    """受信したH.264をデコードせずに区間ファイルに書き込む
+
+    write()はIOLoopのスレッドから呼ばれ、キューに積むだけにする。
+    アクセスユニットへの分割・キーフレームの索引付け・ファイルへの書き込みは専用のスレッドで行う。
+    """
+
+    def __init__(self, prefix, segment_seconds=RECORD_SEGMENT_SECONDS):
+        self.prefix = prefix  # 区間ファイルのパスの前半（フォルダ/名前）
+        self.segment_seconds = segment_seconds
+        self._condition = threading.Condition()
+        self._queue = collections.deque()  # (受信時刻, データ)
+        self._queued_bytes = 0
+        self._closed = False
+        self._splitter = AccessUnitSplitter()
+        self._waiting_keyframe = True  # キーフレームが届くまでは書き込まない
+        self._parameter_sets = b''  # 最後に受け取ったSPS・PPS（区間の先頭のキーフレームに含まれない場合に付ける）
+        self._segment = None  # 書き込み中の区間ファイル
+        self._index = None  # 書き込み中の索引ファイル
+        self._segment_started = 0
+        self.segments = 0  # 作成した区間数
+        self.bytes = 0  # 書き込んだバイト数
+        self.keyframes = 0  # 索引に記録したキーフレーム数
+        self.dropped_bytes = 0  # 書き込みが追いつかず破棄したバイト数
+        self._thread = threading.Thread(target=self._run, name='video-recorder')
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info({'action': 'video_recorder', 'prefix': prefix, 'status': 'started'})
+
+    def write(self, data, timestamp=None):
+        """受信した映像データを書き込み待ちに積む"""
+        if timestamp is None:
+            timestamp = time.time()
+        with self._condition:
+            if self._closed:
+                return
+            if self._queued_bytes + len(data) > RECORD_QUEUE_LIMIT:
+                self.dropped_bytes += len(data)
+                self._queue.append((timestamp, None))  # 欠落の印、次のキーフレームまで書き込まない
+                self._condition.notify()
+                return
+            self._queue.append((timestamp, data))
+            self._queued_bytes += len(data)
+            self._condition.notify()
+
+    def _run(self):
+        try:
+            while True:
+                with self._condition:
+                    self._condition.wait_for(lambda: self._queue or self._closed)
+                    if not self._queue and self._closed:
+                        break
+                    items = list(self._queue)
+                    self._queue.clear()
+                    self._queued_bytes = 0
+                for timestamp, data in items:
+                    if data is None:
+                        self._splitter = AccessUnitSplitter()
+                        self._waiting_keyframe = True
+                        continue
+                    for unit in self._splitter.feed(data):
+                        self._write_unit(unit, timestamp)
+            unit = self._splitter.flush()
+            if unit is not None:
+                self._write_unit(unit, time.time())
+        except Exception as ex:
+            logger.error({'action': 'video_recorder', 'ex': ex})
+        finally:
+            self._close_segment()
+
+    def _write_unit(self, unit, timestamp):
+        keyframe = is_keyframe(unit)
+        if keyframe:
+            parameter_sets = b''.join(b'\x00\x00\x00\x01' + nal for nal in split_nals(unit)
+                                      if nal[0] & 0x1F in (NAL_SPS, NAL_PPS))
+            if parameter_sets:
+                self._parameter_sets = parameter_sets
+            if self._segment is None or timestamp - self._segment_started >= self.segment_seconds:
+                self._open_segment(timestamp)
+                if not parameter_sets:
+                    self._segment.write(self._parameter_sets)  # 区間だけでデコードできるようにする
+                    self.bytes += len(self._parameter_sets)
+            self._waiting_keyframe = False
+            self._index.write(INDEX_ENTRY.pack(timestamp, self._segment.tell()))
+            self._index.flush()
+            self.keyframes += 1
+        if self._waiting_keyframe:
+            return
+        self._segment.write(unit)
+        self.bytes += len(unit)
+
+    def _open_segment(self, timestamp):
+        self._close_segment()
+        path = segment_path(self.prefix, self.segments)
+        self._segment = open(path, 'wb', buffering=RECORD_FILE_BUFFER)
+        self._index = open(path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX, 'wb')
+        self._index.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, 0))
+        self._segment_started = timestamp
+        self.segments += 1
+        logger.info({'action': 'video_recorder', 'segment': path})
+
+    def _close_segment(self):
+        if self._segment is None:
+            return
+        self._segment.close()
+        self._index.close()
+        self._segment = self._index = None
+
+    def close(self):
+        """書き込み待ちのデータを書き終えてから閉じる"""
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+        self._thread.join(timeout=5)
+        logger.info({'action': 'video_recorder', 'prefix': self.prefix, 'segments': self.segments,
+                     'bytes': self.bytes, 'keyframes': self.keyframes, 'dropped_bytes': self.dropped_bytes})
+
+    def stats(self):
+        with self._condition:
+            return {
+                'prefix': self.prefix,
+                'segments': self.segments,
+                'bytes': self.bytes,
+                'keyframes': self.keyframes,
+                'pending_bytes': self._queued_bytes,
+                'dropped_bytes': self.dropped_bytes,
+            }
+
+
+def read_index(path):
+    """索引ファイルを読み込み、[(時刻, 位置)]を返す。区間ファイルに書き込まれていない位置は除く"""
+    with open(path, 'rb') as f:
+        header = f.read(INDEX_HEADER.size)
+        if len(header) < INDEX_HEADER.size:
+            raise ErrorInvalidRecording(path)
+        magic, version, _ = INDEX_HEADER.unpack(header)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ErrorInvalidRecording(path)
+        data = f.read()
+    count = len(data) // INDEX_ENTRY.size  # 書き込み途中の最後の項目は除く
+    entries = [INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size) for i in range(count)]
+    segment = path[:-len(INDEX_SUFFIX)] + SEGMENT_SUFFIX
+    size = os.path.getsize(segment) if os.path.exists(segment) else 0
+    return [(timestamp, offset) for timestamp, offset in entries if offset < size]
+
+
+class RecordingReader(object):
+    """区間に分かれた録画を索引でシークして読み出す"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.segments = sorted(glob.glob(glob.escape(prefix) + '-[0-9][0-9][0-9][0-9]' + SEGMENT_SUFFIX))
+        self.keyframes = []  # (時刻, 区間の番号, 位置)
+        for number, segment in enumerate(self.segments):
+            index = segment[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+            if not os.path.exists(index):
+                logger.warning({'action': 'recording', 'segment': segment, 'status': 'no index'})
+                continue
+            self.keyframes.extend((timestamp, number, offset) for timestamp, offset in read_index(index))
+        self._times = [timestamp for timestamp, _, _ in self.keyframes]
+
+    def seek(self, timestamp):
+        """timestamp以前で最も近いキーフレームの(時刻, 区間のパス, 位置)を返す。録画が空ならNone"""
+        if not self.keyframes:
+            return None
+        position = max(bisect.bisect_right(self._times, timestamp) - 1, 0)
+        keyframe_time, number, offset = self.keyframes[position]
+        return keyframe_time, self.segments[number], offset
+
+    def read(self, start=None, end=None):
+        """startの直前のキーフレームから、endの次のキーフレームの手前までのH.264を順に返す"""
+        if not self.keyframes:
+            return
+        position = 0 if start is None else max(bisect.bisect_right(self._times, start) - 1, 0)
+        _, number, offset = self.keyframes[position]
+        stop = None  # (区間の番号, 位置)
+        if end is not None:
+            after = bisect.bisect_right(self._times, end)
+            if after < len(self.keyframes):
+                stop = self.keyframes[after][1:]
+        for current in range(number, len(self.segments)):
+            with open(self.segments[current], 'rb') as f:
+                f.seek(offset)
+                limit = stop[1] if stop is not None and stop[0] == current else None
+                while limit is None or offset < limit:
+                    data = f.read(READ_CHUNK if limit is None else min(READ_CHUNK, limit - offset))
+                    if not data:
+                        break
+                    offset += len(data)
+                    yield data
+            if stop is not None and stop[0] == current:
+                return
+            offset = 0
+
+    def summary(self):
+        """区間数・キーフレーム数・記録期間を返す"""
+        if not self.keyframes:
+            return {'prefix': self.prefix, 'segments': len(self.segments), 'keyframes': 0, 'bytes': 0,
+                    'start': None, 'end': None, 'duration': 0}
+        return {
+            'prefix': self.prefix,
+            'segments': len(self.segments),
+            'keyframes': len(self.keyframes),
+            'bytes': sum(os.path.getsize(segment) for segment in self.segments),
+            'start': self._times[0],
+            'end': self._times[-1],
+            'duration': self._times[-1] - self._times[0],
+        }
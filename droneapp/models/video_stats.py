@@ -0,0 +1,86 @@
+import logging #ログ出力用
+import time #時間関連
+
+logger = logging.getLogger(__name__)
+
+VIDEO_RATE_WINDOW = 1.0  # 受信レートを計算する区間（秒）
+VIDEO_GAP_SECONDS = 0.2  # これより長く映像データが届かなければ途切れとみなす
+VIDEO_TIMEOUT_SECONDS = 2.0  # これより長く届かなければタイムアウトとみなす
+
+
+class VideoIngestStats(object):
+    """映像データの受信状況の統計
+
+    IOLoopのスレッドからパケットごとに呼ばれるため、整数の加算と時刻の比較だけを行う。
+    log_sampleを指定すると、その数のパケットごとに1回だけデバッグログを出す（内容は出さない）。
+    """
+
+    def __init__(self, log_sample=0):
+        self.log_sample = log_sample
+        self.packets = 0  # 受信したパケット数
+        self.bytes = 0  # 受信したバイト数
+        self.gaps = 0  # VIDEO_GAP_SECONDSを超えた受信間隔の数
+        self.timeouts = 0  # VIDEO_TIMEOUT_SECONDSを超えた受信間隔の数
+        self.max_gap = 0.0  # 最大の受信間隔（秒）
+        self.write_stalls = 0  # ffmpegのパイプに書き切れなかった回数
+        self.dropped_bytes = 0  # ffmpegが詰まって破棄したバイト数
+        self.packets_per_second = 0.0
+        self.bytes_per_second = 0.0
+        self._last_packet = None  # 最後に受信した時刻
+        self._window_start = None
+        self._window_packets = 0
+        self._window_bytes = 0
+
+    def on_packet(self, size):
+        now = time.monotonic()
+        self.packets += 1
+        self.bytes += size
+        if self._last_packet is not None:
+            gap = now - self._last_packet
+            if gap > self.max_gap:
+                self.max_gap = gap
+            if gap > VIDEO_GAP_SECONDS:
+                self.gaps += 1
+                if gap > VIDEO_TIMEOUT_SECONDS:
+                    self.timeouts += 1
+        self._last_packet = now
+
+        if self._window_start is None:
+            self._window_start = now
+        self._window_packets += 1
+        self._window_bytes += size
+        elapsed = now - self._window_start
+        if elapsed >= VIDEO_RATE_WINDOW:
+            self.packets_per_second = self._window_packets / elapsed
+            self.bytes_per_second = self._window_bytes / elapsed
+            self._window_start = now
+            self._window_packets = 0
+            self._window_bytes = 0
+
+        if self.log_sample and self.packets % self.log_sample == 0 and logger.isEnabledFor(logging.DEBUG):
+            logger.debug({'action': '_receive_video', 'packets': self.packets, 'size': size,
+                          'packets_per_second': round(self.packets_per_second, 1)})
+
+    def on_write_stall(self):
+        self.write_stalls += 1
+
+    def on_drop(self, size):
+        self.dropped_bytes += size
+
+    def stats(self):
+        now = time.monotonic()
+        idle = None if self._last_packet is None else now - self._last_packet
+        receiving = idle is not None and idle < VIDEO_TIMEOUT_SECONDS
+        return {
+            'packets': self.packets,
+            'bytes': self.bytes,
+            # 受信が止まっている間は最後の区間の値ではなく0を返す
+            'packets_per_second': round(self.packets_per_second, 1) if receiving else 0.0,
+            'bytes_per_second': round(self.bytes_per_second) if receiving else 0,
+            'gaps': self.gaps,
+            'timeouts': self.timeouts,
+            'max_gap_ms': round(self.max_gap * 1000, 1),
+            'idle_ms': None if idle is None else round(idle * 1000, 1),
+            'write_stalls': self.write_stalls,
+            'dropped_bytes': self.dropped_bytes,
+        }
@@ -3,8 +3,6 @@ import sys
 
 import config #LOG_FILEを取得するために必要
 
-import droneapp.controllers.server
-
 logging.basicConfig(
     level=logging.INFO, 
     stream=sys.stdout
@@ -12,5 +10,9 @@ logging.basicConfig(
 ) #ログの基本設定、コンソールにログを出力
 
 if __name__ == '__main__':
+    # 顔検出のワーカープロセス（spawn）はこのファイルを読み込み直すため、
+    # ドローンの初期化を伴うサーバーのインポートはここで行う
+    import droneapp.controllers.server
+
     logging.info("Webサーバーを起動します")
     droneapp.controllers.server.run()  # Webサーバーを起動
\ No newline at end of file
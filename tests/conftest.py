@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+
+
+@pytest.fixture
+def simulated_drone(monkeypatch, tmp_path):
+    """tello_simulatorにつないだDroneManagerを返す（移動などは実時間の1/10で完了する）"""
+    pytest.importorskip('av')
+    from droneapp.models.drone_manager import DroneManager
+    from tello_simulator import TelloSimulator
+
+    monkeypatch.chdir(ROOT)  # スナップショットのフォルダはリポジトリからの相対パス
+    simulator = TelloSimulator(command_port=29889, time_scale=0.1, video=False)
+    simulator.start()
+    drone = DroneManager(host_ip='127.0.0.1', host_port=29890, drone_ip='127.0.0.1', drone_port=29889,
+                         state_port=29891, video_port=29892, video_decoder='pyav', detect_workers=0,
+                         preroll_folder=str(tmp_path / 'prerolls'))
+    try:
+        yield simulator, drone
+    finally:
+        drone.stop()
+        simulator.stop()
@@ -0,0 +1,81 @@
+import pytest
+
+from droneapp.models.capture import CHANNEL_COMMAND
+from droneapp.models.capture import CHANNEL_RESPONSE
+from droneapp.models.capture import CHANNEL_STATE
+from droneapp.models.capture import CHANNEL_VIDEO
+from droneapp.models.capture import CaptureReader
+from droneapp.models.capture import CaptureWriter
+from droneapp.models.capture import ErrorInvalidCapture
+
+START = 1700000000.0
+
+
+def write_capture(path, seconds=10):
+    """0.1秒ごとに状態・映像、1秒ごとにコマンドと応答を書き込み、書き込んだレコードを返す"""
+    records = []
+    with CaptureWriter(path) as writer:
+        for i in range(seconds * 10):
+            timestamp = START + i / 10
+            if i % 10 == 0:
+                records.append((timestamp, CHANNEL_COMMAND, f'cw {i}'.encode()))
+                records.append((timestamp, CHANNEL_RESPONSE, b'ok'))
+            records.append((timestamp, CHANNEL_STATE, f'h:{i};'.encode()))
+            records.append((timestamp, CHANNEL_VIDEO, bytes([i % 256]) * 1000))
+            for record in records[-4 if i % 10 == 0 else -2:]:
+                writer.write(record[1], record[2], record[0])
+    return records
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'flight.tcap')
+    records = write_capture(path)
+    with CaptureReader(path) as reader:
+        assert list(reader.records()) == records
+        assert len(reader.index) == 10  # 1秒ごと
+
+
+def test_channels(tmp_path):
+    path = str(tmp_path / 'flight.tcap')
+    records = write_capture(path)
+    with CaptureReader(path) as reader:
+        commands = list(reader.records(channels=(CHANNEL_COMMAND, CHANNEL_RESPONSE)))
+    assert commands == [record for record in records if record[1] in (CHANNEL_COMMAND, CHANNEL_RESPONSE)]
+
+
+def test_seek(tmp_path):
+    path = str(tmp_path / 'flight.tcap')
+    records = write_capture(path)
+    start, end = START + 4.55, START + 6.25
+    with CaptureReader(path) as reader:
+        assert list(reader.records(start, end)) == [record for record in records if start <= record[0] <= end]
+
+
+def test_summary(tmp_path):
+    path = str(tmp_path / 'flight.tcap')
+    write_capture(path)
+    with CaptureReader(path) as reader:
+        summary = reader.summary()
+    assert summary['duration'] == pytest.approx(9.9)
+    assert summary['channels']['video'] == {'records': 100, 'bytes': 100000}
+    assert summary['channels']['command']['records'] == 10
+
+
+def test_read_without_index(tmp_path):
+    # 書き込み途中で終了した（索引とフッターがない）ファイルも先頭から読める
+    path = str(tmp_path / 'flight.tcap')
+    writer = CaptureWriter(path)
+    writer.write(CHANNEL_STATE, b'h:0;', START)
+    writer.write(CHANNEL_STATE, b'h:1;', START + 1)
+    writer._file.flush()
+    with CaptureReader(path) as reader:
+        assert reader.index == []
+        assert [data for _, _, data in reader.records(START + 0.5)] == [b'h:1;']
+    writer.close()
+
+
+def test_invalid_file(tmp_path):
+    path = tmp_path / 'other.bin'
+    path.write_bytes(b'not a capture file')
+    with pytest.raises(ErrorInvalidCapture):
+        CaptureReader(str(path))
@@ -0,0 +1,71 @@
+from concurrent.futures import Future
+
+from droneapp.models.command_scheduler import CommandScheduler
+from droneapp.models.command_scheduler import PRIORITY_SAFETY
+from droneapp.models.command_scheduler import PRIORITY_TRACKING
+from droneapp.models.command_scheduler import PRIORITY_USER
+from droneapp.models.command_scheduler import command_priority
+
+
+def drain_commands(scheduler):
+    commands = []
+    while True:
+        item = scheduler.get(timeout=0)
+        if item is None:
+            return commands
+        commands.append(item[0])
+
+
+def test_command_priority():
+    assert command_priority('emergency') == PRIORITY_SAFETY
+    assert command_priority('land') == PRIORITY_SAFETY
+    assert command_priority('forward 30') == PRIORITY_USER
+
+
+def test_get_in_priority_order():
+    scheduler = CommandScheduler()
+    scheduler.put('land', Future(), PRIORITY_SAFETY)
+    scheduler.put('rc 0 0 0 10', Future(), PRIORITY_TRACKING)
+    scheduler.put('forward 30', Future(), PRIORITY_USER)
+    scheduler.put('cw 90', Future(), PRIORITY_USER)
+    # 同じ優先度の中では積んだ順
+    assert drain_commands(scheduler) == ['land', 'forward 30', 'cw 90', 'rc 0 0 0 10']
+
+
+def test_get_timeout():
+    assert CommandScheduler().get(timeout=0) is None
+
+
+def test_tracking_latest_wins():
+    scheduler = CommandScheduler()
+    old, new = Future(), Future()
+    scheduler.put('cw 10', old, PRIORITY_TRACKING)
+    scheduler.put('cw 20', new, PRIORITY_TRACKING)
+    assert old.cancelled()
+    assert not new.cancelled()
+    assert drain_commands(scheduler) == ['cw 20']
+    assert scheduler.stats()['classes']['tracking']['coalesced'] == 1
+
+
+def test_user_commands_are_not_coalesced():
+    scheduler = CommandScheduler()
+    first, second = Future(), Future()
+    scheduler.put('forward 30', first, PRIORITY_USER)
+    scheduler.put('forward 30', second, PRIORITY_USER)
+    assert not first.cancelled()
+    assert drain_commands(scheduler) == ['forward 30', 'forward 30']
+
+
+def test_safety_drops_tracking():
+    scheduler = CommandScheduler()
+    tracking, user = Future(), Future()
+    scheduler.put('cw 10', tracking, PRIORITY_TRACKING)
+    scheduler.put('up 20', user, PRIORITY_USER)
+    scheduler.put('emergency', Future(), PRIORITY_SAFETY)
+    assert tracking.cancelled()
+    assert not user.cancelled()
+    assert drain_commands(scheduler) == ['emergency', 'up 20']
+    stats = scheduler.stats()
+    assert stats['classes']['tracking']['dropped'] == 1
+    assert stats['max_depth'] == 2
+    assert stats['depth'] == 0
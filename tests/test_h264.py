@@ -0,0 +1,60 @@
+import random
+
+import pytest
+
+from droneapp.models.h264 import AccessUnitSplitter
+from droneapp.models.h264 import is_keyframe
+from droneapp.models.preroll import ErrorPrerollEmpty
+from droneapp.models.preroll import PrerollBuffer
+
+
+def make_stream(count=500, seed=0):
+    rng = random.Random(seed)
+    nals = []
+    for _ in range(count):
+        kind = rng.choice([0x67, 0x68, 0x65, 0x41, 0x41, 0x41, 0x09, 0x06])
+        body = bytes(rng.choice([0x00, 0x01, 0x02, 0x55, 0xaa]) for _ in range(rng.randint(1, 200)))
+        nals.append(rng.choice([b'\x00\x00\x01', b'\x00\x00\x00\x01']) + bytes([kind, 0x80]) + body)
+    return b''.join(nals)
+
+
+def split(chunks):
+    splitter = AccessUnitSplitter()
+    units = []
+    for chunk in chunks:
+        units.extend(splitter.feed(chunk))
+    unit = splitter.flush()
+    if unit is not None:
+        units.append(unit)
+    return units
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 4, 7, 1460])
+def test_splitter_independent_of_chunking(size):
+    # スタートコードがデータグラムの境界にまたがっても同じアクセスユニットに分かれる
+    stream = make_stream()
+    expected = split([stream])
+    assert b''.join(expected) == stream
+    assert split([stream[i:i + size] for i in range(0, len(stream), size)]) == expected
+
+
+def test_preroll_empty_ring(tmp_path):
+    preroll = PrerollBuffer(str(tmp_path))
+    preroll.write(b'\x00\x00\x01\x41\x80' + b'\x00\x00\x01\x41\x81', 1.0)  # キーフレームがない
+    with pytest.raises(ErrorPrerollEmpty):
+        preroll.trigger().result()
+    assert list(tmp_path.iterdir()) == []
+    preroll.close()
+
+
+def test_preroll_saves_from_keyframe(tmp_path):
+    preroll = PrerollBuffer(str(tmp_path))
+    idr = b'\x00\x00\x00\x01\x65\x88' + b'\x11' * 100
+    slice_ = b'\x00\x00\x00\x01\x41\x9a' + b'\x22' * 50
+    preroll.write(slice_ + idr + slice_ + slice_, 1.0)
+    result = preroll.trigger().result()
+    with open(result['path'], 'rb') as f:
+        data = f.read()
+    assert is_keyframe(data[:len(idr)])
+    assert data == idr + slice_  # 最後のスライスは続きが届くまで保持される
+    preroll.close()
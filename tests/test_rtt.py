@@ -0,0 +1,77 @@
+import time
+
+import pytest
+
+from droneapp.models.rtt import RTO_INITIAL
+from droneapp.models.rtt import RTO_MAX
+from droneapp.models.rtt import RTO_MIN
+from droneapp.models.rtt import RttEstimator
+
+
+def test_initial_rto():
+    assert RttEstimator().rto() == RTO_INITIAL
+
+
+def test_first_sample():
+    rtt = RttEstimator()
+    rtt.update(0.2)
+    assert rtt.srtt == pytest.approx(0.2)
+    assert rtt.rttvar == pytest.approx(0.1)
+    assert rtt.rto() == pytest.approx(0.2 + 4 * 0.1)  # SRTT + K * RTTVAR
+
+
+def test_smoothing():
+    rtt = RttEstimator()
+    rtt.update(0.2)
+    rtt.update(0.4)
+    # RFC 6298: RTTVARは更新前のSRTTとの差で更新する
+    assert rtt.rttvar == pytest.approx(0.75 * 0.1 + 0.25 * 0.2)
+    assert rtt.srtt == pytest.approx(0.875 * 0.2 + 0.125 * 0.4)
+    assert rtt.samples == 2
+
+
+def test_rto_clamped():
+    rtt = RttEstimator()
+    rtt.update(0.001)
+    assert rtt.rto() == RTO_MIN
+    rtt = RttEstimator()
+    rtt.update(10)
+    assert rtt.rto() == RTO_MAX
+
+
+def test_backoff_until_next_sample():
+    rtt = RttEstimator()
+    rtt.update(0.2)
+    rtt.note_timeout()
+    assert rtt.rto() == pytest.approx(0.6 * 2)
+    rtt.note_timeout()
+    assert rtt.rto() == pytest.approx(0.6 * 4)
+    rtt.update(0.2)  # 有効な測定値が得られたら倍率を戻す
+    assert rtt.rto() < 1.0
+    assert rtt.timeouts == 2
+
+
+def test_retransmission_timeout_doubles():
+    rtt = RttEstimator()
+    rtt.update(0.1)
+    rto = rtt.rto()
+    assert rtt.timeout(0) == pytest.approx(rto)
+    assert rtt.timeout(1) == pytest.approx(rto * 2)
+    assert rtt.timeout(10) == RTO_MAX
+
+
+def test_retransmitted_reply_is_not_sampled(simulated_drone):
+    # Karnのアルゴリズム: 再送したコマンドの応答は、どちらの送信に対する応答か分からないのでRTTに使わない
+    simulator, drone = simulated_drone
+    drone.send_command('battery?').result(timeout=2)
+    before = drone.rtt_stats()
+    simulator.latency = 0.5  # RTO（RTO_MIN）より遅く応答させて再送を起こす
+    assert drone.send_command('battery?').result(timeout=5).isdigit()
+    after = drone.rtt_stats()
+    assert after['retransmissions'] == before['retransmissions'] + 1
+    assert after['samples'] == before['samples']
+
+    simulator.latency = 0
+    time.sleep(1)  # 再送した分の重複応答を読み捨てるまで待つ
+    drone.send_command('battery?').result(timeout=2)
+    assert drone.rtt_stats()['samples'] == before['samples'] + 1
@@ -0,0 +1,30 @@
+import time
+
+import pytest
+
+from droneapp.models.drone_manager import ErrorCommandPreempted
+
+
+def test_emergency_preempts_inflight_move(simulated_drone):
+    simulator, drone = simulated_drone
+    assert drone.send_command('takeoff').result(timeout=5) == 'ok'
+
+    forward = drone.forward(5.0)  # 500cm、10cm/sで5秒（time_scale=0.1）
+    time.sleep(0.2)  # forwardの応答待ちになるまで待つ
+    started = time.monotonic()
+    emergency = drone.emergency()
+    assert emergency.result(timeout=2) == 'ok'
+    assert time.monotonic() - started < 1.0  # forwardの完了を待たない
+    with pytest.raises(ErrorCommandPreempted):
+        forward.result(timeout=0)
+    assert not simulator.drone.flying
+
+    # 打ち切ったコマンドの応答が後のコマンドの応答と取り違えられない
+    assert drone.send_command('battery?').result(timeout=2).isdigit()
+
+
+def test_emergency_without_inflight_command(simulated_drone):
+    simulator, drone = simulated_drone
+    assert drone.send_command('takeoff').result(timeout=5) == 'ok'
+    assert drone.emergency().result(timeout=2) == 'ok'
+    assert not simulator.drone.flying
@@ -0,0 +1,77 @@
+import pytest
+
+from droneapp.models.h264 import is_keyframe
+from droneapp.models.video_recorder import RecordingReader
+from droneapp.models.video_recorder import VideoRecorder
+
+START = 1700000000.0
+GOPS = 8
+FRAMES_PER_GOP = 10
+FRAME_INTERVAL = 0.1
+
+SPS_PPS = b'\x00\x00\x00\x01\x67\x42\xc0\x1e' + b'\x00\x00\x00\x01\x68\xce\x3c\x80'
+
+
+def frame(gop, number):
+    if number == 0:
+        return SPS_PPS + b'\x00\x00\x00\x01\x65' + bytes([gop + 1]) * 2000  # IDR
+    return b'\x00\x00\x00\x01\x41' + bytes([number]) * 300  # 非IDRスライス
+
+
+def record(prefix, segment_seconds):
+    """GOPS個のGOPを録画し、GOPごとのバイト列を返す"""
+    gops = []
+    recorder = VideoRecorder(prefix, segment_seconds=segment_seconds)
+    for gop in range(GOPS):
+        frames = [frame(gop, number) for number in range(FRAMES_PER_GOP)]
+        for number, data in enumerate(frames):
+            recorder.write(data, START + (gop * FRAMES_PER_GOP + number) * FRAME_INTERVAL)
+        gops.append(b''.join(frames))
+    recorder.close()
+    return gops
+
+
+def test_round_trip(tmp_path):
+    prefix = str(tmp_path / 'flight')
+    gops = record(prefix, segment_seconds=60)
+    reader = RecordingReader(prefix)
+    assert len(reader.segments) == 1
+    assert len(reader.keyframes) == GOPS
+    assert b''.join(reader.read()) == b''.join(gops)
+
+
+def test_segments(tmp_path):
+    prefix = str(tmp_path / 'flight')
+    gops = record(prefix, segment_seconds=2.5)
+    reader = RecordingReader(prefix)
+    assert len(reader.segments) == 3  # GOPは1秒ごとなので、0・3・6番目のGOPで区間を切り替える
+    assert b''.join(reader.read()) == b''.join(gops)
+    summary = reader.summary()
+    assert summary['keyframes'] == GOPS
+    assert summary['duration'] == pytest.approx(GOPS - 1)
+
+
+def test_seek(tmp_path):
+    prefix = str(tmp_path / 'flight')
+    record(prefix, segment_seconds=2.5)
+    reader = RecordingReader(prefix)
+    keyframe_time, segment, offset = reader.seek(START + 4.55)
+    assert keyframe_time <= START + 4.55 < keyframe_time + 1
+    with open(segment, 'rb') as f:
+        f.seek(offset)
+        assert is_keyframe(f.read(2100))
+    assert reader.seek(START - 10)[0] == reader.keyframes[0][0]  # 録画の前なら最初のキーフレーム
+
+
+def test_read_range_across_segments(tmp_path):
+    prefix = str(tmp_path / 'flight')
+    gops = record(prefix, segment_seconds=2.5)
+    reader = RecordingReader(prefix)
+    # startを含むGOPから、endを含むGOPの終わりまで（2番目と3番目のGOPは別の区間）
+    assert b''.join(reader.read(START + 2.55, START + 3.55)) == gops[2] + gops[3]
+
+
+def test_empty_recording(tmp_path):
+    reader = RecordingReader(str(tmp_path / 'missing'))
+    assert reader.seek(START) is None
+    assert list(reader.read()) == []
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+DroneManagerのコマンド経路のベンチマーク
+
+ローカルのTelloシミュレータに対してsend_command・move・clockwiseを指定したレートで送り、
+コマンド応答時間のp50/p95/p99、秒間コマンド数、スレッド数、メモリ使用量をJSONで保存する。
+
+    python tools/benchmark_commands.py --rates 0,20,50,100 --count 500 --output bench.json
+
+レート0は、前のコマンドの応答を待ってから次を送る（最大スループットの測定）。
+moveとrotateを送る場合は、最初に離陸し、最後に着陸する（飛行中でなければシミュレータはエラーを返す）。
+'ok'以外の応答（queryは'error'で始まる応答）は失敗として数え、応答時間には含めない。
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from droneapp.models.drone_manager import DroneManager
+from tello_simulator import TelloSimulator
+
+logger = logging.getLogger(__name__)
+
+MIXES = ('query', 'move', 'rotate')  # 送信するコマンドの種類
+FLYING_MIXES = ('move', 'rotate')  # 飛行中でなければ実行できないコマンドの種類
+
+
+def percentile(sorted_values, p):
+    """ソート済みのリストのパーセンタイル（線形補間）"""
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def memory_rss_kb():
+    """現在の常駐メモリ（KB）。/procがない環境では最大常駐メモリ"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def issue(drone, kind):
+    """種類に応じたコマンドを送り、Futureを返す"""
+    if kind == 'query':
+        return drone.send_command('battery?')
+    if kind == 'move':
+        return drone.move('forward', 0.3)
+    return drone.clockwise(90)
+
+
+def is_success(kind, response):
+    """応答が成功かどうか。queryは値を返すので'error'で始まらなければ成功"""
+    if kind == 'query':
+        return not response.startswith('error')
+    return response == 'ok'
+
+
+def run_rate(drone, rate, count, mix):
+    """指定したレートでcount個のコマンドを送り、結果を返す"""
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+    done = threading.Event()
+    remaining = [count]
+    peak_threads = threading.active_count()
+
+    def on_done(future, kind, submitted_at):
+        elapsed = time.perf_counter() - submitted_at
+        with lock:
+            if future.cancelled() or future.exception() is not None or not is_success(kind, future.result()):
+                failures[0] += 1
+            else:
+                latencies.append(elapsed)
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                done.set()
+
+    started = time.perf_counter()
+    for i in range(count):
+        if rate > 0:
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        submitted_at = time.perf_counter()
+        kind = mix[i % len(mix)]
+        future = issue(drone, kind)
+        future.add_done_callback(lambda f, k=kind, t=submitted_at: on_done(f, k, t))
+        if rate == 0:
+            done_event = threading.Event()
+            future.add_done_callback(lambda f: done_event.set())
+            done_event.wait()
+        peak_threads = max(peak_threads, threading.active_count())
+    done.wait()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return {
+        'rate': rate,
+        'count': count,
+        'completed': len(latencies),
+        'failed': failures[0],
+        'elapsed_s': round(elapsed, 3),
+        'commands_per_s': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'latency_ms': {
+            'p50': ms(percentile(latencies, 50)),
+            'p95': ms(percentile(latencies, 95)),
+            'p99': ms(percentile(latencies, 99)),
+            'max': ms(latencies[-1] if latencies else None),
+        },
+        'threads_peak': peak_threads,
+        'memory_rss_kb': memory_rss_kb(),
+        'rtt': drone.rtt_stats(),
+        'scheduler': drone.command_stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DroneManagerのコマンド経路のベンチマーク')
+    parser.add_argument('--rates', default='0,20,50,100', help='コマンドレート（/秒）のカンマ区切り、0は応答待ちで連続送信')
+    parser.add_argument('--count', type=int, default=300, help='レートごとのコマンド数')
+    parser.add_argument('--mix', default=','.join(MIXES), help=f'送信するコマンドの種類 {MIXES}')
+    parser.add_argument('--latency', type=float, default=0.0, help='シミュレータの応答遅延（秒）')
+    parser.add_argument('--jitter', type=float, default=0.0, help='シミュレータの遅延のゆらぎ（秒）')
+    parser.add_argument('--loss', type=float, default=0.0, help='シミュレータの損失率')
+    parser.add_argument('--port', type=int, default=28889, help='シミュレータのコマンドポート（ホスト側は+1〜+3を使う）')
+    parser.add_argument('--output', default=None, help='結果のJSONファイル（省略時は標準出力のみ）')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
+    rates = [float(r) for r in args.rates.split(',')]
+    mix = [m for m in args.mix.split(',') if m in MIXES]
+
+    simulator = TelloSimulator(command_port=args.port, latency=args.latency, jitter=args.jitter,
+                               loss=args.loss, time_scale=0, video=False, seed=0)
+    simulator.start()
+    baseline = {'threads': threading.active_count(), 'memory_rss_kb': memory_rss_kb()}
+    drone = DroneManager(host_ip='127.0.0.1', host_port=args.port + 1,
+                         drone_ip='127.0.0.1', drone_port=args.port,
+                         state_port=args.port + 2, video_port=args.port + 3)
+    flying = any(kind in FLYING_MIXES for kind in mix)
+    try:
+        drone.send_command('command').result()  # 初期化コマンドの完了を待つ
+        if flying:
+            response = drone.send_command('takeoff').result()
+            if response != 'ok':
+                raise SystemExit(f'離陸に失敗しました: {response}')
+        results = []
+        for rate in rates:
+            result = run_rate(drone, rate, args.count, mix)
+            results.append(result)
+            print(f"rate={rate:g}/s: {result['commands_per_s']} cmd/s, "
+                  f"p50={result['latency_ms']['p50']}ms p95={result['latency_ms']['p95']}ms "
+                  f"p99={result['latency_ms']['p99']}ms, threads={result['threads_peak']}, "
+                  f"rss={result['memory_rss_kb']}KB, failed={result['failed']}")
+    finally:
+        if flying:
+            drone.send_command('land').result()
+        drone.stop()
+        simulator.stop()
+
+    report = {
+        'benchmark': 'commands',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': vars(args),
+        'baseline': baseline,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"結果を保存しました: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
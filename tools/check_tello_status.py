@@ -1,7 +1,15 @@
 #!/usr/bin/env python3
+import array
+import math
+import os
 import socket
+import sys
 import time
 
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from droneapp.models.telemetry import STATE_FIELDS, STATE_PORT, parse_state
+
 def check_tello_status():
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.settimeout(10)
@@ -16,10 +24,8 @@ def check_tello_status():
             'battery?',     # バッテリー残量
             'speed?',       # 現在の速度
             'time?',        # 飛行時間
-            'height?',      # 現在の高度
-            'temp?',        # 温度
-            'attitude?',    # 姿勢情報
         ]
+        # 高度・温度・姿勢は問い合わせずに状態パケット（ポート8890）から読む
         
         for cmd in commands:
             print(f"送信: {cmd}")
@@ -40,22 +46,41 @@ def check_tello_status():
                     else:
                         print(f"✅ バッテリー残量: {battery}%")
                         
-                elif cmd == 'height?' and decoded.isdigit():
-                    height = int(decoded)
-                    if height == 0:
-                        print("✅ ドローンは地上にいます")
-                    else:
-                        print(f"⚠️  ドローンは高度 {height}cm で浮遊中")
-                        
+
             except socket.timeout:
                 print(f"タイムアウト: {cmd} への応答なし")
             except Exception as e:
                 print(f"エラー: {e}")
                 
             time.sleep(1)
+
+        check_tello_state()
             
     finally:
         sock.close()
 
+def check_tello_state():
+    """状態パケットを1つ受信して高度・温度・姿勢を表示する"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock_state:
+        sock_state.settimeout(3)
+        sock_state.bind(('0.0.0.0', STATE_PORT))
+        try:
+            data, addr = sock_state.recvfrom(1024)
+        except socket.timeout:
+            print(f"タイムアウト: ポート{STATE_PORT}に状態パケットが届きません")
+            return
+
+    values = array.array('d', [math.nan] * len(STATE_FIELDS))
+    parse_state(data, values)
+    state = dict(zip(STATE_FIELDS, values))
+    print(f"姿勢: pitch={state['pitch']:.0f} roll={state['roll']:.0f} yaw={state['yaw']:.0f}")
+    print(f"温度: {state['templ']:.0f}〜{state['temph']:.0f}℃")
+
+    height = state['h']
+    if height == 0:
+        print("✅ ドローンは地上にいます")
+    else:
+        print(f"⚠️  ドローンは高度 {height:.0f}cm で浮遊中")
+
 if __name__ == "__main__":
     check_tello_status()
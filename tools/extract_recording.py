@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+録画の切り出し
+
+DroneManager.start_recording()（/api/recording/start）で録画した区間ファイルから、
+キーフレームの索引を使って指定した時刻の映像をH.264のまま切り出す（デコード・再エンコードはしない）。
+切り出しはキーフレーム単位なので、開始は指定時刻の直前のキーフレーム、終了は直後のキーフレームになる。
+
+    python tools/extract_recording.py recordings/20240101-120000-192.168.10.1 --info
+    python tools/extract_recording.py recordings/20240101-120000-192.168.10.1 --start 1830 --duration 10 -o clip.h264
+    ffmpeg -r 30 -i clip.h264 -c copy clip.mp4  # MP4にする場合
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from droneapp.models.video_recorder import RecordingReader
+
+
+def main():
+    parser = argparse.ArgumentParser(description='録画からキーフレーム単位で映像を切り出す')
+    parser.add_argument('prefix', help='録画の名前（区間ファイルの-0000.h264より前の部分）')
+    parser.add_argument('--info', action='store_true', help='録画の概要を表示して終了')
+    parser.add_argument('--start', type=float, default=0, help='切り出し開始位置（録画開始からの秒数）')
+    parser.add_argument('--duration', type=float, default=None, help='切り出す長さ（秒）、省略すると最後まで')
+    parser.add_argument('-o', '--output', default=None, help='出力ファイル（H.264）')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    reader = RecordingReader(args.prefix)
+    summary = reader.summary()
+    if args.info or not args.output:
+        summary['index_ms'] = round((time.perf_counter() - started) * 1000, 3)
+        print(json.dumps(summary, indent=2))
+        return
+    if summary['start'] is None:
+        sys.exit(f'録画が見つかりません: {args.prefix}')
+
+    start = summary['start'] + args.start
+    end = start + args.duration if args.duration is not None else None
+    keyframe_time, segment, offset = reader.seek(start)
+    seek_ms = (time.perf_counter() - started) * 1000
+    written = 0
+    with open(args.output, 'wb') as f:
+        for data in reader.read(start, end):
+            f.write(data)
+            written += len(data)
+    print(json.dumps({
+        'output': args.output,
+        'bytes': written,
+        'keyframe': round(keyframe_time - summary['start'], 3),
+        'segment': os.path.basename(segment),
+        'offset': offset,
+        'seek_ms': round(seek_ms, 3),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
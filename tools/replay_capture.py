@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+キャプチャファイルの再生
+
+DroneManager.start_capture()（/api/capture/start）で記録したコマンド応答・状態・映像のデータグラムを、
+元の時間間隔（または倍速）でDroneManagerに流し込み、フレームレートやフレーム処理時間、追跡の出力を計測する。
+ドローンは不要で、コマンドはどこにも届かない宛先に送られる。
+
+    python tools/replay_capture.py flight.tcap --info
+    python tools/replay_capture.py flight.tcap --speed 2 --detect --output replay.json
+    python tools/replay_capture.py flight.tcap --decoder pyav  # デコーダーの比較
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from droneapp.models.capture import CaptureReader
+from droneapp.models.capture import CaptureReplayer
+from droneapp.models.drone_manager import DroneManager
+from droneapp.models.face_detector import DETECT_WORKERS
+from droneapp.models.face_tracker import DETECT_INTERVAL
+from droneapp.models.face_tracker import FACE_TRACKER_FLOW
+from droneapp.models.face_tracker import FACE_TRACKERS
+from droneapp.models.video_decoder import VIDEO_DECODER_FFMPEG
+from droneapp.models.video_decoder import VIDEO_DECODERS
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def consume_frames(drone, stop_event, frames):
+    """映像の処理結果を読み続け、フレームごとの時刻と追跡の出力を記録する"""
+    for _ in drone.video_jpeg_generator():
+        frames.append((time.monotonic(), drone._rc_controller.last_rc))
+        if stop_event.is_set():
+            return
+
+
+def main():
+    parser = argparse.ArgumentParser(description='キャプチャファイルを再生してDroneManagerの処理を計測する')
+    parser.add_argument('capture', help='キャプチャファイル')
+    parser.add_argument('--info', action='store_true', help='記録内容の概要を表示して終了')
+    parser.add_argument('--speed', type=float, default=1.0, help='再生速度（0は待たずに流す）')
+    parser.add_argument('--start', type=float, default=None, help='再生開始位置（記録開始からの秒数）')
+    parser.add_argument('--end', type=float, default=None, help='再生終了位置（記録開始からの秒数）')
+    parser.add_argument('--decoder', default=VIDEO_DECODER_FFMPEG, choices=VIDEO_DECODERS, help='映像デコーダー')
+    parser.add_argument('--detect', action='store_true', help='顔検出と追跡を有効にして再生する')
+    parser.add_argument('--detect-workers', type=int, default=DETECT_WORKERS,
+                        help='顔検出のワーカープロセス数（0はストリーミングのスレッドで検出）')
+    parser.add_argument('--detect-interval', type=int, default=DETECT_INTERVAL,
+                        help='顔検出のフレーム間隔（間のフレームは追跡器で追う）')
+    parser.add_argument('--tracker', default=FACE_TRACKER_FLOW, choices=FACE_TRACKERS, help='検出の合間に使う追跡器')
+    parser.add_argument('--port', type=int, default=38889, help='DroneManagerが使うポート（+1〜+2も使う）')
+    parser.add_argument('--output', default=None, help='結果のJSONファイル')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
+
+    reader = CaptureReader(args.capture)
+    summary = reader.summary()
+    if args.info:
+        print(json.dumps(summary, indent=2))
+        return
+
+    first = summary['start'] or 0
+    start = first + args.start if args.start is not None else None
+    end = first + args.end if args.end is not None else None
+
+    # コマンドの送信先は誰も受信していないポートにする（応答は記録から流し込む）
+    drone = DroneManager(host_ip='127.0.0.1', host_port=args.port,
+                         drone_ip='127.0.0.1', drone_port=args.port + 3,
+                         state_port=args.port + 1, video_port=args.port + 2,
+                         video_decoder=args.decoder, detect_workers=args.detect_workers,
+                         detect_interval=args.detect_interval, face_tracker=args.tracker)
+    if args.detect:
+        drone.enable_face_detect()
+
+    frames = []
+    stop_event = threading.Event()
+    consumer = threading.Thread(target=consume_frames, args=(drone, stop_event, frames), daemon=True)
+    consumer.start()
+
+    replayer = CaptureReplayer(reader, drone, speed=args.speed, start=start, end=end)
+    started = time.monotonic()
+    usage_before = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    try:
+        replayed = replayer.run()
+        time.sleep(1)  # ffmpegに残っているフレームを待つ
+    except KeyboardInterrupt:
+        replayer.stop()
+        replayed = replayer.replayed
+    finally:
+        stop_event.set()
+        drone.stop()
+        reader.close()
+    elapsed = time.monotonic() - started
+    usage_after = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    # CPU時間（ffmpegのサブプロセスは終了後に子プロセスの分として計上される）
+    cpu = sum(after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime
+              for before, after in zip(usage_before, usage_after))
+
+    intervals = sorted(b[0] - a[0] for a, b in zip(frames, frames[1:]))
+    ms = lambda v: None if v is None else round(v * 1000, 2)
+    result = {
+        'capture': summary,
+        'speed': args.speed,
+        'decoder': args.decoder,
+        'cpu_s': round(cpu, 3),
+        'elapsed_s': round(elapsed, 3),
+        'replayed': replayed,
+        'max_lag_ms': ms(replayer.lag),
+        'frames': len(frames),
+        'fps': round(len(frames) / elapsed, 2) if elapsed else None,
+        'frame_interval_ms': {
+            'p50': ms(percentile(intervals, 50)),
+            'p95': ms(percentile(intervals, 95)),
+            'max': ms(intervals[-1] if intervals else None),
+        },
+        'tracking_frames': sum(1 for _, rc in frames if rc != (0, 0, 0, 0)),
+        'state_packets': drone._state_receiver.packets,
+        'video': drone.video_stats(),
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""
+ローカルで動くTelloシミュレータ
+
+コマンド(8889)に応答し、状態パケット(8890)と合成したH.264映像(11111)を送信する。
+DroneManagerのdrone_ipを127.0.0.1にすれば、実機なしで動作確認や性能測定ができる。
+
+    python tools/tello_simulator.py --latency 0.02 --jitter 0.005 --loss 0.01
+"""
+import argparse
+import heapq
+import logging
+import os
+import queue
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import cv2 as cv
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from droneapp.models.h264 import AccessUnitSplitter
+
+logger = logging.getLogger(__name__)
+
+COMMAND_PORT = 8889
+STATE_PORT = 8890
+VIDEO_PORT = 11111
+VIDEO_PACKET_SIZE = 1460  # Telloと同じく1フレームをこの大きさのデータグラムに分割して送る
+STATE_RATE = 10  # 状態パケットの送信頻度（Hz）
+FACE_IMAGE = os.path.join(os.path.dirname(__file__), 'image.jpg')  # 映像内を動き回る画像
+
+CMD_FFMPEG_ENCODE = ('ffmpeg -loglevel error -f rawvideo -pix_fmt bgr24 -s {width}x{height} -r {fps} -i pipe:0'
+                     ' -c:v libx264 -preset ultrafast -tune zerolatency -g {gop} -bf 0 -x264-params repeat-headers=1'
+                     ' -pix_fmt yuv420p -f h264 pipe:1')  # 生成したフレームをH.264にエンコードする
+
+
+class SimulatedDrone(object):
+    """シミュレータ内部のドローンの状態"""
+
+    def __init__(self):
+        self.flying = False
+        self.height = 0  # cm
+        self.yaw = 0  # 度
+        self.speed = 10  # cm/s
+        self.battery = 100.0  # %
+        self.flight_time = 0.0  # 秒
+        self.rc = (0, 0, 0, 0)
+        self.stream_on = False
+        self.started_at = time.time()
+
+    def tick(self, dt):
+        if self.flying:
+            self.flight_time += dt
+            self.battery = max(self.battery - dt / 30, 0)  # 30秒で1%減る
+            self.height = max(20, self.height + self.rc[2] * dt)
+            self.yaw = (self.yaw + self.rc[3] * dt + 180) % 360 - 180
+
+    def state_string(self):
+        vgx, vgy = self.rc[1] / 10, self.rc[0] / 10
+        temp = 60 + int(self.flight_time / 60)
+        return (f'mid:-1;x:0;y:0;z:0;mpry:0,0,0;pitch:0;roll:0;yaw:{int(self.yaw)};'
+                f'vgx:{vgx:.0f};vgy:{vgy:.0f};vgz:0;templ:{temp};temph:{temp + 2};'
+                f'tof:{int(self.height) + 10};h:{int(self.height)};bat:{int(self.battery)};'
+                f'baro:{100 + self.height / 100:.2f};time:{int(self.flight_time)};'
+                f'agx:0.00;agy:0.00;agz:-1000.00;\r\n')
+
+
+class TelloSimulator(object):
+    """Tello SDKのコマンド・状態・映像を模擬するサーバー"""
+
+    def __init__(self, host='127.0.0.1', command_port=COMMAND_PORT,
+                 latency=0.0, jitter=0.0, loss=0.0, time_scale=1.0,
+                 video=True, fps=30, width=960, height=720, gop=30,
+                 seed=None):
+        self.host = host
+        self.command_port = command_port
+        self.latency = latency  # 応答の遅延（秒）
+        self.jitter = jitter  # 遅延のゆらぎ（秒、±）
+        self.loss = loss  # コマンド・応答それぞれが失われる確率
+        self.time_scale = time_scale  # 移動・離陸などにかかる時間の倍率（0で即時）
+        self.video = video
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.gop = gop
+        self._random = random.Random(seed)
+
+        self.drone = SimulatedDrone()
+        self.client = None  # 最後にコマンドを送ってきたアドレス
+        self.state_port = STATE_PORT
+        self.video_port = VIDEO_PORT
+
+        self.commands = 0  # 受信したコマンド数
+        self.dropped = 0  # 損失させたコマンド・応答の数
+
+        self._stop_event = threading.Event()
+        self._commands = queue.Queue()  # 実行待ちのコマンド
+        self._interrupt = threading.Event()  # emergencyで実行中の移動などを中断する
+        self._replies = []  # (送信時刻, 連番, データ, アドレス)のヒープ
+        self._replies_lock = threading.Condition()
+        self._sequence = 0
+        self._threads = []
+        self._ffmpeg = None
+        self._sock = None
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.settimeout(0.5)
+        self._sock.bind((self.host, self.command_port))
+        for target in (self._receive_commands, self._execute_commands, self._send_replies, self._send_state):
+            thread = threading.Thread(target=target, name=f'sim-{target.__name__}')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        logger.info({'action': 'simulator', 'status': 'started', 'address': (self.host, self.command_port)})
+
+    def stop(self):
+        self._stop_event.set()
+        self._stop_video()
+        with self._replies_lock:
+            self._replies_lock.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=2)
+        if self._sock is not None:
+            self._sock.close()
+
+    def _is_lost(self):
+        if self.loss and self._random.random() < self.loss:
+            self.dropped += 1
+            return True
+        return False
+
+    def _receive_commands(self):
+        while not self._stop_event.is_set():
+            try:
+                data, addr = self._sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self.commands += 1
+            if self._is_lost():
+                continue
+            self.client = addr
+            command = data.decode('utf-8', errors='replace').strip()
+            if command == 'emergency':
+                # Telloと同じく、emergencyは実行中のコマンドを待たずにすぐ実行する
+                self._interrupt.set()
+                reply, _ = self._execute(command)
+                self._reply(reply, addr)
+                continue
+            self._commands.put((command, addr))
+
+    def _execute_commands(self):
+        # Telloと同じく、コマンドは1つずつ順番に実行する
+        while not self._stop_event.is_set():
+            try:
+                command, addr = self._commands.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self._interrupt.clear()
+            reply, duration = self._execute(command)
+            if duration and self.time_scale:
+                deadline = time.monotonic() + duration * self.time_scale
+                while not self._stop_event.is_set() and time.monotonic() < deadline:
+                    if self._interrupt.wait(min(deadline - time.monotonic(), 0.5)):
+                        reply = None  # emergencyで中断したコマンドには応答しない
+                        break
+            if reply is not None:
+                self._reply(reply, addr)
+
+    def _reply(self, reply, addr):
+        if self._is_lost():
+            return
+        delay = max(self.latency + self._random.uniform(-self.jitter, self.jitter), 0)
+        with self._replies_lock:
+            self._sequence += 1
+            heapq.heappush(self._replies, (time.monotonic() + delay, self._sequence, reply.encode('utf-8'), addr))
+            self._replies_lock.notify()
+
+    def _send_replies(self):
+        while not self._stop_event.is_set():
+            with self._replies_lock:
+                if not self._replies:
+                    self._replies_lock.wait(0.5)
+                    continue
+                due, _, data, addr = self._replies[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self._replies_lock.wait(wait)
+                    continue
+                heapq.heappop(self._replies)
+            try:
+                self._sock.sendto(data, addr)
+            except OSError:
+                break
+
+    def _execute(self, command):
+        """コマンドを実行して(応答, 所要時間)を返す。応答がNoneなら返信しない"""
+        drone = self.drone
+        args = command.split(' ')
+        name = args[0]
+        if name.endswith('?'):
+            return self._query(name), 0
+        if name == 'command':
+            return 'ok', 0
+        if name == 'rc':
+            try:
+                drone.rc = tuple(int(v) for v in args[1:5])
+            except ValueError:
+                pass
+            return None, 0  # rcには応答しない
+        if name == 'streamon':
+            drone.stream_on = True
+            self._start_video()
+            return 'ok', 0
+        if name == 'streamoff':
+            drone.stream_on = False
+            self._stop_video()
+            return 'ok', 0
+        if name == 'port' and len(args) == 3:
+            self.state_port, self.video_port = int(args[1]), int(args[2])
+            return 'ok', 0
+        if name == 'speed' and len(args) == 2:
+            drone.speed = int(args[1])
+            return 'ok', 0
+        if name == 'emergency':
+            drone.flying, drone.height = False, 0
+            return 'ok', 0
+        if name == 'takeoff':
+            if drone.battery < 10:
+                return 'error', 0
+            drone.flying, drone.height = True, 80
+            return 'ok', 2.0
+        if name == 'land':
+            drone.flying, drone.height = False, 0
+            return 'ok', 2.0
+        if not drone.flying:
+            return 'error Not joystick', 0
+        if name in ('up', 'down', 'left', 'right', 'forward', 'back') and len(args) == 2:
+            distance = int(args[1])
+            if name == 'up':
+                drone.height += distance
+            if name == 'down':
+                drone.height = max(20, drone.height - distance)
+            return 'ok', distance / max(drone.speed, 1)
+        if name in ('cw', 'ccw') and len(args) == 2:
+            degree = int(args[1])
+            drone.yaw = (drone.yaw + (degree if name == 'cw' else -degree) + 180) % 360 - 180
+            return 'ok', degree / 90
+        if name == 'flip':
+            return 'ok', 1.0
+        if name == 'go' and len(args) == 5:
+            x, y, z, speed = (int(v) for v in args[1:])
+            drone.height = max(20, drone.height + z)
+            return 'ok', (x * x + y * y + z * z) ** 0.5 / max(speed, 1)
+        return 'error', 0
+
+    def _query(self, name):
+        drone = self.drone
+        answers = {
+            'battery?': f'{int(drone.battery)}',
+            'speed?': f'{drone.speed:.1f}',
+            'time?': f'{int(drone.flight_time)}s',
+            'height?': f'{int(drone.height) // 10}dm',
+            'temp?': '60~62C',
+            'attitude?': f'pitch:0;roll:0;yaw:{int(drone.yaw)};',
+            'baro?': f'{100 + drone.height / 100:.2f}',
+            'tof?': f'{int(drone.height) * 10 + 100}mm',
+            'wifi?': '90',
+            'sdk?': '30',
+            'sn?': 'SIMULATOR0001',
+        }
+        return answers.get(name, 'error')
+
+    def _send_state(self):
+        period = 1.0 / STATE_RATE
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock_state:
+            while not self._stop_event.wait(period):
+                self.drone.tick(period)
+                if self.client is None:
+                    continue  # まだコマンドを受け取っていない
+                try:
+                    sock_state.sendto(self.drone.state_string().encode('ascii'), (self.client[0], self.state_port))
+                except OSError as ex:
+                    logger.error({'action': '_send_state', 'ex': ex})
+
+    def _start_video(self):
+        if not self.video or self._ffmpeg is not None:
+            return
+        command = CMD_FFMPEG_ENCODE.format(width=self.width, height=self.height, fps=self.fps, gop=self.gop)
+        try:
+            self._ffmpeg = subprocess.Popen(command.split(' '), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except OSError as ex:
+            logger.error({'action': '_start_video', 'ex': ex, 'status': 'ffmpeg not started'})
+            return
+        for target in (self._generate_frames, self._send_video):
+            thread = threading.Thread(target=target, args=(self._ffmpeg, ), name=f'sim-{target.__name__}')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _stop_video(self):
+        if self._ffmpeg is not None:
+            self._ffmpeg.kill()
+            self._ffmpeg = None
+
+    def _generate_frames(self, ffmpeg):
+        """動く画像と送信時刻を描いたフレームを一定周期でffmpegに渡す"""
+        face = cv.imread(FACE_IMAGE)
+        background = np.zeros((self.height, self.width, 3), np.uint8)
+        background[:] = np.linspace(40, 120, self.width, dtype=np.uint8)[None, :, None]
+        period = 1.0 / self.fps
+        next_tick = time.monotonic()
+        frame_number = 0
+        while not self._stop_event.is_set() and ffmpeg.poll() is None:
+            frame = background.copy()
+            if face is not None:
+                fh, fw = face.shape[:2]
+                t = frame_number / self.fps
+                x = int((self.width - fw) / 2 * (1 + 0.5 * np.sin(t / 2)))
+                y = int((self.height - fh) / 2 * (1 + 0.3 * np.cos(t / 3)))
+                frame[y:y + fh, x:x + fw] = face
+            # ガラス・トゥ・ガラスの遅延測定用に、生成時刻（ミリ秒）を描き込む
+            cv.putText(frame, f'{time.time() * 1000:.0f}', (20, self.height - 20),
+                       cv.FONT_HERSHEY_SIMPLEX, 1.2, (255, 255, 255), 2)
+            try:
+                ffmpeg.stdin.write(frame.tobytes())
+                ffmpeg.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                break
+            frame_number += 1
+            next_tick += period
+            self._stop_event.wait(max(next_tick - time.monotonic(), 0))
+
+    def _send_video(self, ffmpeg):
+        """エンコード済みのH.264をフレームごとに1460バイト以下のデータグラムに分けて送る"""
+        splitter = AccessUnitSplitter()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock_video:
+            while not self._stop_event.is_set():
+                data = ffmpeg.stdout.read1(65536)
+                if not data:
+                    break
+                if self.client is None:
+                    continue
+                address = (self.client[0], self.video_port)
+                for unit in splitter.feed(data):
+                    for offset in range(0, len(unit), VIDEO_PACKET_SIZE):
+                        try:
+                            sock_video.sendto(unit[offset:offset + VIDEO_PACKET_SIZE], address)
+                        except OSError as ex:
+                            logger.error({'action': '_send_video', 'ex': ex})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Telloシミュレータ')
+    parser.add_argument('--host', default='127.0.0.1', help='コマンドを待ち受けるアドレス')
+    parser.add_argument('--port', type=int, default=COMMAND_PORT, help='コマンドを待ち受けるポート')
+    parser.add_argument('--latency', type=float, default=0.0, help='応答の遅延（秒）')
+    parser.add_argument('--jitter', type=float, default=0.0, help='遅延のゆらぎ（秒）')
+    parser.add_argument('--loss', type=float, default=0.0, help='コマンド・応答が失われる確率')
+    parser.add_argument('--time-scale', type=float, default=1.0, help='移動などにかかる時間の倍率')
+    parser.add_argument('--no-video', action='store_true', help='映像を送信しない')
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=None, help='損失・ゆらぎの乱数シード')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    simulator = TelloSimulator(host=args.host, command_port=args.port,
+                               latency=args.latency, jitter=args.jitter, loss=args.loss,
+                               time_scale=args.time_scale, video=not args.no_video, fps=args.fps,
+                               seed=args.seed)
+    simulator.start()
+    print(f"Telloシミュレータを起動しました: {args.host}:{args.port}（Ctrl+Cで終了）")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    main()